@@ -0,0 +1,75 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "src"))
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+DEFAULT_IMAGES = Path(__file__).resolve().parent / "src" / "tests" / "fixtures"
+BACKENDS = ["torch", "onnx"]
+
+
+def load_images(source: Path) -> List[Path]:
+    if source.is_file():
+        return [source]
+    return sorted(p for p in source.rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS)
+
+
+def load_backend(name: str):
+    if name == "torch":
+        from modules.classify_image import classify_image
+    elif name == "onnx":
+        from modules.classify_onnx import classify_image
+    else:
+        raise ValueError(
+            f"unknown backend '{name}', expected one of: {', '.join(BACKENDS)}"
+        )
+    return classify_image
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare classify backends: captions and ms per image"
+    )
+    parser.add_argument("images", nargs="?", type=Path, default=DEFAULT_IMAGES)
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    if not images:
+        sys.exit(f"no images found in {args.images}")
+    data = [p.read_bytes() for p in images]
+
+    print(f"{len(images)} images, {args.repeat} runs each\n")
+    captions = {}
+    for name in args.backends.split(","):
+        try:
+            classify_image = load_backend(name)
+        except (ImportError, RuntimeError, ValueError) as e:
+            print(f"{name:<8}skipped: {e}")
+            continue
+
+        # warm up so model loading and compilation are not counted
+        classify_image(data[0])
+        captions[name] = [classify_image(d) for d in data]
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for d in data:
+                classify_image(d)
+        ms = (time.perf_counter() - start) * 1000 / (args.repeat * len(images))
+        print(f"{name:<8}{ms:>10.1f} ms/img")
+
+    if len(captions) > 1:
+        print()
+        for i, path in enumerate(images):
+            print(path.name)
+            for name, results in captions.items():
+                print(f"  {name:<8}{results[i]}")
+
+
+if __name__ == "__main__":
+    main()
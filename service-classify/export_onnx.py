@@ -0,0 +1,25 @@
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "src"))
+
+from modules.blip_export import DEFAULT_OPSET, export_blip  # noqa: E402
+from modules.classify_onnx import CLASSIFY_ONNX_DIR  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the BLIP captioning model to ONNX for CLASSIFY_BACKEND=onnx"
+    )
+    parser.add_argument("--output", type=Path, default=Path(CLASSIFY_ONNX_DIR))
+    parser.add_argument("--opset", type=int, default=DEFAULT_OPSET)
+    parser.add_argument("--force", action="store_true", help="export again if cached")
+    args = parser.parse_args()
+
+    output_dir = export_blip(args.output, opset=args.opset, force=args.force)
+    print(f"BLIP ONNX models in {output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+import io
+from pathlib import Path
+import cv2
+from PIL import Image
+from service_python_shared.lib.decoding import decode_image
+
+MODEL_NAME = "Salesforce/blip-image-captioning-base"
+MAX_NEW_TOKENS = 20
+MODELS_DIR = Path(__file__).resolve().parents[2] / "models"
+# BLIP sees the image at 384px, an embedded preview that size is decoded instead
+DECODE_MIN_SIZE = 384
+
+
+def buffer_to_resized_pil(
+    image_data: bytes, max_size: int = DECODE_MIN_SIZE
+) -> Image.Image:
+    try:
+        image_bgr = decode_image(image_data, min_size=max_size)
+        image = Image.fromarray(cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB))
+    except ValueError:
+        # formats OpenCV can't read, ie. animated GIFs
+        image = Image.open(io.BytesIO(image_data)).convert("RGB")
+    image.thumbnail(
+        (max_size, max_size), Image.Resampling.LANCZOS
+    )  # Preserve aspect ratio
+    return image
@@ -0,0 +1,112 @@
+import json
+from pathlib import Path
+
+import torch
+from transformers import BlipForConditionalGeneration, BlipProcessor
+
+from modules.blip import MODEL_NAME
+from modules.classify_onnx import (
+    DECODER_FILE,
+    ENCODER_FILE,
+    META_FILE,
+    is_exported,
+    optimized_path,
+)
+
+DEFAULT_OPSET = 17
+
+
+class VisionEncoder(torch.nn.Module):
+    def __init__(self, model: BlipForConditionalGeneration):
+        super().__init__()
+        self.vision_model = model.vision_model
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return self.vision_model(pixel_values=pixel_values, return_dict=False)[0]
+
+
+class TextDecoder(torch.nn.Module):
+    """Logits for every position, the whole sequence is run at each step"""
+
+    def __init__(self, model: BlipForConditionalGeneration):
+        super().__init__()
+        self.text_decoder = model.text_decoder
+
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        encoder_hidden_states: torch.Tensor,
+    ) -> torch.Tensor:
+        return self.text_decoder(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            encoder_hidden_states=encoder_hidden_states,
+            use_cache=False,
+            return_dict=False,
+        )[0]
+
+
+def export_blip(
+    output_dir: Path,
+    model_name: str = MODEL_NAME,
+    opset: int = DEFAULT_OPSET,
+    force: bool = False,
+) -> Path:
+    """
+    Export BLIP's vision encoder and text decoder to ONNX in output_dir, with the
+    processor files and the token ids needed to generate captions without torch.
+    Nothing is done if an export of the same model is already there.
+    """
+    output_dir = Path(output_dir)
+    if not force and is_exported(output_dir, model_name):
+        return output_dir
+    output_dir.mkdir(parents=True, exist_ok=True)
+    # optimised copies of a previous export would otherwise be loaded instead
+    (output_dir / META_FILE).unlink(missing_ok=True)
+    for model_file in (ENCODER_FILE, DECODER_FILE):
+        optimized_path(output_dir / model_file).unlink(missing_ok=True)
+
+    processor = BlipProcessor.from_pretrained(model_name)
+    model = BlipForConditionalGeneration.from_pretrained(model_name)
+    model.eval()
+    size = processor.image_processor.size["height"]
+    pixel_values = torch.zeros(1, 3, size, size)
+
+    with torch.no_grad():
+        torch.onnx.export(
+            VisionEncoder(model),
+            (pixel_values,),
+            str(output_dir / ENCODER_FILE),
+            input_names=["pixel_values"],
+            output_names=["image_embeds"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+            opset_version=opset,
+        )
+        image_embeds = VisionEncoder(model)(pixel_values)
+        input_ids = torch.tensor([[model.config.text_config.bos_token_id, 1000]])
+        torch.onnx.export(
+            TextDecoder(model),
+            (input_ids, torch.ones_like(input_ids), image_embeds),
+            str(output_dir / DECODER_FILE),
+            input_names=["input_ids", "attention_mask", "encoder_hidden_states"],
+            output_names=["logits"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "encoder_hidden_states": {0: "batch"},
+                "logits": {0: "batch", 1: "sequence"},
+            },
+            opset_version=opset,
+        )
+
+    processor.save_pretrained(output_dir)
+    # written last, so an interrupted export is not mistaken for a complete one
+    meta = {
+        "model": model_name,
+        "opset": opset,
+        "bos_token_id": model.config.text_config.bos_token_id,
+        "eos_token_id": model.config.text_config.sep_token_id,
+    }
+    (output_dir / META_FILE).write_text(json.dumps(meta, indent=2))
+    return output_dir
@@ -1,11 +1,9 @@
 from transformers import BlipProcessor, BlipForConditionalGeneration
-from PIL import Image
-import io
 from typing import List
 import torch
+from modules.blip import MAX_NEW_TOKENS, MODEL_NAME, buffer_to_resized_pil
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-MODEL_NAME = "Salesforce/blip-image-captioning-base"
 processor = BlipProcessor.from_pretrained(MODEL_NAME, use_fast=True)
 model = BlipForConditionalGeneration.from_pretrained(MODEL_NAME)
 try:
@@ -16,17 +14,9 @@ model.to(device)
 model.eval()
 
 
-def buffer_to_resized_pil(image_data: bytes, max_size: int = 384) -> Image.Image:
-    image = Image.open(io.BytesIO(image_data)).convert("RGB")
-    image.thumbnail(
-        (max_size, max_size), Image.Resampling.LANCZOS
-    )  # Preserve aspect ratio
-    return image
-
-
 def classify_image(image_data: bytes) -> List[str]:
     image = buffer_to_resized_pil(image_data)
     inputs = processor(image, return_tensors="pt").to(device)
     with torch.no_grad():
-        output = model.generate(**inputs, max_new_tokens=20)
+        output = model.generate(**inputs, max_new_tokens=MAX_NEW_TOKENS)
     return processor.decode(output[0], skip_special_tokens=True)
@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import onnxruntime as ort
+from transformers import BlipProcessor
+
+from modules.blip import MAX_NEW_TOKENS, MODEL_NAME, MODELS_DIR, buffer_to_resized_pil
+
+ENCODER_FILE = "vision_encoder.onnx"
+DECODER_FILE = "text_decoder.onnx"
+META_FILE = "export.json"
+# graph optimisations are saved next to the exported model on first load, they
+# can be specific to the CPU so the cache is kept with the models, not the image
+OPTIMIZED_SUFFIX = ".optimized.onnx"
+
+CLASSIFY_ONNX_DIR = os.environ.get("CLASSIFY_ONNX_DIR", str(MODELS_DIR / "blip-onnx"))
+# 0 leaves the choice to ONNX Runtime, one thread per physical core
+CLASSIFY_ORT_INTRA_OP_THREADS = int(
+    os.environ.get("CLASSIFY_ORT_INTRA_OP_THREADS", "0")
+)
+CLASSIFY_ORT_INTER_OP_THREADS = int(
+    os.environ.get("CLASSIFY_ORT_INTER_OP_THREADS", "0")
+)
+
+
+def is_exported(model_dir: Path, model_name: str = MODEL_NAME) -> bool:
+    meta_path = Path(model_dir) / META_FILE
+    if not meta_path.is_file():
+        return False
+    return json.loads(meta_path.read_text()).get("model") == model_name
+
+
+def check_export(model_dir: str = CLASSIFY_ONNX_DIR) -> Path:
+    """
+    Raises RuntimeError unless a complete export is in model_dir. Cheap enough to
+    run before the workers start, no sessions are created.
+    """
+    model_path = Path(model_dir)
+    if not is_exported(model_path):
+        raise RuntimeError(
+            f"BLIP ONNX export not found in {model_dir}, run export_onnx.py"
+        )
+    for model_file in (ENCODER_FILE, DECODER_FILE):
+        if not (model_path / model_file).is_file():
+            raise RuntimeError(
+                f"BLIP ONNX export in {model_dir} has no {model_file}, "
+                "run export_onnx.py --force"
+            )
+    return model_path
+
+
+def optimized_path(model_path: Path) -> Path:
+    return model_path.with_suffix(OPTIMIZED_SUFFIX)
+
+
+def has_optimized(model_path: Path) -> bool:
+    """an optimised copy saved after the model was last exported"""
+    cached = optimized_path(model_path)
+    return cached.is_file() and cached.stat().st_mtime >= model_path.stat().st_mtime
+
+
+def session_options(intra_op_threads: int, inter_op_threads: int) -> ort.SessionOptions:
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = intra_op_threads
+    if inter_op_threads > 1:
+        # inter-op threads are only used to run independent nodes in parallel
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        options.inter_op_num_threads = inter_op_threads
+    return options
+
+
+def load_session(
+    model_path: Path, intra_op_threads: int, inter_op_threads: int
+) -> ort.InferenceSession:
+    options = session_options(intra_op_threads, inter_op_threads)
+    cached = optimized_path(model_path)
+    if has_optimized(model_path):
+        return ort.InferenceSession(
+            str(cached), sess_options=options, providers=["CPUExecutionProvider"]
+        )
+    # workers load the model at the same time, each saves its own copy and renames
+    # it into place so none is ever loaded half written
+    saving = cached.with_name(f"{cached.name}.{os.getpid()}.tmp")
+    options.optimized_model_filepath = str(saving)
+    session = ort.InferenceSession(
+        str(model_path), sess_options=options, providers=["CPUExecutionProvider"]
+    )
+    os.replace(saving, cached)
+    return session
+
+
+class OnnxCaptioner:
+    """BLIP captioning with ONNX Runtime, greedy decoding as in the PyTorch path"""
+
+    def __init__(
+        self,
+        model_dir: str = CLASSIFY_ONNX_DIR,
+        intra_op_threads: int = CLASSIFY_ORT_INTRA_OP_THREADS,
+        inter_op_threads: int = CLASSIFY_ORT_INTER_OP_THREADS,
+        max_new_tokens: int = MAX_NEW_TOKENS,
+    ):
+        model_path = check_export(model_dir)
+        meta = json.loads((model_path / META_FILE).read_text())
+        self.bos_token_id: int = meta["bos_token_id"]
+        self.eos_token_id: int = meta["eos_token_id"]
+        self.max_new_tokens = max_new_tokens
+        self.processor = BlipProcessor.from_pretrained(model_path)
+        self.encoder = load_session(
+            model_path / ENCODER_FILE, intra_op_threads, inter_op_threads
+        )
+        self.decoder = load_session(
+            model_path / DECODER_FILE, intra_op_threads, inter_op_threads
+        )
+
+    def generate(self, pixel_values: np.ndarray) -> np.ndarray:
+        (image_embeds,) = self.encoder.run(
+            None, {"pixel_values": pixel_values.astype(np.float32)}
+        )
+        input_ids = np.array([[self.bos_token_id]], dtype=np.int64)
+        for _ in range(self.max_new_tokens):
+            (logits,) = self.decoder.run(
+                None,
+                {
+                    "input_ids": input_ids,
+                    "attention_mask": np.ones_like(input_ids),
+                    "encoder_hidden_states": image_embeds,
+                },
+            )
+            next_token = int(logits[0, -1].argmax())
+            input_ids = np.concatenate(
+                [input_ids, np.array([[next_token]], dtype=np.int64)], axis=1
+            )
+            if next_token == self.eos_token_id:
+                break
+        return input_ids[0]
+
+    def caption(self, image_data: bytes) -> str:
+        image = buffer_to_resized_pil(image_data)
+        pixel_values = self.processor(images=image, return_tensors="np")["pixel_values"]
+        return self.processor.decode(
+            self.generate(pixel_values), skip_special_tokens=True
+        )
+
+
+_default_captioner: Optional[OnnxCaptioner] = None
+_default_captioner_lock = threading.Lock()
+
+
+def get_captioner() -> OnnxCaptioner:
+    global _default_captioner
+    with _default_captioner_lock:
+        if _default_captioner is None:
+            _default_captioner = OnnxCaptioner()
+    return _default_captioner
+
+
+def classify_image(image_data: bytes) -> List[str]:
+    return get_captioner().caption(image_data)
@@ -1,17 +1,42 @@
-import asyncio
+import os
+import sys
 from service_python_shared.modules.logger import setup_logging, get_logger
+from service_python_shared.modules.Supervisor import run_service
 from service_python_shared.modules.Workflow import Workflow
-from modules.classify_image import classify_image
 
+# "onnx" runs the model exported by export_onnx.py with ONNX Runtime. The PyTorch
+# model is loaded here, once, and shared by all workers. ONNX Runtime sessions
+# start threads, so are created in each worker instead
+CLASSIFY_BACKEND = os.environ.get("CLASSIFY_BACKEND", "torch").lower()
+if CLASSIFY_BACKEND == "onnx":
+    from modules.classify_onnx import check_export, classify_image, get_captioner
+else:
+    from modules.classify_image import classify_image
 
-async def main():
+
+def make_workflow() -> Workflow:
+    if CLASSIFY_BACKEND == "onnx":
+        # loaded before the worker takes any message
+        get_captioner()
+    return Workflow(description="classify image", extract_data=classify_image)
+
+
+def main() -> int:
     setup_logging()
     logger = get_logger("main")
-    logger.info("launching service...")
-    workflow = Workflow(description="classify image", extract_data=classify_image)
-    await workflow.start_receiving_messages()
+    logger.info(f"launching service with {CLASSIFY_BACKEND} backend...")
+    if CLASSIFY_BACKEND == "onnx":
+        # checked before any message, so a missing export stops the service
+        # instead of failing, and requeueing, every message
+        try:
+            model_path = check_export()
+        except RuntimeError as e:
+            logger.error(f"ONNX captioner can't be used: {e}")
+            return 1
+        logger.info(f"captioning with the ONNX export in {model_path}")
+    return run_service(make_workflow)
 
 
 if __name__ == "__main__":
     print("service running...")
-    asyncio.run(main())
+    sys.exit(main())
@@ -0,0 +1,83 @@
+import os
+from pathlib import Path
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+pytest.importorskip("onnxruntime")
+
+from modules.blip import buffer_to_resized_pil  # noqa: E402
+from modules.classify_onnx import (  # noqa: E402
+    CLASSIFY_ONNX_DIR,
+    DECODER_FILE,
+    ENCODER_FILE,
+    META_FILE,
+    OnnxCaptioner,
+    check_export,
+    has_optimized,
+    is_exported,
+    optimized_path,
+)
+
+FIXTURE_DIR = Path(__file__).parent / "fixtures"
+
+needs_export = pytest.mark.skipif(
+    not is_exported(Path(CLASSIFY_ONNX_DIR)),
+    reason="BLIP ONNX export not found, run export_onnx.py",
+)
+
+
+def test_optimized_model_older_than_export_is_not_used(tmp_path):
+    model_path = tmp_path / "model.onnx"
+    model_path.write_bytes(b"exported")
+    optimized_path(model_path).write_bytes(b"optimized")
+    assert has_optimized(model_path)
+
+    # exported again after the optimised copy was saved
+    mtime = model_path.stat().st_mtime
+    os.utime(optimized_path(model_path), (mtime - 60, mtime - 60))
+    assert not has_optimized(model_path)
+
+
+def test_incomplete_export_is_refused(tmp_path):
+    with pytest.raises(RuntimeError, match="not found"):
+        check_export(str(tmp_path))
+    (tmp_path / META_FILE).write_text(
+        '{"model": "Salesforce/blip-image-captioning-base"}'
+    )
+    (tmp_path / ENCODER_FILE).write_bytes(b"exported")
+    with pytest.raises(RuntimeError, match=DECODER_FILE):
+        check_export(str(tmp_path))
+    (tmp_path / DECODER_FILE).write_bytes(b"exported")
+    assert check_export(str(tmp_path)) == tmp_path
+
+
+@pytest.fixture(scope="module")
+def captioner():
+    return OnnxCaptioner()
+
+
+@needs_export
+@pytest.mark.parametrize("fixture", ["bakery.jpg", "bikes.jpg", "snake.jpeg"])
+def test_onnx_matches_torch(captioner, fixture):
+    from modules.classify_image import model, processor
+
+    image = buffer_to_resized_pil((FIXTURE_DIR / fixture).read_bytes())
+    # the same pixels for both, so only the model runtime differs
+    pixel_values = captioner.processor(images=image, return_tensors="np")[
+        "pixel_values"
+    ]
+    with torch.no_grad():
+        torch_embeds = model.vision_model(
+            pixel_values=torch.from_numpy(pixel_values), return_dict=False
+        )[0].numpy()
+        torch_ids = model.generate(
+            pixel_values=torch.from_numpy(pixel_values),
+            max_new_tokens=captioner.max_new_tokens,
+        )[0].numpy()
+    (onnx_embeds,) = captioner.encoder.run(None, {"pixel_values": pixel_values})
+
+    assert np.allclose(onnx_embeds, torch_embeds, atol=1e-3)
+    assert captioner.processor.decode(
+        captioner.generate(pixel_values), skip_special_tokens=True
+    ) == processor.decode(torch_ids, skip_special_tokens=True)
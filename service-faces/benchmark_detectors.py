@@ -0,0 +1,72 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "src"))
+
+from modules.detect_faces import detect_faces  # noqa: E402
+from modules.face_detectors import DETECTORS, create_detector  # noqa: E402
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+DEFAULT_IMAGES = Path(__file__).resolve().parent / "src" / "tests" / "fixtures"
+
+
+def load_images(source: Path) -> List[Path]:
+    if source.is_file():
+        return [source]
+    return sorted(p for p in source.rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare face detector backends: faces found and ms per image"
+    )
+    parser.add_argument("images", nargs="?", type=Path, default=DEFAULT_IMAGES)
+    parser.add_argument("--detectors", default=",".join(DETECTORS))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    if not images:
+        sys.exit(f"no images found in {args.images}")
+    data = [p.read_bytes() for p in images]
+    decoded = [cv2.imdecode(np.frombuffer(d, np.uint8), cv2.IMREAD_COLOR) for d in data]
+    rgb = [cv2.cvtColor(image, cv2.COLOR_BGR2RGB) for image in decoded]
+
+    print(f"{len(images)} images, {args.repeat} runs each\n")
+    print(f"{'detector':<10}{'faces':>8}{'detect ms/img':>16}{'total ms/img':>16}")
+    for name in args.detectors.split(","):
+        try:
+            detector = create_detector(name)
+        except (RuntimeError, ValueError) as e:
+            print(f"{name:<10}skipped: {e}")
+            continue
+
+        # warm up so model loading is not counted
+        detector.face_locations(rgb[0], decoded[0])
+
+        faces = sum(len(detector.face_locations(r, b)) for r, b in zip(rgb, decoded))
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for r, b in zip(rgb, decoded):
+                detector.face_locations(r, b)
+        detect_ms = (time.perf_counter() - start) * 1000 / (args.repeat * len(images))
+
+        # decode, detect and encode, as run by the service
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for d in data:
+                detect_faces(d, detector=detector)
+        total_ms = (time.perf_counter() - start) * 1000 / (args.repeat * len(images))
+
+        print(f"{name:<10}{faces:>8}{detect_ms:>16.1f}{total_ms:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
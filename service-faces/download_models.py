@@ -0,0 +1,33 @@
+import hashlib
+import re
+import urllib.request
+import sys
+
+sys.path.insert(0, "src")
+
+from modules.face_detectors import (  # noqa: E402
+    MODELS_DIR,
+    YUNET_MODEL_NAME,
+    YUNET_MODEL_POINTER_URL,
+    YUNET_MODEL_URL,
+)
+
+# Fetch the YuNet weights used by the OpenCV DNN face detector (FACE_DETECTOR=yunet).
+# Exits with an error, failing the image build, unless the file matches the sha256
+# in its git LFS pointer at the pinned commit
+with urllib.request.urlopen(YUNET_MODEL_POINTER_URL) as response:
+    pointer = response.read().decode()
+match = re.search(r"^oid sha256:([0-9a-f]{64})$", pointer, re.MULTILINE)
+if not match:
+    sys.exit(f"no sha256 in the git LFS pointer at {YUNET_MODEL_POINTER_URL}")
+expected = match.group(1)
+
+MODELS_DIR.mkdir(parents=True, exist_ok=True)
+model_path = MODELS_DIR / YUNET_MODEL_NAME
+download_path = model_path.with_suffix(".download")
+urllib.request.urlretrieve(YUNET_MODEL_URL, download_path)
+sha256 = hashlib.sha256(download_path.read_bytes()).hexdigest()
+if sha256 != expected:
+    download_path.unlink()
+    sys.exit(f"{YUNET_MODEL_URL} has sha256 {sha256}, expected {expected}")
+download_path.replace(model_path)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, ConfigDict, Field
-from typing import List
+from typing import List, Optional, Tuple
 import numpy as np
 import cv2
 import warnings
@@ -10,6 +10,16 @@ warnings.filterwarnings(
 )
 
 import face_recognition  # noqa: E402
+from service_python_shared.lib.decoding import decode_image  # noqa: E402
+from modules.face_detectors import (  # noqa: E402
+    FaceDetector,
+    FaceLocation,
+    get_detector,
+)
+from modules.tiled_detection import detect_faces_tiled, should_tile  # noqa: E402
+
+# faces are located at full resolution, so coordinates match the original image
+DECODE_MIN_SIZE = 0
 
 
 class FaceData(BaseModel):
@@ -22,17 +32,18 @@ class FaceData(BaseModel):
     model_config = ConfigDict(populate_by_name=True)
 
 
-def detect_faces(image_data: bytes) -> List[FaceData]:
-    faces: List[FaceData] = []
-
-    nparr = np.frombuffer(image_data, np.uint8)
-    image_bgr = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+def detect_faces(
+    image_data: bytes, detector: Optional[FaceDetector] = None
+) -> List[FaceData]:
+    detector = detector or get_detector()
 
-    locations = face_recognition.face_locations(image_rgb)
-    hashes = face_recognition.face_encodings(image_rgb, known_face_locations=locations)
+    if should_tile(image_data):
+        found = detect_faces_tiled(image_data, detector)
+    else:
+        found = detect_faces_whole(image_data, detector)
 
-    for loc, encoding in zip(locations, hashes):
+    faces: List[FaceData] = []
+    for loc, encoding in found:
         top, right, bottom, left = loc
         width = right - left
         height = bottom - top
@@ -47,3 +58,14 @@ def detect_faces(image_data: bytes) -> List[FaceData]:
         faces.append(face)
 
     return faces
+
+
+def detect_faces_whole(
+    image_data: bytes, detector: FaceDetector
+) -> List[Tuple[FaceLocation, np.ndarray]]:
+    image_bgr = decode_image(image_data, min_size=DECODE_MIN_SIZE)
+    image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+
+    locations = detector.face_locations(image_rgb, image_bgr)
+    hashes = face_recognition.face_encodings(image_rgb, known_face_locations=locations)
+    return list(zip(locations, hashes))
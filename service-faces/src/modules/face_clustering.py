@@ -0,0 +1,392 @@
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from pydantic import BaseModel
+from service_python_shared.lib.utils import parse_float, parse_int
+
+FACE_CLUSTER_THRESHOLD = parse_float(os.environ.get("FACE_CLUSTER_THRESHOLD"), 0.5)
+FACE_CLUSTER_MERGE_THRESHOLD = parse_float(
+    os.environ.get("FACE_CLUSTER_MERGE_THRESHOLD"), 0.4
+)
+FACE_CLUSTER_REFINE_EVERY = parse_int(os.environ.get("FACE_CLUSTER_REFINE_EVERY"), 2000)
+FACE_CLUSTER_MAX_JOBS = parse_int(os.environ.get("FACE_CLUSTER_MAX_JOBS"), 8)
+
+ENCODING_SIZE = 128
+# distances computed at once when refining, so memory stays bounded however many clusters
+REFINE_BLOCK_ELEMENTS = 1 << 23
+
+
+class EvictedJob(BaseModel):
+    job_id: str
+    # the job's cluster ids below this are never given out or merged again
+    next_id: int
+
+
+class ClusterUpdate(BaseModel):
+    # cluster id for each face added, in the order given
+    labels: List[str]
+    # clusters folded into another by refinement since the last update: old id -> new id
+    merged: Dict[str, str] = {}
+    # jobs whose clusters were dropped from memory to make room for this one
+    evicted: List[EvictedJob] = []
+
+
+def squared_norms(a: np.ndarray) -> np.ndarray:
+    return np.einsum("ij,ij->i", a, a)
+
+
+def squared_distances(
+    a: np.ndarray, b: np.ndarray, b_norms: Optional[np.ndarray] = None
+) -> np.ndarray:
+    if b_norms is None:
+        b_norms = squared_norms(b)
+    d2 = squared_norms(a)[:, None] + b_norms[None, :] - 2.0 * (b @ a.T).T
+    return np.maximum(d2, 0.0, out=d2)
+
+
+def chinese_whispers(
+    indptr: np.ndarray,
+    indices: np.ndarray,
+    weights: np.ndarray,
+    self_weights: np.ndarray,
+    iterations: int = 20,
+) -> np.ndarray:
+    """
+    Chinese whispers graph clustering over a CSR adjacency. Each node repeatedly
+    takes the label with the highest total edge weight among its neighbours and
+    itself, ties going to the lowest label. All nodes are updated at once, with
+    numpy, and counting each node's own vote keeps them from swapping labels back
+    and forth. Returns a label per node.
+    """
+    node_count = len(indptr) - 1
+    labels = np.arange(node_count)
+    nodes = np.arange(node_count)
+    rows = np.concatenate([np.repeat(nodes, np.diff(indptr)), nodes])
+    vote_weights = np.concatenate([weights, self_weights]).astype(np.float64)
+    for _ in range(iterations):
+        voted = np.concatenate([labels[indices], labels])
+        # total weight of each label around each node
+        pairs, inverse = np.unique(rows * node_count + voted, return_inverse=True)
+        totals = np.bincount(inverse, weights=vote_weights)
+        pair_rows, pair_labels = np.divmod(pairs, node_count)
+        order = np.lexsort((pair_labels, -totals, pair_rows))
+        first = order[np.r_[True, np.diff(pair_rows[order]) > 0]]
+        updated = labels.copy()
+        updated[pair_rows[first]] = pair_labels[first]
+        if np.array_equal(updated, labels):
+            break
+        labels = updated
+    return labels
+
+
+class JobFaceClusters:
+    """
+    Online leader clustering of face encodings for one job. Each face joins the
+    nearest cluster centroid within threshold or starts a new cluster, so adding a
+    face costs O(clusters) rather than O(faces). Clusters whose centroids drift
+    together are merged by refine(), which only looks at the clusters changed since
+    it last ran.
+
+    Live clusters are kept in slots 0..cluster_count of contiguous arrays, so they
+    are searched without copying. Cluster ids never change, a merged cluster's
+    slot is filled by one from the end.
+    """
+
+    def __init__(
+        self,
+        threshold: float = FACE_CLUSTER_THRESHOLD,
+        merge_threshold: float = FACE_CLUSTER_MERGE_THRESHOLD,
+        initial_capacity: int = 1024,
+    ):
+        self.threshold_sq = threshold**2
+        self.merge_threshold_sq = merge_threshold**2
+        # per slot
+        self._sums = np.zeros((initial_capacity, ENCODING_SIZE), np.float64)
+        self._centroids = np.zeros((initial_capacity, ENCODING_SIZE), np.float32)
+        # squared length of each centroid, so it is not worked out again per search
+        self._norms = np.zeros(initial_capacity, np.float32)
+        self._counts = np.zeros(initial_capacity, np.int64)
+        self._ids = np.zeros(initial_capacity, np.int64)
+        # joined or created since the last refine
+        self._changed = np.zeros(initial_capacity, bool)
+        self._size = 0
+        # slot of each cluster id, -1 once merged into another
+        self._slots = np.zeros(initial_capacity, np.int64)
+        self._cluster_count = 0
+        self._labels = np.zeros(initial_capacity, np.int64)
+        self._face_count = 0
+        self.faces_since_refine = 0
+
+    @property
+    def face_count(self) -> int:
+        return self._face_count
+
+    @property
+    def cluster_count(self) -> int:
+        return self._size
+
+    @property
+    def created_count(self) -> int:
+        """clusters ever created, including those since merged into another"""
+        return self._cluster_count
+
+    @property
+    def labels(self) -> np.ndarray:
+        """current cluster id of every face added so far"""
+        return self._labels[: self._face_count]
+
+    def _grow_slots(self, needed: int):
+        capacity = len(self._counts)
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2)
+        self._sums = _resize(self._sums, capacity)
+        self._centroids = _resize(self._centroids, capacity)
+        self._norms = _resize(self._norms, capacity)
+        self._counts = _resize(self._counts, capacity)
+        self._ids = _resize(self._ids, capacity)
+        self._changed = _resize(self._changed, capacity)
+
+    def _grow_faces(self, needed: int):
+        if needed > len(self._labels):
+            self._labels = _resize(self._labels, max(needed, len(self._labels) * 2))
+
+    def _update_centroids(self, slots):
+        self._centroids[slots] = self._sums[slots] / self._counts[slots, None]
+        self._norms[slots] = squared_norms(self._centroids[slots])
+        self._changed[slots] = True
+
+    def _join(self, slot: int, encoding: np.ndarray):
+        self._sums[slot] += encoding
+        self._counts[slot] += 1
+        self._update_centroids([slot])
+
+    def _new_cluster(self, encoding: np.ndarray) -> int:
+        slot, cluster_id = self._size, self._cluster_count
+        self._grow_slots(slot + 1)
+        if cluster_id >= len(self._slots):
+            self._slots = _resize(self._slots, len(self._slots) * 2)
+        self._size += 1
+        self._cluster_count += 1
+        self._sums[slot] = encoding
+        self._centroids[slot] = encoding
+        self._norms[slot] = encoding @ encoding
+        self._counts[slot] = 1
+        self._ids[slot] = cluster_id
+        self._changed[slot] = True
+        self._slots[cluster_id] = slot
+        return cluster_id
+
+    def add(self, encodings: np.ndarray) -> np.ndarray:
+        encodings = np.asarray(encodings, np.float32).reshape(-1, ENCODING_SIZE)
+        labels = np.full(len(encodings), -1, np.int64)
+        if not len(encodings):
+            return labels
+
+        # match the whole batch against existing clusters in one distance computation
+        size = self._size
+        if size:
+            d2 = squared_distances(
+                encodings, self._centroids[:size], self._norms[:size]
+            )
+            nearest = d2.argmin(axis=1)
+            matched = d2[np.arange(len(encodings)), nearest] <= self.threshold_sq
+            joined = nearest[matched]
+            labels[matched] = self._ids[joined]
+            np.add.at(self._sums, joined, encodings[matched])
+            np.add.at(self._counts, joined, 1)
+            self._update_centroids(np.unique(joined))
+
+        # unmatched faces may match each other, so only these are handled one by one
+        # against the clusters created here, which fill the slots from size
+        for i in np.flatnonzero(labels < 0):
+            if self._size > size:
+                d2 = ((self._centroids[size : self._size] - encodings[i]) ** 2).sum(
+                    axis=1
+                )
+                nearest = int(d2.argmin())
+                if d2[nearest] <= self.threshold_sq:
+                    labels[i] = self._ids[size + nearest]
+                    self._join(size + nearest, encodings[i])
+                    continue
+            labels[i] = self._new_cluster(encodings[i])
+
+        start = self._face_count
+        self._grow_faces(start + len(labels))
+        self._labels[start : start + len(labels)] = labels
+        self._face_count += len(labels)
+        self.faces_since_refine += len(labels)
+        return labels
+
+    def _neighbours(self, slots: np.ndarray) -> np.ndarray:
+        """slots within merge_threshold of any of slots, including themselves"""
+        found = np.zeros(self._size, bool)
+        block_size = max(1, REFINE_BLOCK_ELEMENTS // self._size)
+        for start in range(0, len(slots), block_size):
+            block = squared_distances(
+                self._centroids[slots[start : start + block_size]],
+                self._centroids[: self._size],
+                self._norms[: self._size],
+            )
+            found |= (block <= self.merge_threshold_sq).any(axis=0)
+        return np.flatnonzero(found)
+
+    def _centroid_graph(
+        self, slots: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        centroids = self._centroids[slots]
+        rows: List[np.ndarray] = []
+        cols: List[np.ndarray] = []
+        block_size = max(1, REFINE_BLOCK_ELEMENTS // len(slots))
+        for start in range(0, len(slots), block_size):
+            block = squared_distances(centroids[start : start + block_size], centroids)
+            r, c = np.nonzero(block <= self.merge_threshold_sq)
+            r += start
+            keep = r != c
+            rows.append(r[keep])
+            cols.append(c[keep])
+        rows_all = np.concatenate(rows)
+        cols_all = np.concatenate(cols)
+        order = np.argsort(rows_all, kind="stable")
+        indices = cols_all[order]
+        indptr = np.zeros(len(slots) + 1, np.int64)
+        np.cumsum(np.bincount(rows_all, minlength=len(slots)), out=indptr[1:])
+        # larger clusters pull harder on their neighbours
+        weights = self._counts[slots][indices].astype(np.float64)
+        return indptr, indices, weights
+
+    def _remove(self, slots: np.ndarray):
+        """drop the clusters in slots, moving those from the end into the gaps"""
+        self._slots[self._ids[slots]] = -1
+        size = self._size - len(slots)
+        kept = np.ones(self._size, bool)
+        kept[slots] = False
+        gaps = np.sort(slots[slots < size])
+        moved = np.flatnonzero(kept[size:]) + size
+        for array in (
+            self._sums,
+            self._centroids,
+            self._norms,
+            self._counts,
+            self._ids,
+            self._changed,
+        ):
+            array[gaps] = array[moved]
+        self._slots[self._ids[gaps]] = gaps
+        self._size = size
+
+    def refine(self) -> Dict[int, int]:
+        """
+        Merge clusters whose centroids lie within merge_threshold, using Chinese
+        whispers over the graph of the clusters changed since the last refine and
+        their neighbours. Clusters that have not changed were not close enough to
+        merge last time, so are only compared with changed ones. Merged clusters
+        keep their lowest id. Returns a mapping of each retired cluster id to the
+        id it was merged into.
+        """
+        self.faces_since_refine = 0
+        changed = np.flatnonzero(self._changed[: self._size])
+        self._changed[: self._size] = False
+        if self._size < 2 or not changed.size:
+            return {}
+        slots = self._neighbours(changed)
+        if len(slots) < 2:
+            return {}
+
+        ids = self._ids[slots]
+        groups = chinese_whispers(
+            *self._centroid_graph(slots), self_weights=self._counts[slots]
+        )
+        # canonical id for each group is the lowest cluster id in it
+        canonical = np.full(len(slots), np.iinfo(np.int64).max)
+        np.minimum.at(canonical, groups, ids)
+        target_ids = canonical[groups]
+        moved = target_ids != ids
+        if not moved.any():
+            return {}
+
+        sources, targets = slots[moved], self._slots[target_ids[moved]]
+        np.add.at(self._sums, targets, self._sums[sources])
+        np.add.at(self._counts, targets, self._counts[sources])
+        # moved closer to others, so looked at again next time
+        self._update_centroids(np.unique(targets))
+        merged = dict(zip(ids[moved].tolist(), target_ids[moved].tolist()))
+        self._remove(sources)
+
+        remap = np.arange(self._cluster_count)
+        remap[ids[moved]] = target_ids[moved]
+        self._labels[: self._face_count] = remap[self.labels]
+        return merged
+
+
+def _resize(array: np.ndarray, length: int) -> np.ndarray:
+    grown = np.zeros((length, *array.shape[1:]), array.dtype)
+    grown[: len(array)] = array
+    return grown
+
+
+class FaceClusterer:
+    """
+    Keeps incremental face clusters per job, refining each job periodically.
+    Only the most recently used jobs are held in memory. Cluster ids are
+    "<namespace>:<n>", so ids from different clusterers never collide, and a job
+    evicted and seen again carries on numbering where it left off.
+    """
+
+    def __init__(
+        self,
+        threshold: float = FACE_CLUSTER_THRESHOLD,
+        merge_threshold: float = FACE_CLUSTER_MERGE_THRESHOLD,
+        refine_every: int = FACE_CLUSTER_REFINE_EVERY,
+        max_jobs: int = FACE_CLUSTER_MAX_JOBS,
+        namespace: str = "",
+    ):
+        self.threshold = threshold
+        self.merge_threshold = merge_threshold
+        self.refine_every = refine_every
+        self.max_jobs = max_jobs
+        self.namespace = namespace
+        self.jobs: "OrderedDict[str, JobFaceClusters]" = OrderedDict()
+        # first id of each job's clusters, numbering continues after an eviction
+        self.first_ids: Dict[str, int] = {}
+        self.next_ids: Dict[str, int] = {}
+
+    def cluster_id(self, job_id: str, label: int) -> str:
+        return f"{self.namespace}:{self.first_ids[job_id] + label}"
+
+    def get_job(
+        self, job_id: str, evicted: Optional[List[EvictedJob]] = None
+    ) -> JobFaceClusters:
+        clusters = self.jobs.get(job_id)
+        if clusters is None:
+            clusters = JobFaceClusters(self.threshold, self.merge_threshold)
+            self.jobs[job_id] = clusters
+            self.first_ids[job_id] = self.next_ids.pop(job_id, 0)
+            while len(self.jobs) > self.max_jobs:
+                old_id, old = self.jobs.popitem(last=False)
+                next_id = self.first_ids.pop(old_id) + old.created_count
+                self.next_ids[old_id] = next_id
+                if evicted is not None:
+                    evicted.append(EvictedJob(job_id=old_id, next_id=next_id))
+        else:
+            self.jobs.move_to_end(job_id)
+        return clusters
+
+    def add_faces(self, job_id: str, encodings: np.ndarray) -> ClusterUpdate:
+        evicted: List[EvictedJob] = []
+        clusters = self.get_job(job_id, evicted)
+        labels = clusters.add(encodings)
+        merged: Dict[int, int] = {}
+        if clusters.faces_since_refine >= self.refine_every:
+            merged = clusters.refine()
+            if merged:
+                labels = np.array([merged.get(int(label), label) for label in labels])
+        return ClusterUpdate(
+            labels=[self.cluster_id(job_id, int(label)) for label in labels],
+            merged={
+                self.cluster_id(job_id, old): self.cluster_id(job_id, new)
+                for old, new in merged.items()
+            },
+            evicted=evicted,
+        )
@@ -0,0 +1,180 @@
+import os
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Type
+import numpy as np
+import cv2
+import warnings
+
+# Suppress warning from face_recognition_models
+warnings.filterwarnings(
+    "ignore", category=UserWarning, module=r".*face_recognition_models.*"
+)
+
+import face_recognition  # noqa: E402
+from service_python_shared.lib.utils import parse_float, parse_int  # noqa: E402
+
+# (top, right, bottom, left) as used by face_recognition
+FaceLocation = Tuple[int, int, int, int]
+
+MODELS_DIR = Path(__file__).resolve().parents[2] / "models"
+YUNET_MODEL_NAME = "face_detection_yunet_2023mar.onnx"
+# opencv_zoo commit the model is fetched from, as pinned by OpenCV's own samples.
+# The zoo keeps models in git LFS, so the file's pointer at this commit holds the
+# sha256 the download is checked against
+YUNET_MODEL_COMMIT = "fef72f8fa7c52eaf116d3df358d24e6e959ada0e"
+YUNET_MODEL_URL = (
+    f"https://github.com/opencv/opencv_zoo/raw/{YUNET_MODEL_COMMIT}"
+    f"/models/face_detection_yunet/{YUNET_MODEL_NAME}"
+)
+YUNET_MODEL_POINTER_URL = (
+    f"https://raw.githubusercontent.com/opencv/opencv_zoo/{YUNET_MODEL_COMMIT}"
+    f"/models/face_detection_yunet/{YUNET_MODEL_NAME}"
+)
+
+FACE_DETECTOR = os.environ.get("FACE_DETECTOR", "hog").lower()
+FACE_DETECTOR_UPSAMPLE = parse_int(os.environ.get("FACE_DETECTOR_UPSAMPLE"), 1)
+FACE_DETECTOR_YUNET_MODEL = os.environ.get(
+    "FACE_DETECTOR_YUNET_MODEL", str(MODELS_DIR / YUNET_MODEL_NAME)
+)
+FACE_DETECTOR_YUNET_THRESHOLD = parse_float(
+    os.environ.get("FACE_DETECTOR_YUNET_THRESHOLD"), 0.8
+)
+# longest side YuNet is run at, larger images are scaled down, 0 for full size
+FACE_DETECTOR_YUNET_MAX_SIZE = parse_int(
+    os.environ.get("FACE_DETECTOR_YUNET_MAX_SIZE"), 1280
+)
+
+
+class FaceDetector(ABC):
+    name = "base"
+    # longest side searched at full resolution, 0 for any size
+    max_size = 0
+
+    @abstractmethod
+    def face_locations(
+        self, image_rgb: np.ndarray, image_bgr: np.ndarray
+    ) -> List[FaceLocation]:
+        pass
+
+
+class HogFaceDetector(FaceDetector):
+    name = "hog"
+
+    def __init__(self, upsample: int = FACE_DETECTOR_UPSAMPLE):
+        self.upsample = upsample
+
+    def face_locations(
+        self, image_rgb: np.ndarray, image_bgr: np.ndarray
+    ) -> List[FaceLocation]:
+        return face_recognition.face_locations(
+            image_rgb, number_of_times_to_upsample=self.upsample, model=self.name
+        )
+
+
+class CnnFaceDetector(HogFaceDetector):
+    # dlib's MMOD CNN, much slower than HOG without CUDA but finds small and profile faces
+    name = "cnn"
+
+
+class YuNetFaceDetector(FaceDetector):
+    name = "yunet"
+
+    def __init__(
+        self,
+        model_path: str = FACE_DETECTOR_YUNET_MODEL,
+        score_threshold: float = FACE_DETECTOR_YUNET_THRESHOLD,
+        nms_threshold: float = 0.3,
+        top_k: int = 5000,
+        max_size: int = FACE_DETECTOR_YUNET_MAX_SIZE,
+    ):
+        if not Path(model_path).is_file():
+            raise RuntimeError(
+                f"YuNet model not found at {model_path}, run download_models.py"
+            )
+        self.max_size = max_size
+        self.settings = (
+            model_path,
+            "",
+            (320, 320),
+            score_threshold,
+            nms_threshold,
+            top_k,
+        )
+        # input size is set per image before detecting, so each thread has its own
+        self.local = threading.local()
+        try:
+            # loaded now, so a bad model fails at startup rather than on every image
+            self.detector
+        except cv2.error as e:
+            raise RuntimeError(
+                f"YuNet model at {model_path} can't be loaded: {e}"
+            ) from e
+
+    @property
+    def detector(self) -> cv2.FaceDetectorYN:
+        detector = getattr(self.local, "detector", None)
+        if detector is None:
+            detector = cv2.FaceDetectorYN.create(*self.settings)
+            self.local.detector = detector
+        return detector
+
+    def face_locations(
+        self, image_rgb: np.ndarray, image_bgr: np.ndarray
+    ) -> List[FaceLocation]:
+        height, width = image_bgr.shape[:2]
+        # the network's cost grows with its input, so large images are searched at
+        # a bounded size and the boxes scaled back to the original
+        scale = 1.0
+        if self.max_size and max(width, height) > self.max_size:
+            scale = self.max_size / max(width, height)
+            image_bgr = cv2.resize(
+                image_bgr,
+                (max(round(width * scale), 1), max(round(height * scale), 1)),
+                interpolation=cv2.INTER_AREA,
+            )
+        detector = self.detector
+        detector.setInputSize((image_bgr.shape[1], image_bgr.shape[0]))
+        _, detections = detector.detect(image_bgr)
+        if detections is None:
+            return []
+
+        locations: List[FaceLocation] = []
+        for x, y, w, h in detections[:, :4] / scale:
+            # boxes can extend past the image edges, clip to keep encodings valid
+            left = max(int(round(x)), 0)
+            top = max(int(round(y)), 0)
+            right = min(int(round(x + w)), width)
+            bottom = min(int(round(y + h)), height)
+            if right > left and bottom > top:
+                locations.append((top, right, bottom, left))
+        return locations
+
+
+DETECTORS: Dict[str, Type[FaceDetector]] = {
+    HogFaceDetector.name: HogFaceDetector,
+    CnnFaceDetector.name: CnnFaceDetector,
+    YuNetFaceDetector.name: YuNetFaceDetector,
+}
+
+_default_detector: Optional[FaceDetector] = None
+_default_detector_lock = threading.Lock()
+
+
+def create_detector(name: str) -> FaceDetector:
+    detector_class = DETECTORS.get(name.lower())
+    if detector_class is None:
+        raise ValueError(
+            f"unknown face detector '{name}', expected one of: {', '.join(DETECTORS)}"
+        )
+    return detector_class()
+
+
+def get_detector() -> FaceDetector:
+    """Detector chosen for this deployment with FACE_DETECTOR, created once"""
+    global _default_detector
+    with _default_detector_lock:
+        if _default_detector is None:
+            _default_detector = create_detector(FACE_DETECTOR)
+    return _default_detector
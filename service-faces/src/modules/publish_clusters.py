@@ -0,0 +1,127 @@
+import asyncio
+import os
+import socket
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Literal, Set
+import numpy as np
+from pydantic import BaseModel, ConfigDict, Field
+from service_python_shared.configs.config import config
+from service_python_shared.lib.utils import parse_bool
+from service_python_shared.modules.logger import get_logger
+from service_python_shared.modules.rabbitmq import (
+    RabbitMqMessage,
+    RabbitMqMessageSender,
+)
+from modules.detect_faces import FaceData
+from modules.face_clustering import FaceClusterer
+
+FACE_CLUSTERING = parse_bool(os.environ.get("FACE_CLUSTERING"), False)
+FACE_CLUSTERS_QUEUE = os.environ.get(
+    "RABBIT_MQ_FACE_CLUSTERS_QUEUE_NAME", "FaceClusters"
+)
+
+
+class FaceClusterAssignments(BaseModel):
+    event: Literal["assigned"] = "assigned"
+    # cluster id of each face in the image, in the same order as the extracted FaceData
+    clusters: List[str]
+    # earlier cluster ids for the job that have been merged: old id -> new id
+    merged: Dict[str, str]
+
+
+class FaceClustersEvicted(BaseModel):
+    """
+    The job's clusters were dropped from memory. Ids "<namespace>:<n>" with n below
+    next_id are final, later faces of the same people start new clusters.
+    """
+
+    event: Literal["evicted"] = "evicted"
+    namespace: str
+    next_id: int = Field(alias="nextId")
+
+    model_config = ConfigDict(populate_by_name=True)
+
+
+def worker_namespace() -> str:
+    """prefix for cluster ids unique to this worker, even across restarts"""
+    replica_id = config["rabbitmq"]["replica_id"] or socket.gethostname()
+    return f"{replica_id}/{uuid.uuid4().hex[:8]}"
+
+
+class FaceClusterPublisher:
+    def __init__(self, clusterer: FaceClusterer | None = None):
+        self.clusterer = clusterer or FaceClusterer(namespace=worker_namespace())
+        self.sender = RabbitMqMessageSender(FACE_CLUSTERS_QUEUE)
+        # clustering, and refining in particular, runs off the event loop, one job at a time
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="face-clusters"
+        )
+        # publishes still to finish, close waits for them
+        self._pending: Set[asyncio.Future] = set()
+
+    async def publish(
+        self,
+        data: RabbitMqMessage,
+        faces: List[FaceData],
+        corr_id: str,
+        jwe_token: str,
+    ):
+        if not faces:
+            return
+        # shielded, so faces already clustered are published even if the message
+        # handling is cancelled
+        task = asyncio.ensure_future(self._publish(data, faces, corr_id, jwe_token))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        await asyncio.shield(task)
+
+    async def _publish(
+        self,
+        data: RabbitMqMessage,
+        faces: List[FaceData],
+        corr_id: str,
+        jwe_token: str,
+    ):
+        logger = get_logger("FaceClusterPublisher/publish", corr_id=corr_id)
+        encodings = np.array(
+            [np.array(face.hash.split(","), dtype=np.float32) for face in faces]
+        )
+        update = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.clusterer.add_faces, data.jobId, encodings
+        )
+        for evicted in update.evicted:
+            logger.info(f"dropped face clusters for job {evicted.job_id}")
+            await self.sender.send_json_message(
+                queue_name=FACE_CLUSTERS_QUEUE,
+                message=FaceClustersEvicted(
+                    namespace=self.clusterer.namespace, next_id=evicted.next_id
+                ),
+                filepath="",
+                md5="",
+                job_id=evicted.job_id,
+                corr_id=corr_id,
+                jwe_token=jwe_token,
+            )
+        if update.merged:
+            logger.info(
+                f"refined face clusters for job {data.jobId}, merged {len(update.merged)}"
+            )
+        await self.sender.send_json_message(
+            queue_name=FACE_CLUSTERS_QUEUE,
+            message=FaceClusterAssignments(
+                clusters=update.labels, merged=update.merged
+            ),
+            filepath=data.filepath,
+            md5=data.md5,
+            job_id=data.jobId,
+            corr_id=corr_id,
+            jwe_token=jwe_token,
+        )
+
+    async def close(self):
+        """Flush the publishes in flight, then disconnect"""
+        if self._pending:
+            await asyncio.wait(self._pending)
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+        await self.sender.close()
@@ -0,0 +1,186 @@
+import math
+import os
+from typing import List, NamedTuple, Tuple
+import numpy as np
+import cv2
+import warnings
+
+# Suppress warning from face_recognition_models
+warnings.filterwarnings(
+    "ignore", category=UserWarning, module=r".*face_recognition_models.*"
+)
+
+import face_recognition  # noqa: E402
+from service_python_shared.lib.decoding import (  # noqa: E402
+    PixelView,
+    decode_image,
+    pixel_view,
+)
+from service_python_shared.lib.image_header import sniff_image_header  # noqa: E402
+from service_python_shared.lib.utils import parse_int  # noqa: E402
+from modules.face_detectors import FaceDetector, FaceLocation  # noqa: E402
+
+# images with at least this many pixels are searched a tile at a time, 0 never
+FACE_TILE_MIN_PIXELS = parse_int(os.environ.get("FACE_TILE_MIN_PIXELS"), 40000000)
+FACE_TILE_SIZE = parse_int(os.environ.get("FACE_TILE_SIZE"), 2048)
+# faces up to this size are found whole in at least one tile
+FACE_TILE_OVERLAP = parse_int(os.environ.get("FACE_TILE_OVERLAP"), 256)
+# largest image searched, in place of IMAGE_MAX_PIXELS, so large scans are tiled
+# rather than rejected. Formats other than uncompressed BMP and TIFF are decoded
+# whole, at 3 bytes a pixel, 0 for no limit
+FACE_MAX_PIXELS = parse_int(os.environ.get("FACE_MAX_PIXELS"), 600000000)
+
+# share of the smaller of two boxes that must overlap for them to be one face
+MERGE_OVERLAP = 0.5
+# context kept around a face when encoding it, as a share of its size
+ENCODING_MARGIN = 0.5
+
+Region = Tuple[int, int, int, int]
+
+
+class Detection(NamedTuple):
+    location: FaceLocation
+    # boxes further from a tile seam are more likely to be the whole face
+    priority: float
+
+
+def should_tile(image_data: bytes, min_pixels: int = FACE_TILE_MIN_PIXELS) -> bool:
+    if min_pixels <= 0:
+        return False
+    try:
+        header = sniff_image_header(image_data)
+    except ValueError:
+        return False
+    return bool(header and header.pixels and header.pixels >= min_pixels)
+
+
+def tile_starts(length: int, tile_size: int, overlap: int) -> List[int]:
+    """start of each tile along one side, the last one ending at the image edge"""
+    if length <= tile_size:
+        return [0]
+    step = tile_size - overlap
+    return [*range(0, length - tile_size, step), length - tile_size]
+
+
+def seam_margin(location: FaceLocation, tile: Region, width: int, height: int) -> float:
+    """distance from a box to the nearest edge of its tile that is not an image edge"""
+    top, right, bottom, left = location
+    tile_left, tile_top, tile_right, tile_bottom = tile
+    margins = []
+    if tile_left > 0:
+        margins.append(left - tile_left)
+    if tile_top > 0:
+        margins.append(top - tile_top)
+    if tile_right < width:
+        margins.append(tile_right - right)
+    if tile_bottom < height:
+        margins.append(tile_bottom - bottom)
+    return min(margins, default=math.inf)
+
+
+def overlap(a: FaceLocation, b: FaceLocation) -> float:
+    """intersection of two boxes as a share of the smaller one"""
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    if right <= left or bottom <= top:
+        return 0.0
+    smaller = min((a[1] - a[3]) * (a[2] - a[0]), (b[1] - b[3]) * (b[2] - b[0]))
+    return (right - left) * (bottom - top) / smaller
+
+
+def merge_detections(
+    detections: List[Detection], threshold: float = MERGE_OVERLAP
+) -> List[FaceLocation]:
+    """non-maximum suppression, of overlapping boxes the highest priority is kept"""
+    kept: List[FaceLocation] = []
+    for detection in sorted(detections, key=lambda d: d.priority, reverse=True):
+        if all(overlap(detection.location, k) <= threshold for k in kept):
+            kept.append(detection.location)
+    # top to bottom, left to right
+    return sorted(kept, key=lambda location: (location[0], location[3]))
+
+
+def overview(regions: PixelView, size: int) -> Tuple[np.ndarray, float]:
+    """the whole image scaled down to fit size, built a block at a time"""
+    width, height = regions.width, regions.height
+    scale = size / max(width, height)
+    canvas = np.empty((round(height * scale), round(width * scale), 3), np.uint8)
+    for top in range(0, height, size):
+        for left in range(0, width, size):
+            right, bottom = min(left + size, width), min(top + size, height)
+            x0, y0 = round(left * scale), round(top * scale)
+            x1, y1 = round(right * scale), round(bottom * scale)
+            if x1 > x0 and y1 > y0:
+                block = regions.region(left, top, right, bottom)
+                canvas[y0:y1, x0:x1] = cv2.resize(
+                    block, (x1 - x0, y1 - y0), interpolation=cv2.INTER_AREA
+                )
+    return canvas, scale
+
+
+def locate(detector: FaceDetector, image_bgr: np.ndarray) -> List[FaceLocation]:
+    image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+    return detector.face_locations(image_rgb, image_bgr)
+
+
+def detect_faces_tiled(
+    image_data: bytes,
+    detector: FaceDetector,
+    tile_size: int = FACE_TILE_SIZE,
+    tile_overlap: int = FACE_TILE_OVERLAP,
+) -> List[Tuple[FaceLocation, np.ndarray]]:
+    """
+    Locate and encode faces in overlapping tiles. Uncompressed BMP and strip TIFF
+    are read a tile at a time from the image data, so only a few tiles are held in
+    memory beyond the file. Anything else, ie. JPEG, PNG and WebP, is decoded whole
+    first and the tiles are taken from that. Boxes found twice across a seam are
+    merged, and faces too big for the overlap are found on a scaled down copy of
+    the whole image. Locations are in full image coordinates.
+    """
+    if detector.max_size:
+        # tiles are not scaled down, or small faces would be lost again
+        tile_size = min(tile_size, detector.max_size)
+    regions = pixel_view(image_data) or PixelView(decode_image(image_data), "bgr")
+    width, height = regions.width, regions.height
+
+    detections: List[Detection] = []
+    for tile_top in tile_starts(height, tile_size, tile_overlap):
+        for tile_left in tile_starts(width, tile_size, tile_overlap):
+            tile = (
+                tile_left,
+                tile_top,
+                min(tile_left + tile_size, width),
+                min(tile_top + tile_size, height),
+            )
+            for top, right, bottom, left in locate(detector, regions.region(*tile)):
+                location = (
+                    top + tile_top,
+                    right + tile_left,
+                    bottom + tile_top,
+                    left + tile_left,
+                )
+                priority = seam_margin(location, tile, width, height)
+                detections.append(Detection(location, priority))
+
+    if max(width, height) > tile_size:
+        small, scale = overview(regions, tile_size)
+        for box in locate(detector, small):
+            top, right, bottom, left = (round(v / scale) for v in box)
+            location = (top, min(right, width), min(bottom, height), left)
+            if min(bottom - top, right - left) >= tile_overlap:
+                # beats boxes cut by a seam, but not a face found whole in a tile
+                detections.append(Detection(location, tile_overlap / 4))
+
+    faces: List[Tuple[FaceLocation, np.ndarray]] = []
+    for location in merge_detections(detections):
+        top, right, bottom, left = location
+        margin = int(ENCODING_MARGIN * max(bottom - top, right - left))
+        x0, y0 = max(left - margin, 0), max(top - margin, 0)
+        x1, y1 = min(right + margin, width), min(bottom + margin, height)
+        crop_rgb = cv2.cvtColor(regions.region(x0, y0, x1, y1), cv2.COLOR_BGR2RGB)
+        (encoding,) = face_recognition.face_encodings(
+            crop_rgb,
+            known_face_locations=[(top - y0, right - x0, bottom - y0, left - x0)],
+        )
+        faces.append((location, encoding))
+    return faces
@@ -1,17 +1,43 @@
-import asyncio
+import sys
+from service_python_shared.configs.config import config
 from service_python_shared.modules.logger import setup_logging, get_logger
+from service_python_shared.modules.Supervisor import run_service
 from service_python_shared.modules.Workflow import Workflow
 from modules.detect_faces import detect_faces
+from modules.face_detectors import get_detector
+from modules.publish_clusters import FACE_CLUSTERING, FaceClusterPublisher
+from modules.tiled_detection import FACE_MAX_PIXELS
 
 
-async def main():
+def make_workflow() -> Workflow:
+    cluster_publisher = FaceClusterPublisher() if FACE_CLUSTERING else None
+    return Workflow(
+        description="extract faces",
+        extract_data=detect_faces,
+        on_data_extracted=cluster_publisher.publish if cluster_publisher else None,
+        max_pixels=FACE_MAX_PIXELS,
+        on_close=cluster_publisher.close if cluster_publisher else None,
+    )
+
+
+def main() -> int:
     setup_logging()
     logger = get_logger("main")
     logger.info("launching service...")
-    workflow = Workflow(description="extract faces", extract_data=detect_faces)
-    await workflow.start_receiving_messages()
+    if FACE_CLUSTERING and config["supervisor"]["workers"] > 1:
+        logger.warning("face clusters are kept per worker, each clusters its own faces")
+    # created before any message, so a missing model or an unknown FACE_DETECTOR
+    # stops the service instead of failing every message
+    try:
+        detector = get_detector()
+    except (RuntimeError, ValueError) as e:
+        logger.error(f"face detector could not be created: {e}")
+        return 1
+    logger.info(f"detecting faces with {detector.name}")
+    # dlib's models were loaded by importing face_recognition, workers share them
+    return run_service(make_workflow)
 
 
 if __name__ == "__main__":
     print("service running...")
-    asyncio.run(main())
+    sys.exit(main())
@@ -0,0 +1,194 @@
+import asyncio
+import time
+import numpy as np
+import pytest
+from modules.face_clustering import FaceClusterer, JobFaceClusters, chinese_whispers
+from modules.publish_clusters import FaceClusterPublisher
+
+IDENTITIES = 6
+FACES_PER_IDENTITY = 40
+
+
+def make_faces(spread: float, seed: int = 1):
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(IDENTITIES, 128))
+    centres /= np.linalg.norm(centres, axis=1, keepdims=True)
+    identity = np.repeat(np.arange(IDENTITIES), FACES_PER_IDENTITY)
+    rng.shuffle(identity)
+    noise = rng.normal(scale=spread / np.sqrt(128), size=(len(identity), 128))
+    return centres[identity] + noise, identity
+
+
+def assert_same_grouping(labels: np.ndarray, identity: np.ndarray):
+    for person in range(IDENTITIES):
+        assert len(np.unique(labels[identity == person])) == 1
+    assert len(np.unique(labels)) == IDENTITIES
+
+
+def test_faces_of_same_person_share_a_cluster():
+    encodings, identity = make_faces(spread=0.2)
+    clusters = JobFaceClusters(threshold=0.5, merge_threshold=0.4)
+    labels = np.concatenate(
+        [clusters.add(encodings[i : i + 3]) for i in range(0, len(encodings), 3)]
+    )
+    assert_same_grouping(labels, identity)
+    assert np.array_equal(clusters.labels, labels)
+    assert clusters.cluster_count == IDENTITIES
+
+
+def test_refine_merges_split_clusters():
+    encodings, identity = make_faces(spread=0.25)
+    # a tight leader threshold splits each identity across several clusters
+    clusters = JobFaceClusters(threshold=0.25, merge_threshold=0.45)
+    for encoding in encodings:
+        clusters.add(encoding)
+    assert clusters.cluster_count > IDENTITIES
+
+    merged = clusters.refine()
+    assert merged
+    assert all(new < old for old, new in merged.items())
+    assert_same_grouping(clusters.labels, identity)
+
+
+def test_chinese_whispers_settles_on_the_heavier_label():
+    # two nodes joined both ways, and a third on its own
+    indptr = np.array([0, 1, 2, 2])
+    indices = np.array([1, 0])
+    weights = np.array([1.0, 3.0])
+    labels = chinese_whispers(indptr, indices, weights, np.array([3.0, 1.0, 1.0]))
+    assert labels.tolist() == [0, 0, 2]
+
+
+def test_faces_join_merged_clusters_after_refine():
+    encodings, identity = make_faces(spread=0.25)
+    clusters = JobFaceClusters(threshold=0.25, merge_threshold=0.45)
+    half = len(encodings) // 2
+    clusters.add(encodings[:half])
+    merged = clusters.refine()
+    assert merged
+    # nothing has changed since, so there is nothing to compare
+    assert clusters.refine() == {}
+
+    labels = clusters.add(encodings[half:])
+    assert not set(labels.tolist()) & set(merged)
+    clusters.refine()
+    assert_same_grouping(clusters.labels, identity)
+    assert clusters.cluster_count == IDENTITIES
+
+
+def test_clusterer_keeps_jobs_apart_and_reports_merges():
+    encodings, _ = make_faces(spread=0.25)
+    clusterer = FaceClusterer(
+        threshold=0.25, merge_threshold=0.45, refine_every=len(encodings), max_jobs=1
+    )
+    updates = [clusterer.add_faces("job-1", encoding) for encoding in encodings]
+    assert all(not update.merged for update in updates[:-1])
+    assert updates[-1].merged
+
+    clusterer.add_faces("job-2", encodings[:1])
+    assert list(clusterer.jobs) == ["job-2"]
+
+
+def test_cluster_ids_stay_unique_after_eviction():
+    encodings, identity = make_faces(spread=0.2)
+    first, second = encodings[identity == 0][0], encodings[identity == 1][0]
+    clusterer = FaceClusterer(max_jobs=1, namespace="replica/a")
+
+    (id_a,) = clusterer.add_faces("job-1", first).labels
+    update = clusterer.add_faces("job-2", first)
+    assert [(e.job_id, e.next_id) for e in update.evicted] == [("job-1", 1)]
+
+    # the job is seen again, a new person does not reuse an earlier id
+    update = clusterer.add_faces("job-1", second)
+    assert update.evicted[0].job_id == "job-2"
+    (id_b,) = update.labels
+    assert (id_a, id_b) == ("replica/a:0", "replica/a:1")
+
+    # another worker's ids for the same job never collide
+    other = FaceClusterer(namespace="replica/b")
+    assert other.add_faces("job-1", first).labels == ["replica/b:0"]
+
+
+class FakeSender:
+    def __init__(self):
+        self.messages = []
+
+    async def send_json_message(self, **kwargs):
+        self.messages.append(kwargs["message"])
+
+    async def close(self):
+        pass
+
+
+class Message:
+    jobId = "job"
+    filepath = "image.jpg"
+    md5 = "md5"
+
+
+class Face:
+    def __init__(self, encoding: np.ndarray):
+        self.hash = ",".join(f"{x:.8f}" for x in encoding)
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(120)
+async def test_refining_a_large_job_does_not_block_the_event_loop():
+    # hundreds of thousands of faces of a few thousand people
+    rng = np.random.default_rng(0)
+    people, faces = 5000, 200_000
+    centres = rng.normal(size=(people, 128)).astype(np.float32)
+    centres /= np.linalg.norm(centres, axis=1, keepdims=True)
+    noise = rng.normal(scale=0.3 / np.sqrt(128), size=(faces, 128))
+    encodings = centres[rng.integers(0, people, faces)] + noise.astype(np.float32)
+
+    clusterer = FaceClusterer(refine_every=faces, namespace="n")
+    for start in range(0, faces - 5, 5000):
+        clusterer.add_faces("job", encodings[start : min(start + 5000, faces - 5)])
+    publisher = FaceClusterPublisher(clusterer)
+    publisher.sender = FakeSender()
+
+    gaps = []
+
+    async def tick():
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(0.01)
+            now = time.monotonic()
+            gaps.append(now - last)
+            last = now
+
+    ticker = asyncio.create_task(tick())
+    started = time.monotonic()
+    # the last faces take the job to refine_every
+    await publisher.publish(
+        Message(), [Face(e) for e in encodings[-5:]], corr_id="", jwe_token=""
+    )
+    refine_time = time.monotonic() - started
+    ticker.cancel()
+    await publisher.close()
+
+    (message,) = publisher.sender.messages
+    assert len(message.clusters) == 5 and message.merged
+    assert clusterer.jobs["job"].cluster_count == people
+    assert refine_time > 0.1
+    assert max(gaps) < 0.1
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(10)
+async def test_close_publishes_what_is_in_flight():
+    publisher = FaceClusterPublisher(FaceClusterer(namespace="n"))
+    publisher.sender = FakeSender()
+    face = Face(np.ones(128, dtype=np.float32) / np.sqrt(128))
+    publishing = asyncio.create_task(
+        publisher.publish(Message(), [face], corr_id="", jwe_token="")
+    )
+    await asyncio.sleep(0)
+    # the message is dropped while its faces are being clustered
+    publishing.cancel()
+
+    await publisher.close()
+
+    (message,) = publisher.sender.messages
+    assert message.clusters == ["n:0"]
@@ -0,0 +1,60 @@
+from pathlib import Path
+import cv2
+import pytest
+from modules.detect_faces import detect_faces
+from modules.face_detectors import (
+    FACE_DETECTOR_YUNET_MODEL,
+    HogFaceDetector,
+    YuNetFaceDetector,
+    create_detector,
+)
+
+FIXTURE_DIR = Path(__file__).parent / "fixtures"
+
+
+def test_create_detector_by_name():
+    assert isinstance(create_detector("HOG"), HogFaceDetector)
+    with pytest.raises(ValueError):
+        create_detector("not-a-detector")
+
+
+def test_yunet_fails_on_creation_without_a_usable_model(tmp_path):
+    with pytest.raises(RuntimeError, match="not found"):
+        YuNetFaceDetector(model_path=str(tmp_path / "missing.onnx"))
+    broken = tmp_path / "broken.onnx"
+    broken.write_bytes(b"not a model")
+    with pytest.raises(RuntimeError, match="can't be loaded"):
+        YuNetFaceDetector(model_path=str(broken))
+
+
+@pytest.mark.skipif(
+    not Path(FACE_DETECTOR_YUNET_MODEL).is_file(),
+    reason="YuNet model not downloaded, run download_models.py",
+)
+def test_yunet_detector_finds_faces():
+    faces = detect_faces(
+        (FIXTURE_DIR / "faces.jpg").read_bytes(), detector=YuNetFaceDetector()
+    )
+    assert faces, "faces.jpg should have faces"
+    for face in faces:
+        assert face.width > 0 and face.height > 0
+        assert len(face.hash.split(",")) == 128
+
+
+@pytest.mark.skipif(
+    not Path(FACE_DETECTOR_YUNET_MODEL).is_file(),
+    reason="YuNet model not downloaded, run download_models.py",
+)
+def test_yunet_boxes_are_scaled_back_to_the_image():
+    image_bgr = cv2.imread(str(FIXTURE_DIR / "faces.jpg"))
+    image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+    full = YuNetFaceDetector(max_size=0).face_locations(image_rgb, image_bgr)
+    scaled = YuNetFaceDetector(max_size=640).face_locations(image_rgb, image_bgr)
+
+    assert len(scaled) == len(full)
+    for top, right, bottom, left in scaled:
+        # the same face within a few pixels of the full size search
+        assert any(
+            max(abs(top - t), abs(right - r), abs(bottom - b), abs(left - x)) < 12
+            for t, r, b, x in full
+        )
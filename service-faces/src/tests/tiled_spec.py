@@ -0,0 +1,87 @@
+from pathlib import Path
+import cv2
+import face_recognition
+import numpy as np
+import pytest
+
+from modules.detect_faces import detect_faces_whole
+from modules.face_detectors import get_detector
+from modules.tiled_detection import (
+    Detection,
+    detect_faces_tiled,
+    merge_detections,
+    overlap,
+    should_tile,
+    tile_starts,
+)
+
+FIXTURE_DIR = Path(__file__).parent / "fixtures"
+
+
+def large_image(extension: str) -> bytes:
+    """faces.jpg in the middle of a larger canvas, so tiles cut through faces"""
+    faces = cv2.imread(str(FIXTURE_DIR / "faces.jpg"))
+    canvas = np.full((1350, 1800, 3), 127, np.uint8)
+    canvas[225:1125, 300:1500] = faces
+    ok, encoded = cv2.imencode(extension, canvas)
+    assert ok
+    return encoded.tobytes()
+
+
+def iou(a, b) -> float:
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    intersection = max(right - left, 0) * max(bottom - top, 0)
+    union = (a[1] - a[3]) * (a[2] - a[0]) + (b[1] - b[3]) * (b[2] - b[0])
+    return intersection / (union - intersection)
+
+
+def test_tile_starts_cover_the_image():
+    assert tile_starts(500, 600, 200) == [0]
+    assert tile_starts(1800, 600, 200) == [0, 400, 800, 1200]
+    assert tile_starts(1700, 600, 200) == [0, 400, 800, 1100]
+
+
+def test_merge_keeps_the_box_furthest_from_a_seam():
+    whole = (100, 200, 200, 100)
+    cut = (100, 160, 200, 100)
+    elsewhere = (400, 500, 500, 400)
+    merged = merge_detections(
+        [Detection(cut, 2), Detection(whole, 50), Detection(elsewhere, 0)]
+    )
+    assert merged == [whole, elsewhere]
+    assert overlap(cut, whole) == 1.0
+
+
+def test_should_tile_by_pixel_count():
+    data = large_image(".png")
+    assert should_tile(data, min_pixels=1800 * 1350)
+    assert not should_tile(data, min_pixels=1800 * 1350 + 1)
+    assert not should_tile(data, min_pixels=0)
+
+
+@pytest.mark.parametrize(
+    "extension,tile_overlap",
+    [
+        # read a tile at a time from the pixels in the file
+        (".bmp", 200),
+        # decoded once, faces larger than the overlap found on the overview
+        (".png", 100),
+    ],
+)
+def test_tiled_detection_matches_whole_image(extension, tile_overlap):
+    data = large_image(extension)
+    detector = get_detector()
+    whole = detect_faces_whole(data, detector)
+    tiled = detect_faces_tiled(data, detector, tile_size=600, tile_overlap=tile_overlap)
+
+    assert len(whole) == 8
+    assert len(tiled) == len(whole)
+    for location, encoding in whole:
+        match_location, match_encoding = max(
+            tiled, key=lambda face: iou(face[0], location)
+        )
+        assert iou(match_location, location) > 0.5
+        assert face_recognition.compare_faces(
+            [encoding], match_encoding, tolerance=0.6
+        )[0]
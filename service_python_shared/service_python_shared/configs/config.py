@@ -1,6 +1,11 @@
 import os
-from typing import TypedDict
-from service_python_shared.lib.utils import parse_int
+from typing import List, TypedDict
+from service_python_shared.lib.utils import (
+    parse_bool,
+    parse_float,
+    parse_int,
+    parse_list,
+)
 
 
 class RabbitMqConnectionSettings(TypedDict):
@@ -16,6 +21,10 @@ class RabbitMqSettings(TypedDict):
     service_queue_name: str
     job_manager_queue_name: str
     prefetchLimit: int
+    sharding: bool
+    replica_id: str
+    shard_weight: int
+    shard_reap_interval_s: int
 
 
 class LoggerSettings(TypedDict):
@@ -33,10 +42,54 @@ class GrpcSettings(TypedDict):
     job_manager_port: int
 
 
+class ImagePolicySettings(TypedDict):
+    enabled: bool
+    sniff_bytes: int
+    min_width: int
+    min_height: int
+    max_pixels: int
+    allowed_formats: List[str]
+
+
+class ProfilerSettings(TypedDict):
+    output_dir: str
+    mode: str
+    sample_rate: float
+    sample_interval_ms: int
+    allow_header: bool
+    signal_count: int
+
+
+class TrafficSettings(TypedDict):
+    record_dir: str
+    record_sample_rate: float
+    record_max_messages: int
+
+
+class AdmissionSettings(TypedDict):
+    memory_budget_mb: int
+    bytes_per_pixel: int
+    unknown_estimate_mb: int
+    log_every: int
+    extract_threads: int
+
+
+class SupervisorSettings(TypedDict):
+    workers: int
+    drain_timeout_s: float
+    stats_interval_s: float
+    restart_backoff_max_s: float
+
+
 class Config(TypedDict):
     rabbitmq: RabbitMqSettings
     logger: LoggerSettings
     grpc: GrpcSettings
+    image_policy: ImagePolicySettings
+    profiler: ProfilerSettings
+    traffic: TrafficSettings
+    admission: AdmissionSettings
+    supervisor: SupervisorSettings
 
 
 default_format = "<green>[{time}]</green> <level>[{level}]</level> <blue>[{extra[id]}]</blue> <blue>[{extra[corr_id]}]</blue> {message}"
@@ -57,6 +110,15 @@ config: Config = {
             "RABBIT_MQ_JOB_MANAGER_QUEUE_NAME", "JobManager"
         ),
         "prefetchLimit": parse_int(os.environ.get("RABBIT_MQ_PREFETCH_LIMIT", "8"), 10),
+        # Route messages to replicas by a consistent hash of md5, so duplicates of a file
+        # are handled by the same replica. Needs the rabbitmq_consistent_hash_exchange plugin
+        "sharding": parse_bool(os.environ.get("RABBIT_MQ_SHARDING", "false"), False),
+        # must be set when sharding, and stable across restarts of the same replica
+        "replica_id": os.environ.get("RABBIT_MQ_REPLICA_ID", ""),
+        "shard_weight": parse_int(os.environ.get("RABBIT_MQ_SHARD_WEIGHT", "1"), 1),
+        "shard_reap_interval_s": parse_int(
+            os.environ.get("RABBIT_MQ_SHARD_REAP_INTERVAL_S", "30"), 30
+        ),
     },
     "logger": {
         "combined_log": os.environ.get(
@@ -78,4 +140,75 @@ config: Config = {
             os.environ.get("GRPC_JOB_MANAGER_PORT", "5042"), 5042
         ),
     },
+    # Early inspection of the first streamed chunks of an image, so junk can be
+    # rejected and the gRPC stream cancelled before the whole file is downloaded
+    "image_policy": {
+        "enabled": parse_bool(os.environ.get("IMAGE_POLICY_ENABLED", "true"), True),
+        "sniff_bytes": parse_int(os.environ.get("IMAGE_SNIFF_BYTES", "262144"), 262144),
+        "min_width": parse_int(os.environ.get("IMAGE_MIN_WIDTH", "16"), 16),
+        "min_height": parse_int(os.environ.get("IMAGE_MIN_HEIGHT", "16"), 16),
+        "max_pixels": parse_int(
+            os.environ.get("IMAGE_MAX_PIXELS", "178956970"), 178956970
+        ),
+        # empty allows any format but HEIF/AVIF, leaving it to the service's decoder
+        "allowed_formats": parse_list(os.environ.get("IMAGE_ALLOWED_FORMATS"), []),
+    },
+    # On demand profiling of single messages, keyed by correlation id. Triggered by an
+    # x-profile message header, a random sample of messages, or SIGUSR2
+    "profiler": {
+        "output_dir": os.environ.get("PROFILE_DIR", "../profiles"),
+        # cprofile (deterministic, .pstats) or sampling (collapsed stacks)
+        "mode": os.environ.get("PROFILE_MODE", "cprofile"),
+        "sample_rate": parse_float(os.environ.get("PROFILE_SAMPLE_RATE", "0"), 0.0),
+        "sample_interval_ms": parse_int(
+            os.environ.get("PROFILE_SAMPLE_INTERVAL_MS", "5"), 5
+        ),
+        "allow_header": parse_bool(
+            os.environ.get("PROFILE_ALLOW_HEADER", "true"), True
+        ),
+        "signal_count": parse_int(os.environ.get("PROFILE_SIGNAL_COUNT", "10"), 10),
+    },
+    # Recording of live messages and image data for offline replay, off unless a
+    # directory is given
+    "traffic": {
+        "record_dir": os.environ.get("TRAFFIC_RECORD_DIR", ""),
+        "record_sample_rate": parse_float(
+            os.environ.get("TRAFFIC_RECORD_SAMPLE_RATE", "1"), 1.0
+        ),
+        "record_max_messages": parse_int(
+            os.environ.get("TRAFFIC_RECORD_MAX_MESSAGES", "10000"), 10000
+        ),
+    },
+    # Bounds the decoded image memory of messages in flight. Images wait, mid stream,
+    # until their estimated memory fits in the budget. 0 disables
+    "admission": {
+        "memory_budget_mb": parse_int(
+            os.environ.get("ADMISSION_MEMORY_BUDGET_MB", "1024"), 1024
+        ),
+        # decoded copies held while extracting, ie. BGR + RGB + working buffers
+        "bytes_per_pixel": parse_int(
+            os.environ.get("ADMISSION_BYTES_PER_PIXEL", "12"), 12
+        ),
+        # used when the dimensions can not be read from the header
+        "unknown_estimate_mb": parse_int(
+            os.environ.get("ADMISSION_UNKNOWN_ESTIMATE_MB", "64"), 64
+        ),
+        "log_every": parse_int(os.environ.get("ADMISSION_LOG_EVERY", "100"), 100),
+        # images extracted at the same time, off the event loop, within the budget
+        "extract_threads": parse_int(os.environ.get("EXTRACT_THREADS", "1"), 1),
+    },
+    # Worker processes forked from one process after the model is loaded, so they
+    # share its memory. 1 runs the service in a single process as before
+    "supervisor": {
+        "workers": parse_int(os.environ.get("SUPERVISOR_WORKERS", "1"), 1),
+        "drain_timeout_s": parse_float(
+            os.environ.get("SUPERVISOR_DRAIN_TIMEOUT_S", "60"), 60.0
+        ),
+        "stats_interval_s": parse_float(
+            os.environ.get("SUPERVISOR_STATS_INTERVAL_S", "60"), 60.0
+        ),
+        "restart_backoff_max_s": parse_float(
+            os.environ.get("SUPERVISOR_RESTART_BACKOFF_MAX_S", "30"), 30.0
+        ),
+    },
 }
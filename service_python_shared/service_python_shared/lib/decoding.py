@@ -0,0 +1,482 @@
+import math
+import struct
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import cv2
+import numpy as np
+from pydantic import BaseModel
+
+from service_python_shared.lib.image_header import (
+    FORMAT_SIGNATURE_BYTES,
+    detect_format,
+    sniff_image_header,
+)
+
+# libjpeg decodes JPEGs at 1/2, 1/4 and 1/8 scale for little more than the cost
+# of reading the compressed data
+JPEG_SCALES = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# largest image decoded in pixels, 0 for no limit. OpenCV reads its own limit only
+# when it is loaded, so images are checked against this before decoding
+MAX_IMAGE_PIXELS = 0
+
+# bytes read to find the frame header of an embedded JPEG
+EMBEDDED_HEADER_BYTES = 65536
+# IFDs visited in one file, guards against loops and absurd files
+MAX_IFDS = 32
+
+# strips listed by a large uncompressed TIFF, one per row is common
+MAX_STRIPS = 1 << 20
+
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 13: 4}
+TAG_IMAGE_WIDTH = 0x0100
+TAG_IMAGE_LENGTH = 0x0101
+TAG_BITS_PER_SAMPLE = 0x0102
+TAG_COMPRESSION = 0x0103
+TAG_PHOTOMETRIC = 0x0106
+TAG_STRIP_OFFSETS = 0x0111
+TAG_ORIENTATION = 0x0112
+TAG_SAMPLES_PER_PIXEL = 0x0115
+TAG_ROWS_PER_STRIP = 0x0116
+TAG_STRIP_BYTE_COUNTS = 0x0117
+TAG_PLANAR_CONFIGURATION = 0x011C
+TAG_SUB_IFDS = 0x014A
+TAG_JPEG_OFFSET = 0x0201
+TAG_JPEG_LENGTH = 0x0202
+TAG_MP_ENTRY = 0xB002
+TIFF_JPEG_COMPRESSION = {6, 7}
+
+
+class ImageSource(BaseModel):
+    """
+    Something in an image file that can be decoded to a picture of it: the
+    primary image, or an embedded preview or EXIF thumbnail, at a JPEG scale.
+    """
+
+    kind: str
+    format: str
+    offset: int
+    length: int
+    width: Optional[int] = None
+    height: Optional[int] = None
+    scale: int = 1
+    # EXIF orientation applied after decoding, the decoder handles the primary's
+    orientation: int = 1
+
+    @property
+    def long_edge(self) -> Optional[int]:
+        if self.width is None or self.height is None:
+            return None
+        return math.ceil(max(self.width, self.height) / self.scale)
+
+    @property
+    def pixels(self) -> Optional[int]:
+        """pixels in the decoded image"""
+        if self.width is None or self.height is None:
+            return None
+        return math.ceil(self.width / self.scale) * math.ceil(self.height / self.scale)
+
+    @property
+    def cost(self) -> int:
+        """rough decoding cost, the compressed bytes read and the pixels produced"""
+        return self.length + self.pixels
+
+
+class _TiffReader:
+    """Reads integer tags from the IFDs of a TIFF structure starting at start"""
+
+    def __init__(self, data: bytes, start: int):
+        self.data = data
+        self.start = start
+        byte_order = data[start : start + 2]
+        if byte_order == b"II":
+            self.endian = "<"
+        elif byte_order == b"MM":
+            self.endian = ">"
+        else:
+            raise ValueError("not a TIFF structure")
+
+    def first_ifd(self) -> int:
+        return self._unpack("I", self.start + 4)[0]
+
+    def _unpack(self, fmt: str, offset: int) -> Tuple:
+        return struct.unpack_from(self.endian + fmt, self.data, offset)
+
+    def read_ifd(
+        self, offset: int, max_values: int = 64
+    ) -> Tuple[Dict[int, object], int]:
+        """tags of the IFD at offset, integers as lists and MP entries as bytes"""
+        position = self.start + offset
+        (count,) = self._unpack("H", position)
+        tags: Dict[int, object] = {}
+        for entry in range(position + 2, position + 2 + count * 12, 12):
+            tag, field_type, values = self._unpack("HHI", entry)
+            size = TIFF_TYPE_SIZES.get(field_type, 0) * values
+            value_offset = entry + 8
+            if size > 4:
+                value_offset = self.start + self._unpack("I", entry + 8)[0]
+            if tag == TAG_MP_ENTRY:
+                tags[tag] = self.data[value_offset : value_offset + size]
+            elif field_type in (3, 4, 13) and values <= max_values:
+                fmt = ("H" if field_type == 3 else "I") * values
+                tags[tag] = list(self._unpack(fmt, value_offset))
+        (next_ifd,) = self._unpack("I", position + 2 + count * 12)
+        return tags, next_ifd
+
+    def ifds(self) -> Iterator[Dict[int, object]]:
+        """every IFD in the chain from the first, and their sub-IFDs"""
+        pending = [self.first_ifd()]
+        seen = set()
+        while pending and len(seen) < MAX_IFDS:
+            offset = pending.pop(0)
+            if offset == 0 or offset in seen:
+                continue
+            seen.add(offset)
+            tags, next_ifd = self.read_ifd(offset)
+            yield tags
+            pending.append(next_ifd)
+            pending.extend(tags.get(TAG_SUB_IFDS, []))
+
+
+def _embedded_jpeg(
+    data: bytes, offset: int, length: int, kind: str, orientation: int
+) -> Optional[ImageSource]:
+    if length <= 0 or offset + length > len(data):
+        return None
+    if data[offset : offset + 3] != b"\xff\xd8\xff":
+        return None
+    try:
+        header = sniff_image_header(
+            data[offset : offset + min(length, EMBEDDED_HEADER_BYTES)]
+        )
+    except ValueError:
+        return None
+    if header is None or header.width is None:
+        return None
+    return ImageSource(
+        kind=kind,
+        format="jpeg",
+        offset=offset,
+        length=length,
+        width=header.width,
+        height=header.height,
+        orientation=orientation,
+    )
+
+
+def _first(tags: Dict[int, object], tag: int, default: int = 0) -> int:
+    values = tags.get(tag)
+    return values[0] if values else default
+
+
+def _tiff_previews(
+    data: bytes, start: int, kind: str, orientation: Optional[int] = None
+) -> Tuple[List[ImageSource], int]:
+    """
+    JPEGs embedded in a TIFF structure, ie. camera RAW previews or the EXIF
+    thumbnail, with the orientation from its first IFD.
+    """
+    reader = _TiffReader(data, start)
+    sources: List[ImageSource] = []
+    for tags in reader.ifds():
+        if orientation is None:
+            orientation = _first(tags, TAG_ORIENTATION, 1)
+        if TAG_JPEG_OFFSET in tags and TAG_JPEG_LENGTH in tags:
+            offset = start + _first(tags, TAG_JPEG_OFFSET)
+            length = _first(tags, TAG_JPEG_LENGTH)
+        elif (
+            _first(tags, TAG_COMPRESSION) in TIFF_JPEG_COMPRESSION
+            and len(tags.get(TAG_STRIP_OFFSETS, [])) == 1
+        ):
+            offset = start + _first(tags, TAG_STRIP_OFFSETS)
+            length = _first(tags, TAG_STRIP_BYTE_COUNTS)
+        else:
+            continue
+        source = _embedded_jpeg(data, offset, length, kind, orientation)
+        if source:
+            sources.append(source)
+    return sources, orientation or 1
+
+
+def _mpf_previews(data: bytes, start: int, orientation: int) -> List[ImageSource]:
+    """the images after the primary in a JPEG's multi-picture format index"""
+    reader = _TiffReader(data, start)
+    tags, _ = reader.read_ifd(reader.first_ifd())
+    entries = tags.get(TAG_MP_ENTRY, b"")
+    sources: List[ImageSource] = []
+    # the first entry is the primary image
+    for entry in range(16, len(entries) - 15, 16):
+        _, length, offset = struct.unpack_from(reader.endian + "III", entries, entry)
+        source = _embedded_jpeg(data, start + offset, length, "preview", orientation)
+        if source:
+            sources.append(source)
+    return sources
+
+
+def _jpeg_previews(data: bytes) -> List[ImageSource]:
+    """EXIF thumbnail and multi-picture format previews from a JPEG's APP segments"""
+    sources: List[ImageSource] = []
+    orientation = 1
+    mpf_start = None
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF or data[offset + 1] in (0x00, 0xFF):
+            # extraneous or fill bytes before the next marker
+            offset += 1
+            continue
+        marker = data[offset + 1]
+        # APP segments come before the frame and scan headers
+        if marker == 0xDA or (0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xCC)):
+            break
+        (length,) = struct.unpack_from(">H", data, offset + 2)
+        segment = offset + 4
+        if marker == 0xE1 and data[segment : segment + 6] == b"Exif\x00\x00":
+            thumbnails, orientation = _tiff_previews(data, segment + 6, "thumbnail")
+            sources.extend(thumbnails)
+        elif marker == 0xE2 and data[segment : segment + 4] == b"MPF\x00":
+            mpf_start = segment + 4
+        offset += 2 + length
+    if mpf_start is not None:
+        sources.extend(_mpf_previews(data, mpf_start, orientation))
+    return sources
+
+
+def image_sources(data: bytes) -> List[ImageSource]:
+    """
+    The primary image, at every scale it can be decoded at, and any embedded
+    previews and thumbnails found in the file.
+    """
+    header = sniff_image_header(data)
+    image_format = header.format if header else "unknown"
+    primary = ImageSource(
+        kind="primary",
+        format=image_format,
+        offset=0,
+        length=len(data),
+        width=header.width if header else None,
+        height=header.height if header else None,
+    )
+    embedded: List[ImageSource] = []
+    try:
+        if image_format == "jpeg":
+            embedded = _jpeg_previews(data)
+        elif image_format == "tiff":
+            # camera RAW files are TIFF structures with JPEG previews
+            embedded, _ = _tiff_previews(data, 0, "preview")
+    except (struct.error, ValueError):
+        # a corrupt preview is no reason not to decode the primary image
+        pass
+
+    sources = [primary]
+    for source in [primary, *embedded]:
+        scales = JPEG_SCALES if source.format == "jpeg" and source.width else [1]
+        for scale in scales:
+            if source is not primary or scale > 1:
+                sources.append(source.model_copy(update={"scale": scale}))
+    return sources
+
+
+def choose_sources(sources: List[ImageSource], min_size: int = 0) -> List[ImageSource]:
+    """
+    Sources in the order to try them: those with a long edge of at least min_size
+    pixels, cheapest first, then the rest, largest first. min_size 0 asks for the
+    full resolution, that of the largest source, and nothing smaller is tried as
+    its coordinates would not match the original. The primary of a camera RAW file
+    may be a thumbnail, with a larger preview embedded.
+    """
+    sized = [s for s in sources if s.long_edge is not None]
+    unsized = [s for s in sources if s.long_edge is None]
+    if not min_size and sources[0].long_edge is None:
+        # nothing is known about the primary, any other source may be smaller
+        return sources[:1]
+    if not sized:
+        return unsized
+    largest = max(s.long_edge for s in sized)
+    if not min_size:
+        full = (s for s in sized if s.long_edge == largest)
+        return sorted(full, key=lambda s: s.cost)
+    target = min(min_size, largest)
+
+    good = sorted((s for s in sized if s.long_edge >= target), key=lambda s: s.cost)
+    rest = sorted((s for s in sized if s.long_edge < target), key=_largest_first)
+    return good + unsized + rest
+
+
+def _largest_first(source: ImageSource) -> int:
+    return -(source.long_edge or 0)
+
+
+# EXIF orientation to the rotation, then flip, that shows the image upright
+ORIENTATIONS = {
+    2: (None, 1),
+    3: (cv2.ROTATE_180, None),
+    4: (None, 0),
+    5: (cv2.ROTATE_90_CLOCKWISE, 1),
+    6: (cv2.ROTATE_90_CLOCKWISE, None),
+    7: (cv2.ROTATE_90_COUNTERCLOCKWISE, 1),
+    8: (cv2.ROTATE_90_COUNTERCLOCKWISE, None),
+}
+
+
+def apply_orientation(image: np.ndarray, orientation: int) -> np.ndarray:
+    rotation, flip = ORIENTATIONS.get(orientation, (None, None))
+    if rotation is not None:
+        image = cv2.rotate(image, rotation)
+    if flip is not None:
+        image = cv2.flip(image, flip)
+    return image
+
+
+def decode_source(data: bytes, source: ImageSource) -> Optional[np.ndarray]:
+    buffer = np.frombuffer(data, np.uint8, count=source.length, offset=source.offset)
+    if source.kind == "primary":
+        flags = JPEG_SCALES.get(source.scale, cv2.IMREAD_COLOR)
+        return cv2.imdecode(buffer, flags)
+    # embedded images take the orientation of the file they are in
+    flags = JPEG_SCALES.get(source.scale, cv2.IMREAD_COLOR)
+    image = cv2.imdecode(buffer, flags | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:
+        return None
+    return apply_orientation(image, source.orientation)
+
+
+def decode_image(data: bytes, min_size: int = 0) -> np.ndarray:
+    """
+    Decode an image to BGR from the cheapest source in the file with a long edge
+    of at least min_size pixels: a reduced scale JPEG decode, an embedded preview
+    or the EXIF thumbnail. min_size 0 decodes at full resolution or not at all.
+    Otherwise falls back to the next best source if one can't be decoded, ie. the
+    raw data of a camera RAW file. Sources over MAX_IMAGE_PIXELS are skipped.
+    Raises ValueError if nothing can be decoded.
+    """
+    too_large: Optional[int] = None
+    for source in choose_sources(image_sources(data), min_size):
+        if MAX_IMAGE_PIXELS and (source.pixels or 0) > MAX_IMAGE_PIXELS:
+            too_large = source.pixels
+            continue
+        image = decode_source(data, source)
+        if image is None:
+            continue
+        # a header that understates the size is only caught after decoding
+        pixels = image.shape[0] * image.shape[1]
+        if MAX_IMAGE_PIXELS and pixels > MAX_IMAGE_PIXELS:
+            too_large = pixels
+            continue
+        return image
+    if too_large:
+        raise ValueError(
+            f"image of {too_large} pixels is over the limit of {MAX_IMAGE_PIXELS}"
+        )
+    raise ValueError("image data could not be decoded")
+
+
+class PixelView(NamedTuple):
+    """Pixels of an uncompressed image, read from the image data as needed"""
+
+    pixels: np.ndarray
+    # "bgr", "rgb" or "gray"
+    channels: str
+
+    @property
+    def width(self) -> int:
+        return self.pixels.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.pixels.shape[0]
+
+    def region(self, left: int, top: int, right: int, bottom: int) -> np.ndarray:
+        """a BGR copy of part of the image"""
+        region = self.pixels[top:bottom, left:right]
+        if self.channels == "rgb":
+            region = region[:, :, ::-1]
+        elif self.channels == "gray":
+            region = np.repeat(region, 3, axis=2)
+        return np.ascontiguousarray(region)
+
+
+def _bmp_pixels(data: bytes) -> Optional[PixelView]:
+    (pixel_offset,) = struct.unpack_from("<I", data, 10)
+    dib_size, width, height, _, bits, compression = struct.unpack_from(
+        "<IiiHHI", data, 14
+    )
+    if dib_size < 40 or compression != 0 or bits not in (24, 32) or width <= 0:
+        return None
+    rows = abs(height)
+    pixel_bytes = bits // 8
+    # rows are padded to 4 bytes
+    stride = (width * bits + 31) // 32 * 4
+    if rows == 0 or pixel_offset + stride * rows > len(data):
+        return None
+    pixels = np.ndarray(
+        (rows, width, pixel_bytes),
+        np.uint8,
+        data,
+        pixel_offset,
+        (stride, pixel_bytes, 1),
+    )[:, :, :3]
+    # positive heights are stored bottom row first
+    return PixelView(pixels[::-1] if height > 0 else pixels, "bgr")
+
+
+def _tiff_pixels(data: bytes) -> Optional[PixelView]:
+    reader = _TiffReader(data, 0)
+    tags, _ = reader.read_ifd(reader.first_ifd(), max_values=MAX_STRIPS)
+    width = _first(tags, TAG_IMAGE_WIDTH)
+    height = _first(tags, TAG_IMAGE_LENGTH)
+    samples = _first(tags, TAG_SAMPLES_PER_PIXEL, 1)
+    photometric = _first(tags, TAG_PHOTOMETRIC, -1)
+    if (
+        _first(tags, TAG_COMPRESSION, 1) != 1
+        or _first(tags, TAG_PLANAR_CONFIGURATION, 1) != 1
+        or any(bits != 8 for bits in tags.get(TAG_BITS_PER_SAMPLE, [1]))
+        or width <= 0
+        or height <= 0
+    ):
+        return None
+    if photometric == 2 and samples >= 3:
+        channels = "rgb"
+    elif photometric == 1:
+        channels = "gray"
+    else:
+        return None
+
+    # only strips written one after another can be viewed as a single array
+    offsets = tags.get(TAG_STRIP_OFFSETS, [])
+    row_bytes = width * samples
+    strip_bytes = _first(tags, TAG_ROWS_PER_STRIP, height) * row_bytes
+    if not offsets or any(
+        offset != offsets[0] + strip * strip_bytes
+        for strip, offset in enumerate(offsets)
+    ):
+        return None
+    if offsets[0] + row_bytes * height > len(data):
+        return None
+    pixels = np.ndarray(
+        (height, width, samples), np.uint8, data, offsets[0], (row_bytes, samples, 1)
+    )
+    return PixelView(
+        pixels[:, :, :3] if channels == "rgb" else pixels[:, :, :1], channels
+    )
+
+
+def pixel_view(data: bytes) -> Optional[PixelView]:
+    """
+    A view of the pixels of an uncompressed BMP or strip TIFF, without decoding
+    or copying them, so regions of a very large image can be read on demand.
+    None for other formats, which have to be decoded whole.
+    """
+    image_format = detect_format(data[:FORMAT_SIGNATURE_BYTES])
+    try:
+        if image_format == "bmp":
+            return _bmp_pixels(data)
+        if image_format == "tiff":
+            return _tiff_pixels(data)
+    except (struct.error, ValueError):
+        pass
+    return None
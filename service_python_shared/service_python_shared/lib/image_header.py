@@ -0,0 +1,199 @@
+import struct
+from typing import Optional, Tuple
+
+from pydantic import BaseModel
+
+# enough bytes to recognise every supported signature
+FORMAT_SIGNATURE_BYTES = 12
+
+# JPEG start-of-frame markers carrying the image dimensions (excludes DHT, JPG and DAC)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7}
+JPEG_SOF_MARKERS |= {0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}
+
+HEIF_BRANDS = {b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1"}
+AVIF_BRANDS = {b"avif", b"avis"}
+
+
+class ImageHeader(BaseModel):
+    format: str
+    width: Optional[int] = None
+    height: Optional[int] = None
+
+    @property
+    def pixels(self) -> Optional[int]:
+        if self.width is None or self.height is None:
+            return None
+        return self.width * self.height
+
+
+def detect_format(data: bytes) -> Optional[str]:
+    """
+    Identify an image format from its magic bytes. Returns None when there are
+    not yet enough bytes to decide, and "unknown" when nothing matches.
+    """
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if data.startswith((b"GIF87a", b"GIF89a")):
+        return "gif"
+    if data.startswith(b"BM"):
+        return "bmp"
+    if data.startswith((b"II*\x00", b"MM\x00*")):
+        return "tiff"
+    if len(data) < FORMAT_SIGNATURE_BYTES:
+        return None
+    if data[0:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[4:8] == b"ftyp":
+        brand = data[8:12]
+        if brand in AVIF_BRANDS:
+            return "avif"
+        if brand in HEIF_BRANDS:
+            return "heif"
+    return "unknown"
+
+
+def _jpeg_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    offset = 2
+    while True:
+        # skip to the next marker, passing over extraneous bytes between segments as
+        # libjpeg does, and fill bytes before the marker
+        while offset < len(data) and data[offset] != 0xFF:
+            offset += 1
+        while offset < len(data) and data[offset] == 0xFF:
+            offset += 1
+        if offset >= len(data):
+            return None
+        marker = data[offset]
+        offset += 1
+        # 0xFF00 is not a marker, just more extraneous bytes
+        if marker == 0x00 or marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker in (0xD9, 0xDA):
+            raise ValueError("jpeg reached image data before a frame header")
+        if offset + 2 > len(data):
+            return None
+        (length,) = struct.unpack(">H", data[offset : offset + 2])
+        if length < 2:
+            raise ValueError(f"jpeg segment 0x{marker:02X} has invalid length")
+        if marker in JPEG_SOF_MARKERS:
+            if offset + 7 > len(data):
+                return None
+            height, width = struct.unpack(">HH", data[offset + 3 : offset + 7])
+            return width, height
+        offset += length
+
+
+def _png_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    if len(data) < 24:
+        return None
+    if data[12:16] != b"IHDR":
+        raise ValueError("png does not start with an IHDR chunk")
+    return struct.unpack(">II", data[16:24])
+
+
+def _gif_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    if len(data) < 10:
+        return None
+    return struct.unpack("<HH", data[6:10])
+
+
+def _bmp_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    if len(data) < 18:
+        return None
+    (dib_size,) = struct.unpack("<I", data[14:18])
+    if dib_size == 12:
+        if len(data) < 22:
+            return None
+        return struct.unpack("<HH", data[18:22])
+    if dib_size < 40:
+        raise ValueError(f"bmp has unsupported header size {dib_size}")
+    if len(data) < 26:
+        return None
+    width, height = struct.unpack("<ii", data[18:26])
+    # negative height marks a top-down bitmap
+    return abs(width), abs(height)
+
+
+def _tiff_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    endian = "<" if data.startswith(b"II") else ">"
+    if len(data) < 8:
+        return None
+    (ifd_offset,) = struct.unpack(endian + "I", data[4:8])
+    if ifd_offset < 8:
+        raise ValueError("tiff has invalid first IFD offset")
+    if len(data) < ifd_offset + 2:
+        return None
+    (entries,) = struct.unpack(endian + "H", data[ifd_offset : ifd_offset + 2])
+    end = ifd_offset + 2 + entries * 12
+    if len(data) < end:
+        return None
+    width = height = None
+    for start in range(ifd_offset + 2, end, 12):
+        tag, field_type = struct.unpack(endian + "HH", data[start : start + 4])
+        if tag not in (256, 257):
+            continue
+        if field_type == 3:
+            (value,) = struct.unpack(endian + "H", data[start + 8 : start + 10])
+        elif field_type == 4:
+            (value,) = struct.unpack(endian + "I", data[start + 8 : start + 12])
+        else:
+            raise ValueError(f"tiff dimension tag {tag} has unexpected type")
+        if tag == 256:
+            width = value
+        else:
+            height = value
+    if width is None or height is None:
+        raise ValueError("tiff first IFD has no image dimensions")
+    return width, height
+
+
+def _webp_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    if len(data) < 30:
+        return None
+    chunk = data[12:16]
+    if chunk == b"VP8 ":
+        if data[23:26] != b"\x9d\x01\x2a":
+            raise ValueError("webp lossy frame has invalid start code")
+        width, height = struct.unpack("<HH", data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L":
+        if data[20] != 0x2F:
+            raise ValueError("webp lossless frame has invalid signature")
+        (bits,) = struct.unpack("<I", data[21:25])
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X":
+        width = int.from_bytes(data[24:27], "little") + 1
+        height = int.from_bytes(data[27:30], "little") + 1
+        return width, height
+    raise ValueError(f"webp has unexpected first chunk {chunk!r}")
+
+
+DIMENSION_READERS = {
+    "jpeg": _jpeg_dimensions,
+    "png": _png_dimensions,
+    "gif": _gif_dimensions,
+    "bmp": _bmp_dimensions,
+    "tiff": _tiff_dimensions,
+    "webp": _webp_dimensions,
+}
+
+
+def sniff_image_header(data: bytes) -> Optional[ImageHeader]:
+    """
+    Read the format and, where it can be found in the bytes given, the pixel
+    dimensions of an image. Returns None until the format can be identified and
+    a header without width/height until the dimensions have arrived.
+    Raises ValueError for a recognised format with a corrupt header.
+    """
+    image_format = detect_format(data)
+    if image_format is None:
+        return None
+    reader = DIMENSION_READERS.get(image_format)
+    dimensions = reader(data) if reader else None
+    if dimensions is None:
+        return ImageHeader(format=image_format)
+    width, height = dimensions
+    return ImageHeader(format=image_format, width=width, height=height)
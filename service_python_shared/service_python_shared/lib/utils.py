@@ -1,3 +1,6 @@
+from typing import List
+
+
 def parse_int(value: str, fallback: int) -> int:
     try:
         return int(value)
@@ -11,3 +14,28 @@ def decode_header(value):
     if value is not None:
         return str(value)
     return None
+
+
+def parse_float(value: str, fallback: float) -> float:
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return fallback
+
+
+def parse_bool(value: str, fallback: bool) -> bool:
+    if value is None:
+        return fallback
+    normalised = str(value).strip().lower()
+    if normalised in ("1", "true", "yes", "on"):
+        return True
+    if normalised in ("0", "false", "no", "off"):
+        return False
+    return fallback
+
+
+def parse_list(value: str, fallback: List[str]) -> List[str]:
+    if value is None:
+        return fallback
+    items = [item.strip().lower() for item in str(value).split(",")]
+    return [item for item in items if item] or fallback
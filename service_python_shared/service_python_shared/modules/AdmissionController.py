@@ -0,0 +1,184 @@
+import asyncio
+import itertools
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Optional, Tuple
+
+from pydantic import BaseModel
+
+from service_python_shared.configs.config import AdmissionSettings, config
+from service_python_shared.lib import decoding
+from service_python_shared.lib.image_header import ImageHeader
+from service_python_shared.modules.logger import get_logger
+
+MB = 1024 * 1024
+
+try:
+    from PIL import Image as PilImage
+    from PIL.Image import DecompressionBombError
+except ImportError:
+    PilImage = None
+
+    class DecompressionBombError(Exception):
+        """stands in for PIL's error when pillow is not installed"""
+
+
+def apply_decoder_pixel_limits(max_pixels: int):
+    """
+    Have the decoders themselves refuse images over max_pixels, as a backstop for
+    formats whose dimensions are not read from the header.
+    """
+    if max_pixels <= 0:
+        return
+    decoding.MAX_IMAGE_PIXELS = max_pixels
+    if PilImage is not None:
+        # pillow raises DecompressionBombError over twice its limit
+        PilImage.MAX_IMAGE_PIXELS = max_pixels // 2
+
+
+class AdmissionStats(BaseModel):
+    budget_bytes: int
+    in_flight_bytes: int
+    peak_bytes: int
+    in_flight: int
+    waiting: int
+    admitted: int
+    delayed: int
+    serialised: int
+
+
+class Reservation:
+    def __init__(self, controller: "AdmissionController", corr_id: str):
+        self.controller = controller
+        self.corr_id = corr_id
+        self.bytes = 0
+        self.admitted = False
+
+    async def admit(self, header: Optional[ImageHeader]):
+        """wait until the memory estimated for the image fits in the budget"""
+        if self.admitted:
+            return
+        estimate = self.controller.estimate(header)
+        await self.controller.acquire(estimate, self.corr_id)
+        self.bytes = estimate
+        self.admitted = True
+
+
+class AdmissionController:
+    """
+    Bounds the estimated decoded memory of all images in flight. An image reserves
+    its share of the budget once its header has been read, waiting until it fits,
+    and releases it when extraction is done. An image larger than the whole budget
+    is only admitted when nothing else is in flight, so it runs alone.
+
+    Waiting images are admitted oldest first. Later, smaller images may overtake
+    them only if they fit alongside the memory the oldest one is waiting for, so a
+    large image is delayed but never starved.
+    """
+
+    def __init__(
+        self,
+        budget_bytes: int,
+        bytes_per_pixel: int = 12,
+        unknown_estimate_bytes: int = 64 * MB,
+        log_every: int = 100,
+    ):
+        self.budget_bytes = budget_bytes
+        self.bytes_per_pixel = bytes_per_pixel
+        self.unknown_estimate_bytes = unknown_estimate_bytes
+        self.log_every = log_every
+        self.in_flight_bytes = 0
+        self.peak_bytes = 0
+        self.in_flight = 0
+        self.admitted = 0
+        self.delayed = 0
+        self.serialised = 0
+        self._waiting: Deque[Tuple[int, int]] = deque()
+        self._tickets = itertools.count()
+        self._changed = asyncio.Condition()
+
+    @classmethod
+    def from_config(
+        cls, settings: Optional[AdmissionSettings] = None
+    ) -> Optional["AdmissionController"]:
+        settings = settings or config["admission"]
+        if settings["memory_budget_mb"] <= 0:
+            return None
+        return cls(
+            budget_bytes=settings["memory_budget_mb"] * MB,
+            bytes_per_pixel=settings["bytes_per_pixel"],
+            unknown_estimate_bytes=settings["unknown_estimate_mb"] * MB,
+            log_every=settings["log_every"],
+        )
+
+    def estimate(self, header: Optional[ImageHeader]) -> int:
+        if header is None or header.pixels is None:
+            return self.unknown_estimate_bytes
+        return header.pixels * self.bytes_per_pixel
+
+    def stats(self) -> AdmissionStats:
+        return AdmissionStats(
+            budget_bytes=self.budget_bytes,
+            in_flight_bytes=self.in_flight_bytes,
+            peak_bytes=self.peak_bytes,
+            in_flight=self.in_flight,
+            waiting=len(self._waiting),
+            admitted=self.admitted,
+            delayed=self.delayed,
+            serialised=self.serialised,
+        )
+
+    def _fits(self, estimate: int, ticket: int) -> bool:
+        reserved = 0
+        if self._waiting and self._waiting[0][0] != ticket:
+            reserved = min(self._waiting[0][1], self.budget_bytes)
+        if self.in_flight == 0 and reserved == 0:
+            return True
+        return self.in_flight_bytes + reserved + estimate <= self.budget_bytes
+
+    async def acquire(self, estimate: int, corr_id: str = ""):
+        logger = get_logger("AdmissionController/acquire", corr_id=corr_id)
+        async with self._changed:
+            ticket = next(self._tickets)
+            if not self._fits(estimate, ticket):
+                self.delayed += 1
+                logger.debug(
+                    f"delaying image needing {estimate / MB:.1f}MB, "
+                    f"{self.in_flight_bytes / MB:.1f}MB of "
+                    f"{self.budget_bytes / MB:.0f}MB in flight"
+                )
+                entry = (ticket, estimate)
+                self._waiting.append(entry)
+                try:
+                    await self._changed.wait_for(lambda: self._fits(estimate, ticket))
+                finally:
+                    self._waiting.remove(entry)
+                    # the next waiter may now be at the head of the queue
+                    self._changed.notify_all()
+            if estimate > self.budget_bytes:
+                self.serialised += 1
+            self.in_flight += 1
+            self.in_flight_bytes += estimate
+            self.peak_bytes = max(self.peak_bytes, self.in_flight_bytes)
+            self.admitted += 1
+            if self.log_every and self.admitted % self.log_every == 0:
+                logger.info(f"admission stats: {self.stats().model_dump_json()}")
+
+    async def release(self, estimate: int):
+        async with self._changed:
+            self.in_flight -= 1
+            self.in_flight_bytes -= estimate
+            self._changed.notify_all()
+
+    @asynccontextmanager
+    async def reserve(self, corr_id: str = "") -> AsyncIterator[Reservation]:
+        """
+        Reservation held for the life of one message, admitted with the image
+        header by Reservation.admit and released on exit.
+        """
+        reservation = Reservation(self, corr_id)
+        try:
+            yield reservation
+        finally:
+            if reservation.admitted:
+                await self.release(reservation.bytes)
@@ -0,0 +1,87 @@
+from typing import List, Optional
+
+from service_python_shared.configs.config import config
+from service_python_shared.lib.image_header import ImageHeader, sniff_image_header
+
+# recognised from their magic bytes but not decoded by any service, so never worth
+# downloading; anything else unrecognised is left for the decoder to try
+UNDECODABLE_FORMATS = {"heif", "avif"}
+
+
+class ImageRejectedError(ValueError):
+    """Raised when an image can not, or should not, be processed by the service"""
+
+
+class ImagePolicy:
+    def __init__(
+        self,
+        allowed_formats: List[str],
+        min_width: int = 1,
+        min_height: int = 1,
+        max_pixels: int = 0,
+        sniff_bytes: int = 262144,
+    ):
+        # empty allows any format but those known not to decode
+        self.allowed_formats = {f.lower() for f in allowed_formats}
+        self.min_width = min_width
+        self.min_height = min_height
+        # 0 disables the upper bound
+        self.max_pixels = max_pixels
+        self.sniff_bytes = sniff_bytes
+
+    @classmethod
+    def from_config(cls, max_pixels: Optional[int] = None) -> Optional["ImagePolicy"]:
+        settings = config["image_policy"]
+        if not settings["enabled"]:
+            return None
+        return cls(
+            allowed_formats=settings["allowed_formats"],
+            min_width=settings["min_width"],
+            min_height=settings["min_height"],
+            max_pixels=settings["max_pixels"] if max_pixels is None else max_pixels,
+            sniff_bytes=settings["sniff_bytes"],
+        )
+
+    def check_header(self, header: ImageHeader):
+        if self.allowed_formats:
+            if header.format not in self.allowed_formats:
+                raise ImageRejectedError(f"unsupported image format: {header.format}")
+        elif header.format in UNDECODABLE_FORMATS:
+            raise ImageRejectedError(f"unsupported image format: {header.format}")
+        if header.width is None or header.height is None:
+            return
+        if header.width < self.min_width or header.height < self.min_height:
+            raise ImageRejectedError(
+                f"image too small: {header.width}x{header.height} "
+                f"(minimum {self.min_width}x{self.min_height})"
+            )
+        if self.max_pixels and header.pixels > self.max_pixels:
+            raise ImageRejectedError(
+                f"image too large: {header.width}x{header.height} "
+                f"exceeds {self.max_pixels} pixels"
+            )
+
+    def inspect(self, data: bytes, final: bool = False) -> bool:
+        """
+        Inspect the leading bytes of an image as they arrive. Returns True once the
+        image has been accepted, False if more bytes are needed to decide, and raises
+        ImageRejectedError if the image should not be processed. With final set, no
+        more bytes will be given so a decision is always made.
+        """
+        final = final or len(data) >= self.sniff_bytes
+        try:
+            header = sniff_image_header(data)
+        except ValueError as e:
+            raise ImageRejectedError(f"corrupt image header: {e}") from e
+        if header is None:
+            if final:
+                raise ImageRejectedError("not enough data to identify image format")
+            return False
+        self.check_header(header)
+        if header.format == "unknown":
+            # no dimensions will be read from a format that isn't recognised
+            return True
+        if header.width is None or header.height is None:
+            # leave anything not resolved within the sniff window to the decoder
+            return final
+        return True
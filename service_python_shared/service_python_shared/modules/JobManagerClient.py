@@ -1,5 +1,5 @@
 import asyncio
-from typing import Optional, List
+from typing import Awaitable, Callable, Optional, List
 
 import grpc
 from grpc import aio
@@ -9,12 +9,21 @@ from service_python_shared.generated.service_jobs_pb2 import GetDataRequest
 from service_python_shared.generated.service_jobs_pb2_grpc import (
     JobManagerControllerStub,
 )
+from service_python_shared.lib.image_header import ImageHeader, sniff_image_header
+from service_python_shared.modules.ImagePolicy import ImagePolicy, ImageRejectedError
 from service_python_shared.modules.logger import get_logger
 
 MAX_CONNECTION_ATTEMPTS = 10
 TIME_BETWEEN_ATTEMPTS = 2  # seconds
 
 
+def read_header(data: bytes) -> Optional[ImageHeader]:
+    try:
+        return sniff_image_header(data)
+    except ValueError:
+        return None
+
+
 class JobManagerClient:
     _client: Optional[JobManagerControllerStub] = None
     _channel: Optional[aio.Channel] = None
@@ -53,7 +62,12 @@ class JobManagerClient:
 
     @classmethod
     async def get_image_data(
-        cls, image_source: str, corr_id: str, jwe_token: str
+        cls,
+        image_source: str,
+        corr_id: str,
+        jwe_token: str,
+        image_policy: Optional[ImagePolicy] = None,
+        on_header: Optional[Callable[[Optional[ImageHeader]], Awaitable[None]]] = None,
     ) -> bytes:
         if cls._client is None:
             raise RuntimeError("Client not connected. Call connect() first.")
@@ -68,14 +82,42 @@ class JobManagerClient:
 
         logger = get_logger("JobManagerClient/get_image_data")
 
+        # leading bytes are inspected as they arrive so out of policy images can
+        # be rejected without downloading the rest of the file
+        accepted = image_policy is None
+        head = bytearray()
+        # on_header is awaited once the header has been accepted, before the rest
+        # of the stream is read, so the caller can hold back large images
+        header_sent = on_header is None
+
         request = GetDataRequest(filepath=image_source)
+        call = cls._client.getData(request, metadata=metadata)
         try:
-            async for response in cls._client.getData(request, metadata=metadata):
+            async for response in call:
                 if response.data:
                     buffer.append(response.data)
+                    if not accepted:
+                        head += response.data
+                        accepted = image_policy.inspect(bytes(head))
+                    elif not head:
+                        head += response.data
+                    if accepted and not header_sent:
+                        header_sent = True
+                        await on_header(read_header(bytes(head)))
+            if not accepted:
+                image_policy.inspect(bytes(head), final=True)
+            if not header_sent:
+                await on_header(read_header(bytes(head)))
         except grpc.RpcError as e:
             logger.error(f"Error streaming image data: {e}", extra={"id": log_id})
             raise
+        except ImageRejectedError as e:
+            call.cancel()
+            logger.info(
+                f"Rejected {image_source} after {len(head)} bytes: {e}",
+                extra={"id": log_id},
+            )
+            raise
 
         logger.debug(
             f"Completed streaming image data for {image_source}", extra={"id": log_id}
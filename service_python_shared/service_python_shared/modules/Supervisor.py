@@ -0,0 +1,418 @@
+import asyncio
+import gc
+import json
+import os
+import select
+import signal
+import time
+from typing import Callable, List, Optional, Tuple
+
+from service_python_shared.configs.config import SupervisorSettings, config
+from service_python_shared.modules.logger import get_logger, setup_worker_logging
+from service_python_shared.modules.Workflow import Workflow, WorkflowStats
+
+WorkflowFactory = Callable[[], Workflow]
+
+# how often workers send their stats to the supervisor
+REPORT_INTERVAL_S = 1.0
+# extra time given to a draining worker to close its connections before it is killed
+KILL_GRACE_S = 5.0
+
+
+class WorkerStats(WorkflowStats):
+    index: int
+    pid: int = 0
+    state: str = "starting"
+    restarts: int = 0
+    rss_mb: float = 0.0
+    pss_mb: float = 0.0
+    private_mb: float = 0.0
+
+
+def read_memory(pid: int) -> Tuple[float, float, float]:
+    """
+    Resident, proportional and private memory of a process in MB. Pages shared
+    copy-on-write with the supervisor count fully to rss but only in part to pss,
+    and not at all to private. Zeros where /proc is not available.
+    """
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as smaps:
+            for line in smaps:
+                name, _, value = line.partition(":")
+                parts = value.split()
+                if len(parts) == 2 and parts[1] == "kB":
+                    fields[name] = int(parts[0]) / 1024
+    except OSError:
+        return 0.0, 0.0, 0.0
+    return (
+        fields.get("Rss", 0.0),
+        fields.get("Pss", 0.0),
+        fields.get("Private_Clean", 0.0) + fields.get("Private_Dirty", 0.0),
+    )
+
+
+async def _report_stats(workflow: Workflow, stats_fd: int):
+    while True:
+        report = workflow.stats.model_dump()
+        report["ready"] = workflow.receiver.is_connected()
+        try:
+            os.write(stats_fd, (json.dumps(report) + "\n").encode())
+        except BlockingIOError:
+            # the supervisor is behind, it gets the next report
+            pass
+        await asyncio.sleep(REPORT_INTERVAL_S)
+
+
+async def run_worker(
+    make_workflow: WorkflowFactory,
+    drain_timeout: float,
+    stats_fd: Optional[int] = None,
+) -> int:
+    """
+    Run a workflow until SIGTERM or SIGINT, then drain it. Returns the exit code,
+    1 if the workflow stopped by itself.
+    """
+    logger = get_logger("Supervisor/run_worker")
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    workflow = make_workflow()
+    receiving = asyncio.create_task(workflow.start_receiving_messages())
+    stop = asyncio.create_task(stopping.wait())
+    tasks = [receiving, stop]
+    if stats_fd is not None:
+        tasks.append(asyncio.create_task(_report_stats(workflow, stats_fd)))
+
+    code = 0
+    try:
+        await asyncio.wait([receiving, stop], return_when=asyncio.FIRST_COMPLETED)
+        if receiving.done():
+            error = receiving.exception()
+            logger.error(f"stopped receiving messages: {error or 'consumer ended'}")
+            code = 1
+        else:
+            await workflow.drain(drain_timeout)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return code
+
+
+class WorkerProcess:
+    def __init__(self, index: int):
+        self.index = index
+        self.pid = 0
+        self.state = "stopped"
+        self.started = 0.0
+        self.drain_deadline = 0.0
+        self.restart_at: Optional[float] = None
+        self.restarts = 0
+        self.crashes = 0
+        self.stats_fd: Optional[int] = None
+        self.buffer = b""
+        self.stats = WorkerStats(index=index)
+
+
+class Supervisor:
+    """
+    Forks worker processes from a process that has already loaded the model, so
+    the weights are shared copy-on-write instead of loaded once per worker. Each
+    worker runs its own Workflow, with its own RabbitMQ and gRPC connections.
+
+    Crashed workers are restarted with a backoff. SIGHUP restarts the workers one
+    at a time, each drained before it is replaced and the next only once the
+    replacement is ready. SIGTERM or SIGINT drains them all and exits. SIGUSR2 is
+    passed on to the workers to profile their next messages. Per-worker stats,
+    including how much memory each shares with the others, are logged every
+    stats interval.
+
+    Only fork with the model loaded, not used: threads started by inference in
+    the supervisor, ie. by OpenMP, do not survive the fork.
+    """
+
+    def __init__(
+        self,
+        make_workflow: WorkflowFactory,
+        settings: Optional[SupervisorSettings] = None,
+    ):
+        self.make_workflow = make_workflow
+        self.settings = settings or config["supervisor"]
+        self.workers = [WorkerProcess(i) for i in range(self.settings["workers"])]
+        self.stopping = False
+        self._stop_deadline = 0.0
+        self._signals: List[int] = []
+        # (worker index, pid being replaced) left to go in a rolling restart
+        self._rolling: List[Tuple[int, int]] = []
+
+    def run(self) -> int:
+        logger = get_logger("Supervisor/run")
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR2):
+            signal.signal(sig, self._on_signal)
+        # objects loaded so far, above all the model, are left out of garbage
+        # collection in the workers, which would otherwise write to their pages
+        gc.collect()
+        gc.freeze()
+
+        logger.info(f"starting {len(self.workers)} workers...")
+        for worker in self.workers:
+            self._spawn(worker)
+
+        next_stats = time.monotonic() + self.settings["stats_interval_s"]
+        while not self.stopping or any(worker.pid for worker in self.workers):
+            self._handle_signals()
+            self._read_stats(timeout=0.5)
+            self._reap()
+            now = time.monotonic()
+            if not self.stopping:
+                self._restart_due(now)
+                self._roll(now)
+            self._kill_overdue(now)
+            if now >= next_stats:
+                self.log_stats()
+                next_stats = now + self.settings["stats_interval_s"]
+
+        self.log_stats()
+        logger.info("all workers stopped")
+        return 0
+
+    def _on_signal(self, sig: int, frame):
+        self._signals.append(sig)
+
+    def _handle_signals(self):
+        logger = get_logger("Supervisor/handle_signals")
+        while self._signals:
+            sig = self._signals.pop(0)
+            if sig in (signal.SIGTERM, signal.SIGINT) and not self.stopping:
+                logger.warning("stopping, draining all workers...")
+                self.stopping = True
+                self._stop_deadline = (
+                    time.monotonic() + self.settings["drain_timeout_s"] + KILL_GRACE_S
+                )
+                self._rolling = []
+                for worker in self.workers:
+                    worker.restart_at = None
+                    self._drain(worker)
+            elif sig == signal.SIGHUP and not self.stopping and not self._rolling:
+                logger.info("rolling restart of all workers...")
+                self._rolling = [(worker.index, worker.pid) for worker in self.workers]
+            elif sig == signal.SIGUSR2:
+                for worker in self.workers:
+                    self._send(worker, signal.SIGUSR2)
+
+    def _spawn(self, worker: WorkerProcess):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            self._run_child(worker, write_fd)
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        if worker.started:
+            worker.restarts += 1
+        worker.pid = pid
+        worker.state = "starting"
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        worker.stats_fd = read_fd
+        worker.buffer = b""
+        worker.stats = WorkerStats(index=worker.index, pid=pid)
+        get_logger("Supervisor/spawn").info(f"worker {worker.index} started, pid {pid}")
+
+    def _run_child(self, worker: WorkerProcess, stats_fd: int):
+        code = 1
+        try:
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(sig, signal.SIG_DFL)
+            # until the workflow handles SIGUSR2, which would otherwise kill it
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            for other in self.workers:
+                if other.stats_fd is not None:
+                    os.close(other.stats_fd)
+            os.set_blocking(stats_fd, False)
+            setup_worker_logging(worker.index)
+            # each worker is its own replica when sharding, keeping its shard queue
+            # across restarts
+            rabbitmq = config["rabbitmq"]
+            if rabbitmq["replica_id"]:
+                rabbitmq["replica_id"] = f"{rabbitmq['replica_id']}-{worker.index}"
+            code = asyncio.run(
+                run_worker(
+                    self.make_workflow, self.settings["drain_timeout_s"], stats_fd
+                )
+            )
+        except BaseException as e:
+            get_logger("Supervisor/worker").exception(
+                f"worker {worker.index} failed: {e}"
+            )
+        finally:
+            os._exit(code)
+
+    def _send(self, worker: WorkerProcess, sig: int):
+        if worker.pid:
+            try:
+                os.kill(worker.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def _drain(self, worker: WorkerProcess):
+        if worker.pid and worker.state != "draining":
+            worker.state = "draining"
+            worker.drain_deadline = (
+                time.monotonic() + self.settings["drain_timeout_s"] + KILL_GRACE_S
+            )
+            self._send(worker, signal.SIGTERM)
+
+    def _read_stats(self, timeout: float):
+        fds = {w.stats_fd: w for w in self.workers if w.stats_fd is not None}
+        if not fds:
+            time.sleep(timeout)
+            return
+        readable, _, _ = select.select(list(fds), [], [], timeout)
+        for fd in readable:
+            worker = fds[fd]
+            try:
+                data = os.read(fd, 65536)
+            except BlockingIOError:
+                continue
+            if not data:
+                os.close(fd)
+                worker.stats_fd = None
+                continue
+            *lines, worker.buffer = (worker.buffer + data).split(b"\n")
+            for line in lines:
+                self._update_stats(worker, json.loads(line))
+
+    def _update_stats(self, worker: WorkerProcess, report: dict):
+        ready = report.pop("ready", False)
+        worker.stats = worker.stats.model_copy(update=report)
+        if ready and worker.state == "starting":
+            worker.state = "running"
+            get_logger("Supervisor/update_stats").info(
+                f"worker {worker.index} ready, pid {worker.pid}"
+            )
+
+    def _reap(self):
+        logger = get_logger("Supervisor/reap")
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = next((w for w in self.workers if w.pid == pid), None)
+            if worker is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            drained = worker.state == "draining"
+            worker.pid = 0
+            worker.state = "stopped"
+            if self.stopping:
+                logger.info(f"worker {worker.index} stopped with code {code}")
+            elif drained:
+                logger.info(f"worker {worker.index} drained, replacing it")
+                self._spawn(worker)
+            else:
+                now = time.monotonic()
+                max_backoff = self.settings["restart_backoff_max_s"]
+                # a worker that ran for a while starts its backoff again
+                ran = now - worker.started
+                worker.crashes = 1 if ran > max_backoff else worker.crashes + 1
+                delay = min(2 ** (worker.crashes - 1), max_backoff)
+                worker.restart_at = now + delay
+                logger.error(
+                    f"worker {worker.index} exited with code {code}, "
+                    f"restarting in {delay:.0f}s"
+                )
+
+    def _restart_due(self, now: float):
+        for worker in self.workers:
+            if worker.restart_at is not None and now >= worker.restart_at:
+                self._spawn(worker)
+
+    def _roll(self, now: float):
+        if not self._rolling:
+            return
+        index, old_pid = self._rolling[0]
+        worker = self.workers[index]
+        if worker.pid == old_pid and worker.state != "draining":
+            self._drain(worker)
+        elif worker.pid != old_pid and worker.state == "running":
+            self._rolling.pop(0)
+            if not self._rolling:
+                get_logger("Supervisor/roll").info("rolling restart complete")
+        elif (
+            worker.state == "starting"
+            and now - worker.started > self.settings["drain_timeout_s"]
+        ):
+            get_logger("Supervisor/roll").warning(
+                f"worker {index} not ready, continuing the rolling restart"
+            )
+            self._rolling.pop(0)
+
+    def _kill_overdue(self, now: float):
+        stop_overdue = self.stopping and now > self._stop_deadline
+        for worker in self.workers:
+            if not worker.pid:
+                continue
+            if stop_overdue or (
+                worker.state == "draining" and now > worker.drain_deadline
+            ):
+                get_logger("Supervisor/kill_overdue").warning(
+                    f"worker {worker.index} did not drain in time, killing it"
+                )
+                self._send(worker, signal.SIGKILL)
+                worker.drain_deadline = float("inf")
+        if stop_overdue:
+            self._stop_deadline = float("inf")
+
+    def worker_stats(self) -> List[WorkerStats]:
+        stats = []
+        for worker in self.workers:
+            rss, pss, private = read_memory(worker.pid) if worker.pid else (0, 0, 0)
+            stats.append(
+                worker.stats.model_copy(
+                    update={
+                        "state": worker.state,
+                        "restarts": worker.restarts,
+                        "rss_mb": rss,
+                        "pss_mb": pss,
+                        "private_mb": private,
+                    }
+                )
+            )
+        return stats
+
+    def log_stats(self):
+        logger = get_logger("Supervisor/stats")
+        stats = self.worker_stats()
+        for worker in stats:
+            logger.info(
+                f"worker {worker.index} pid {worker.pid} {worker.state}: "
+                f"{worker.completed} completed, {worker.rejected} rejected, "
+                f"{worker.requeued} requeued, {worker.in_flight} in flight, "
+                f"{worker.restarts} restarts, rss {worker.rss_mb:.0f}MB, "
+                f"pss {worker.pss_mb:.0f}MB, private {worker.private_mb:.0f}MB"
+            )
+        rss, pss, _ = read_memory(os.getpid())
+        total = pss + sum(worker.pss_mb for worker in stats)
+        logger.info(f"supervisor rss {rss:.0f}MB, {total:.0f}MB used by all processes")
+
+
+def run_service(
+    make_workflow: WorkflowFactory, settings: Optional[SupervisorSettings] = None
+) -> int:
+    """
+    Run a service's workflow, in this process or, with more than one worker, in
+    worker processes forked by a Supervisor. Load the model before calling this,
+    make_workflow is called in each worker. Returns the exit code.
+    """
+    settings = settings or config["supervisor"]
+    if settings["workers"] <= 1:
+        return asyncio.run(run_worker(make_workflow, settings["drain_timeout_s"]))
+    return Supervisor(make_workflow, settings).run()
@@ -1,3 +1,4 @@
+import asyncio
 from aio_pika import IncomingMessage
 from aio_pika.exceptions import (
     ChannelClosed,
@@ -5,16 +6,26 @@ from aio_pika.exceptions import (
     MessageProcessError,
 )
 import grpc
-from typing import TypeVar, Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Awaitable, Optional, TypeVar, Callable
 from cv2 import error as Cv2Error
-from pydantic import ValidationError
+from pydantic import BaseModel, ValidationError
 from service_python_shared.modules.rabbitmq import (
     RabbitMqMessageSender,
     RabbitMqMessageReceiver,
     RabbitMqMessage,
 )
 from service_python_shared.modules.JobManagerClient import JobManagerClient
+from service_python_shared.modules.ImagePolicy import ImagePolicy, ImageRejectedError
+from service_python_shared.modules.AdmissionController import (
+    AdmissionController,
+    DecompressionBombError,
+    apply_decoder_pixel_limits,
+)
 from service_python_shared.modules.logger import get_logger
+from service_python_shared.modules.profiler import Profiler
+from service_python_shared.modules.traffic import Recording, TrafficRecorder
 from service_python_shared.configs.config import config
 from service_python_shared.lib.utils import decode_header
 
@@ -23,14 +34,58 @@ SERVICE_QUEUE = config["rabbitmq"]["service_queue_name"]
 
 T = TypeVar("T")
 
+# called with the source message, extracted data, corr_id and jwe_token once processed
+ExtractedDataHandler = Callable[[RabbitMqMessage, T, str, str], Awaitable[None]]
+# called once no more messages will be handled, to release what the service holds
+CloseHandler = Callable[[], Awaitable[None]]
+
+
+class WorkflowStats(BaseModel):
+    received: int = 0
+    completed: int = 0
+    rejected: int = 0
+    requeued: int = 0
+    in_flight: int = 0
+
 
 class Workflow:
-    def __init__(self, description: str, extract_data: Callable[[bytes], T]):
+    def __init__(
+        self,
+        description: str,
+        extract_data: Callable[[bytes], T],
+        image_policy: Optional[ImagePolicy] = None,
+        on_data_extracted: Optional[ExtractedDataHandler] = None,
+        check_images: bool = True,
+        max_pixels: Optional[int] = None,
+        on_close: Optional[CloseHandler] = None,
+    ):
         self.sender = RabbitMqMessageSender(JOB_MANAGER_QUEUE)
         self.receiver = RabbitMqMessageReceiver(SERVICE_QUEUE)
         self.jobManagerClient = JobManagerClient()
         self.description = description
         self.extract_data = extract_data
+        # a service can raise or lower the configured limit for the images it decodes
+        if max_pixels is None:
+            max_pixels = config["image_policy"]["max_pixels"]
+        # the configured policy unless the service brings its own, or opts out
+        self.image_policy = (
+            (image_policy or ImagePolicy.from_config(max_pixels))
+            if check_images
+            else None
+        )
+        self.on_data_extracted = on_data_extracted
+        self.on_close = on_close
+        self.profiler = Profiler()
+        self.recorder = TrafficRecorder.from_config()
+        self.admission = AdmissionController.from_config()
+        self.stats = WorkflowStats()
+        # extraction runs off the event loop, so messages, downloads and heartbeats
+        # carry on, and several images can be extracted at once within the budget
+        self.extract_executor = ThreadPoolExecutor(
+            max_workers=max(config["admission"]["extract_threads"], 1),
+            thread_name_prefix="extract",
+        )
+        apply_decoder_pixel_limits(max_pixels)
 
     async def start_receiving_messages(self):
         logger = get_logger("Workflow/start_receiving_messages")
@@ -39,6 +94,7 @@ class Workflow:
         logger.info("connecting to rabbitMq...")
         await self.sender.connect()
         await self.receiver.connect()
+        self.profiler.install_signal_handler()
         self._keep_alive = self.receiver.get_messages_on_queue(
             self.handle_incoming_message
         )
@@ -49,13 +105,74 @@ class Workflow:
         logger = get_logger("Workflow/stop_processing")
         logger.warning("closing service and killing all connections...")
         await self.receiver.close()
+        await self._close_handler()
         await self.sender.close()
         await self.jobManagerClient.close_grpc_socket()
+        self.extract_executor.shutdown(wait=False)
+        await self._close_recorder()
         self._keep_alive.set()
         logger.warning("service closed and processing stopped")
 
+    async def drain(self, timeout: float):
+        """
+        Stop taking new messages and wait up to timeout for those in flight to be
+        processed, then close all connections. Anything still unacked is returned
+        to the queue by the broker when the connection closes.
+        """
+        logger = get_logger("Workflow/drain")
+        logger.info(f"draining {self.stats.in_flight} messages in flight...")
+        await self.receiver.stop_consuming()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.stats.in_flight and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        if self.stats.in_flight:
+            logger.warning(
+                f"{self.stats.in_flight} messages still in flight after {timeout}s, "
+                "they will be redelivered"
+            )
+        await self.receiver.close()
+        await self._close_handler()
+        await self.sender.close()
+        await self.jobManagerClient.close_grpc_socket()
+        self.extract_executor.shutdown(wait=False)
+        await self._close_recorder()
+        logger.info("drained and disconnected")
+
+    async def _close_recorder(self):
+        if self.recorder:
+            await asyncio.get_running_loop().run_in_executor(None, self.recorder.close)
+
+    async def _close_handler(self):
+        if not self.on_close:
+            return
+        try:
+            await self.on_close()
+        except Exception as e:
+            get_logger("Workflow/close").exception(f"closing the service failed: {e}")
+
     async def handle_incoming_message(
         self, data: RabbitMqMessage, message: IncomingMessage
+    ):
+        self.stats.received += 1
+        self.stats.in_flight += 1
+        # the envelope is kept from the start, so messages which never get as far
+        # as their image data are recorded too
+        recording = (
+            self.recorder.start(data, message.headers or {}) if self.recorder else None
+        )
+        try:
+            await self._handle_incoming_message(data, message, recording)
+        finally:
+            self.stats.in_flight -= 1
+            if recording:
+                self.recorder.finish(recording)
+
+    async def _handle_incoming_message(
+        self,
+        data: RabbitMqMessage,
+        message: IncomingMessage,
+        recording: Optional[Recording] = None,
     ):
         job_id = data.jobId
         filepath = data.filepath
@@ -73,11 +190,18 @@ class Workflow:
                 message=message,
                 corr_id=corr_id,
                 jwe_token=jwe_token,
+                recording=recording,
             )
             return
         acked = False
         try:
-            extracted_data = await self.process_image(filepath, corr_id, jwe_token)
+            extracted_data = await self.process_image(
+                filepath,
+                corr_id,
+                jwe_token,
+                profile=self.profiler.should_profile(headers),
+                recording=recording,
+            )
             await self.sender.send_json_message(
                 queue_name=JOB_MANAGER_QUEUE,
                 message=extracted_data,
@@ -90,14 +214,25 @@ class Workflow:
             )
             await message.ack()
             acked = True
+            if recording:
+                recording.settle("completed")
+            self.stats.completed += 1
             logger.info(f"completed processing image {filepath} for job: {job_id}")
+            if self.on_data_extracted:
+                await self.on_data_extracted(data, extracted_data, corr_id, jwe_token)
             return
         except grpc.RpcError as e:
             reason = f"failed to stream image data for {filepath}: #{e.code()} - {e.details()}"
             requeue = True
+        except ImageRejectedError as e:
+            reason = f"Image rejected before processing: {e}"
+            requeue = False
         except (ValueError, TypeError, IndexError) as e:
             reason = f"Bad image input or parsing error: {e}"
             requeue = False
+        except DecompressionBombError as e:
+            reason = f"Image rejected as a decompression bomb: {e}"
+            requeue = False
         except Cv2Error as e:
             reason = f"OpenCV failed to decode image: {e}"
             requeue = False
@@ -120,6 +255,7 @@ class Workflow:
                 corr_id=corr_id,
                 jwe_token=jwe_token,
                 requeue=requeue,
+                recording=recording,
             )
 
     async def reject_message(
@@ -130,9 +266,16 @@ class Workflow:
         corr_id: str | None,
         jwe_token: str | None,
         requeue=False,
+        recording: Optional[Recording] = None,
     ):
         logger = get_logger("Workflow/reject_message", corr_id=corr_id)
         logger.info(f"rejecting message due to: {reason} for file: {data.filepath}")
+        if recording:
+            recording.settle("requeued" if requeue else "rejected", reason)
+        if requeue:
+            self.stats.requeued += 1
+        else:
+            self.stats.rejected += 1
         try:
             await message.nack(requeue=requeue)
             await self.sender.send_json_message(
@@ -155,13 +298,40 @@ class Workflow:
         except Exception as e:
             logger.error(f"Unexpected error during ack: {e}")
 
-    async def process_image(self, filepath: str, corr_id: str, jwe_token: str) -> T:
+    async def process_image(
+        self,
+        filepath: str,
+        corr_id: str,
+        jwe_token: str,
+        profile: bool = False,
+        recording: Optional[Recording] = None,
+    ) -> T:
         logger = get_logger("Workflow/process_image", corr_id=corr_id)
         logger.debug(f"streaming image data for {filepath}...")
-        image_data = await self.jobManagerClient.get_image_data(
-            filepath, corr_id=corr_id, jwe_token=jwe_token
+        # memory for the decoded image is reserved from the header, before the rest
+        # of the image is streamed, and held until extraction is done
+        reserve_memory = (
+            self.admission.reserve(corr_id) if self.admission else nullcontext()
         )
-        logger.debug(f"{self.description} for {filepath}")
-        extracted_data = self.extract_data(image_data)
-        logger.debug(f"{self.description} completed for {filepath}")
+        async with reserve_memory as reservation:
+            with self.profiler.stage(corr_id, "get_image_data", profile):
+                image_data = await self.jobManagerClient.get_image_data(
+                    filepath,
+                    corr_id=corr_id,
+                    jwe_token=jwe_token,
+                    image_policy=self.image_policy,
+                    on_header=reservation.admit if reservation else None,
+                )
+            if recording:
+                recording.image_data = image_data
+            logger.debug(f"{self.description} for {filepath}")
+            extracted_data = await asyncio.get_running_loop().run_in_executor(
+                self.extract_executor, self._extract, image_data, corr_id, profile
+            )
+            logger.debug(f"{self.description} completed for {filepath}")
         return extracted_data
+
+    def _extract(self, image_data: bytes, corr_id: str, profile: bool) -> T:
+        # profiled on the thread doing the work
+        with self.profiler.stage(corr_id, "extract_data", profile):
+            return self.extract_data(image_data)
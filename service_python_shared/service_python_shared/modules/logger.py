@@ -1,10 +1,26 @@
 import sys
+from pathlib import Path
+from typing import Optional
 from loguru import logger
 from service_python_shared.configs.config import config
 
+# set once the service logs to files, so forked workers open files of their own
+_logging_to_files = False
 
-def setup_logging():
+
+def worker_log_path(path: str, worker: int) -> str:
+    """ie. ../logs/service_{time}.worker-1.log"""
+    log_path = Path(path)
+    return str(log_path.with_name(f"{log_path.stem}.worker-{worker}{log_path.suffix}"))
+
+
+def setup_logging(worker: Optional[int] = None):
+    global _logging_to_files
     conf = config["logger"]
+    combined_log, error_log = conf["combined_log"], conf["error_log"]
+    if worker is not None:
+        combined_log = worker_log_path(combined_log, worker)
+        error_log = worker_log_path(error_log, worker)
     logger.remove()
     logger.add(
         sys.stdout,
@@ -13,19 +29,30 @@ def setup_logging():
         format=conf["stdout_format"],
     )
     logger.add(
-        conf["combined_log"],
+        combined_log,
         rotation=conf["file_size"],
         retention=conf["retention"],
         level=conf["level"],
         format=conf["format"],
     )
     logger.add(
-        conf["error_log"],
+        error_log,
         rotation=conf["file_size"],
         retention=conf["retention"],
         level="ERROR",
         format=conf["format"],
     )
+    _logging_to_files = True
+
+
+def setup_worker_logging(worker: int):
+    """
+    Called in a forked worker. Files opened before the fork are shared with the
+    supervisor and the other workers, which would each rotate them, so the worker
+    logs to files of its own instead.
+    """
+    if _logging_to_files:
+        setup_logging(worker)
 
 
 def get_logger(id: str, corr_id: str = ""):
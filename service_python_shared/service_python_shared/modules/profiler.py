@@ -0,0 +1,155 @@
+import asyncio
+import cProfile
+import os
+import random
+import re
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Iterator, Mapping, Optional
+
+from service_python_shared.configs.config import ProfilerSettings, config
+from service_python_shared.lib.utils import decode_header, parse_bool
+from service_python_shared.modules.logger import get_logger
+
+PROFILE_HEADER = "x-profile"
+
+_not_profiling = nullcontext()
+
+
+class _StackSampler(threading.Thread):
+    """Samples the stack of one thread at a fixed interval into collapsed stacks"""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(daemon=True, name="profile-sampler")
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                filename = os.path.basename(code.co_filename)
+                frames.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if frames:
+                self.stacks[";".join(reversed(frames))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class Profiler:
+    """
+    Profiles individual messages on demand, writing one file per stage to
+    <output_dir>/<corr_id>/. A message is profiled if it carries an x-profile
+    header, is picked by the sample rate, or arrives after SIGUSR2 has armed the
+    profiler for the next few messages. Messages not picked pay only for the
+    should_profile check.
+
+    Each stage is profiled on the thread that runs it: get_image_data on the
+    event loop thread, so it also includes any other messages handled while it
+    awaits, and extract_data on its extract thread. Only one cProfile can run at
+    a time in a process, so with cprofile a stage starting while another is
+    profiled, on any thread, is left unprofiled.
+    """
+
+    def __init__(self, settings: Optional[ProfilerSettings] = None):
+        settings = settings or config["profiler"]
+        self.output_dir = Path(settings["output_dir"])
+        self.mode = settings["mode"]
+        self.sample_rate = settings["sample_rate"]
+        self.sample_interval = settings["sample_interval_ms"] / 1000
+        self.allow_header = settings["allow_header"]
+        self.signal_count = settings["signal_count"]
+        self._armed = 0
+        # held while a cProfile runs, stages start on the loop and extract threads
+        self._cprofile_lock = threading.Lock()
+
+    def arm(self, count: Optional[int] = None):
+        """profile the next count messages"""
+        self._armed += self.signal_count if count is None else count
+        get_logger("Profiler/arm").info(
+            f"profiling the next {self._armed} messages to {self.output_dir}"
+        )
+
+    def install_signal_handler(self, sig: int = getattr(signal, "SIGUSR2", 0)):
+        if not sig:
+            return
+        try:
+            asyncio.get_running_loop().add_signal_handler(sig, self.arm)
+        except (NotImplementedError, RuntimeError) as e:
+            get_logger("Profiler/install_signal_handler").warning(
+                f"unable to profile on signal {sig}: {e}"
+            )
+
+    def should_profile(self, headers: Mapping) -> bool:
+        if self._armed:
+            self._armed -= 1
+            return True
+        if self.allow_header and PROFILE_HEADER in headers:
+            return parse_bool(decode_header(headers[PROFILE_HEADER]), False)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def stage(self, corr_id: str, name: str, enabled: bool):
+        """context manager profiling one stage of a message, if enabled"""
+        if not enabled:
+            return _not_profiling
+        return self.profile(corr_id, name)
+
+    @contextmanager
+    def profile(self, corr_id: str, name: str) -> Iterator[None]:
+        logger = get_logger("Profiler/profile", corr_id=corr_id)
+        directory = self.output_dir / re.sub(r"[^\w.-]", "_", corr_id or "unknown")
+        directory.mkdir(parents=True, exist_ok=True)
+        started = time.perf_counter()
+
+        if self.mode == "sampling":
+            sampler = _StackSampler(threading.get_ident(), self.sample_interval)
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                path = directory / f"{name}.collapsed"
+                path.write_text(
+                    "".join(f"{s} {n}\n" for s, n in sampler.stacks.items())
+                )
+        else:
+            profile = self._start_cprofile()
+            if profile is None:
+                logger.warning(f"skipped profiling {name}, another profile is running")
+                yield
+                return
+            try:
+                yield
+            finally:
+                profile.disable()
+                self._cprofile_lock.release()
+                path = directory / f"{name}.pstats"
+                profile.dump_stats(path)
+
+        elapsed = (time.perf_counter() - started) * 1000
+        logger.info(f"profiled {name} in {elapsed:.1f}ms, written to {path}")
+
+    def _start_cprofile(self) -> Optional[cProfile.Profile]:
+        """a running cProfile, or None if one is already running"""
+        if not self._cprofile_lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # started outside of this profiler, ie. by python -m cProfile
+            self._cprofile_lock.release()
+            return None
+        return profile
@@ -1,15 +1,30 @@
 import json
 
 from datetime import datetime, timezone
-from typing import Any, Callable, Generic, Optional, TypeVar, List, Awaitable
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generic,
+    Optional,
+    Set,
+    TypeVar,
+    List,
+    Awaitable,
+    Tuple,
+)
 import asyncio
 
 import aio_pika
 from aio_pika.abc import (
+    AbstractExchange,
+    AbstractIncomingMessage,
+    AbstractQueue,
     AbstractRobustConnection,
     AbstractRobustChannel,
 )
-from pydantic import BaseModel, ConfigDict, Field
+from aio_pika.exceptions import ChannelNotFoundEntity
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
 
 from service_python_shared.configs.config import config
 from service_python_shared.modules.logger import get_logger
@@ -19,6 +34,11 @@ T = TypeVar("T")
 conn_info = config["rabbitmq"]["connection_settings"]
 origin_queue_name = config["rabbitmq"]["service_queue_name"]
 prefetch_limit = config["rabbitmq"]["prefetchLimit"]
+sharding = config["rabbitmq"]["sharding"]
+shard_weight = config["rabbitmq"]["shard_weight"]
+shard_reap_interval = config["rabbitmq"]["shard_reap_interval_s"]
+
+SHARD_EXCHANGE_TYPE = "x-consistent-hash"
 
 
 class RabbitMqMessage(BaseModel, Generic[T]):
@@ -190,12 +210,267 @@ class RabbitMqMessageSender(RabbitMqConnectionManager):
         )
 
 
+class ShardMember(BaseModel):
+    """a shard queue in the ring, and the weight it was bound with"""
+
+    queue: str
+    weight: int
+
+
+def shard_key(body: bytes) -> str:
+    """routing key used to pick a shard for a message, the md5 of its file"""
+    try:
+        md5 = json.loads(body).get("md5")
+    except (ValueError, AttributeError):
+        md5 = None
+    return md5 if isinstance(md5, str) else ""
+
+
 class RabbitMqMessageReceiver(RabbitMqConnectionManager):
     def __init__(
-        self, queue_name: str, durable: bool = True, auto_acknowledge: bool = False
+        self,
+        queue_name: str,
+        durable: bool = True,
+        auto_acknowledge: bool = False,
+        sharded: bool = sharding,
     ):
         super().__init__(queue_name, durable)
         self.auto_acknowledge = auto_acknowledge
+        self.sharded = sharded
+        # read when created, supervised workers each take their own replica id
+        replica_id = config["rabbitmq"]["replica_id"]
+        if sharded and not replica_id:
+            raise ValueError("RABBIT_MQ_REPLICA_ID must be set when sharding")
+        self.shard_exchange_name = f"{queue_name}.shards"
+        self.shard_queue_name = f"{queue_name}.shard.{replica_id}"
+        # every shard queue that joined the ring, so orphaned ones can be found
+        self.shard_members_name = f"{queue_name}.shards.members"
+        self.shard_exchange: Optional[AbstractExchange] = None
+        self.shard_queue: Optional[AbstractQueue] = None
+        self._consumer_tags: List[Tuple[AbstractQueue, str]] = []
+        self._idle_shards: Set[str] = set()
+        self._tend_task: Optional[asyncio.Task] = None
+
+    async def _join_shard_ring(self) -> AbstractQueue:
+        """
+        Declare this replica's shard queue and bind it to the consistent hash
+        exchange. New messages are spread over the bound replicas by md5, so
+        replicas joining or leaving only move the share of md5s next to them.
+        """
+        logger = get_logger("RabbitMqMessageReceiver/join_shard_ring")
+        channel = self.connection.channel
+        self.shard_exchange = await channel.declare_exchange(
+            self.shard_exchange_name, SHARD_EXCHANGE_TYPE, durable=True
+        )
+        self.shard_queue = await channel.declare_queue(
+            self.shard_queue_name,
+            durable=True,
+            arguments={
+                "x-dead-letter-exchange": "img.dlx",
+                "x-dead-letter-routing-key": f"{self.queue_name}.dead",
+            },
+        )
+        await self.shard_queue.bind(self.shard_exchange, routing_key=str(shard_weight))
+        await channel.declare_queue(self.shard_members_name, durable=True)
+        await self._register(
+            ShardMember(queue=self.shard_queue_name, weight=shard_weight)
+        )
+        logger.info(
+            f"joined shard ring {self.shard_exchange_name} as {self.shard_queue_name}"
+        )
+        return self.shard_queue
+
+    async def _register(self, member: ShardMember):
+        await self.connection.channel.default_exchange.publish(
+            aio_pika.Message(
+                body=member.model_dump_json().encode("utf-8"),
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            ),
+            routing_key=self.shard_members_name,
+        )
+
+    async def _hand_back(self, queue: AbstractQueue) -> int:
+        """move every message waiting in a shard queue back to the service queue"""
+        handed_back = 0
+        while message := await queue.get(no_ack=False, fail=False):
+            await self.connection.channel.default_exchange.publish(
+                aio_pika.Message(
+                    body=message.body,
+                    headers=message.headers,
+                    content_type=message.content_type,
+                    delivery_mode=message.delivery_mode,
+                ),
+                routing_key=self.queue_name,
+            )
+            await message.ack()
+            handed_back += 1
+        return handed_back
+
+    async def _consumer_count(self, queue_name: str) -> Optional[int]:
+        """consumers of a queue, None if it no longer exists"""
+        # a missing queue closes the channel, so it is looked up on its own
+        async with self.connection.connection.channel() as probe:
+            try:
+                queue = await probe.declare_queue(queue_name, passive=True)
+            except ChannelNotFoundEntity:
+                return None
+            return queue.declaration_result.consumer_count
+
+    async def _reap_shard(self, member: ShardMember) -> int:
+        async with self.connection.connection.channel() as probe:
+            try:
+                queue = await probe.declare_queue(member.queue, passive=True)
+            except ChannelNotFoundEntity:
+                return 0
+            if queue.declaration_result.consumer_count:
+                # its replica came back
+                return 0
+            await queue.unbind(self.shard_exchange_name, routing_key=str(member.weight))
+            handed_back = await self._hand_back(queue)
+            await queue.delete(if_unused=True, if_empty=True)
+            return handed_back
+
+    async def reap_shard_ring(self) -> List[str]:
+        """
+        Take the shard queues of replicas that crashed, or were replaced by one with
+        another id, out of the ring and hand their messages back to the service
+        queue to be routed to the replicas left. A queue is reaped once it has had
+        no consumer on two passes in a row. Returns the names of the queues reaped.
+        """
+        logger = get_logger("RabbitMqMessageReceiver/reap_shard_ring")
+        members_queue = await self.connection.channel.declare_queue(
+            self.shard_members_name, durable=True
+        )
+        taken: List[AbstractIncomingMessage] = []
+        members: Dict[str, ShardMember] = {
+            self.shard_queue_name: ShardMember(
+                queue=self.shard_queue_name, weight=shard_weight
+            )
+        }
+        try:
+            while message := await members_queue.get(no_ack=False, fail=False):
+                taken.append(message)
+                try:
+                    member = ShardMember.model_validate_json(message.body)
+                except ValidationError:
+                    continue
+                members.setdefault(member.queue, member)
+
+            idle: Set[str] = set()
+            reaped: List[str] = []
+            for name, member in members.items():
+                consumers = (
+                    1
+                    if name == self.shard_queue_name
+                    else await self._consumer_count(name)
+                )
+                if consumers is None:
+                    continue
+                if consumers == 0 and name in self._idle_shards:
+                    handed_back = await self._reap_shard(member)
+                    logger.info(
+                        f"reaped shard queue {name}, handed back {handed_back} messages"
+                    )
+                    reaped.append(name)
+                    continue
+                if consumers == 0:
+                    idle.add(name)
+                await self._register(member)
+            self._idle_shards = idle
+        except Exception:
+            for message in taken:
+                await message.nack(requeue=True)
+            raise
+        for message in taken:
+            await message.ack()
+        return reaped
+
+    async def _tend_shard_ring(self):
+        logger = get_logger("RabbitMqMessageReceiver/tend_shard_ring")
+        while True:
+            await asyncio.sleep(shard_reap_interval)
+            try:
+                # rebinding is harmless, and heals a binding reaped while this replica
+                # was reconnecting
+                await self.shard_queue.bind(
+                    self.shard_exchange, routing_key=str(shard_weight)
+                )
+                await self.reap_shard_ring()
+            except Exception as e:
+                logger.warning(f"failed to tend shard ring: {e}")
+
+    def _stop_tending(self):
+        if self._tend_task:
+            self._tend_task.cancel()
+            self._tend_task = None
+
+    async def _route_to_shard(self, message: aio_pika.IncomingMessage):
+        """move a message from the shared service queue to the replica owning its md5"""
+        try:
+            await self.shard_exchange.publish(
+                aio_pika.Message(
+                    body=message.body,
+                    headers=message.headers,
+                    content_type=message.content_type,
+                    delivery_mode=message.delivery_mode,
+                ),
+                routing_key=shard_key(message.body),
+            )
+            await message.ack()
+        except Exception as e:
+            get_logger("RabbitMqMessageReceiver/route_to_shard").error(
+                f"failed to route message to shard: {e}"
+            )
+            await message.nack(requeue=True)
+
+    async def leave_shard_ring(self):
+        """
+        Stop receiving new messages for this replica and hand any still waiting in
+        its shard queue back to the service queue to be routed to another replica.
+        Messages in flight when the channel closes return to the shard queue and
+        are picked up when the replica rejoins.
+        """
+        self._stop_tending()
+        if self.shard_queue is None or not self.is_connected():
+            return
+        logger = get_logger("RabbitMqMessageReceiver/leave_shard_ring")
+        await self.shard_queue.unbind(
+            self.shard_exchange, routing_key=str(shard_weight)
+        )
+        for queue, tag in self._consumer_tags:
+            await queue.cancel(tag)
+        self._consumer_tags = []
+
+        handed_back = await self._hand_back(self.shard_queue)
+        try:
+            await self.shard_queue.delete(if_unused=False, if_empty=True)
+        except Exception as e:
+            logger.warning(f"shard queue {self.shard_queue_name} kept: {e}")
+        logger.info(
+            f"left shard ring {self.shard_exchange_name}, handed back {handed_back} messages"
+        )
+        self.shard_queue = None
+
+    async def stop_consuming(self):
+        """
+        Stop new messages being delivered, messages already received can still be
+        acked or nacked. A sharded replica also stops new md5s being routed to it.
+        """
+        self._stop_tending()
+        if not self.is_connected():
+            return
+        if self.sharded and self.shard_queue is not None:
+            await self.shard_queue.unbind(
+                self.shard_exchange, routing_key=str(shard_weight)
+            )
+        for queue, tag in self._consumer_tags:
+            await queue.cancel(tag)
+        self._consumer_tags = []
+
+    async def close(self):
+        if self.sharded:
+            await self.leave_shard_ring()
+        await super().close()
 
     async def get_messages_on_queue(
         self,
@@ -227,7 +502,17 @@ class RabbitMqMessageReceiver(RabbitMqConnectionManager):
             except Exception as e:
                 logger.error(f"Error processing message: {e}")
 
-        await queue.consume(_consumer, no_ack=False)
+        if self.sharded:
+            shard_queue = await self._join_shard_ring()
+            self._consumer_tags = [
+                (queue, await queue.consume(self._route_to_shard, no_ack=False)),
+                (shard_queue, await shard_queue.consume(_consumer, no_ack=False)),
+            ]
+            self._tend_task = asyncio.create_task(self._tend_shard_ring())
+        else:
+            self._consumer_tags = [
+                (queue, await queue.consume(_consumer, no_ack=False))
+            ]
 
         # Keep the consumer alive
         logger.info("Waiting for messages...")
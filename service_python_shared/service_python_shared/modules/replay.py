@@ -0,0 +1,232 @@
+import argparse
+import asyncio
+import importlib
+import math
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from pydantic import BaseModel
+
+from service_python_shared.configs.config import config
+from service_python_shared.lib.image_header import ImageHeader
+from service_python_shared.modules.ImagePolicy import ImagePolicy
+from service_python_shared.modules.JobManagerClient import read_header
+from service_python_shared.modules.logger import get_logger, setup_logging
+from service_python_shared.modules.rabbitmq import RabbitMqMessage
+from service_python_shared.modules.traffic import TrafficArchive
+from service_python_shared.modules.Workflow import Workflow
+
+REPLAY_TOKEN = "replay"
+
+
+class ReplayReport(BaseModel):
+    speed: str
+    messages: int
+    # recorded without image data, settled before it was all streamed
+    skipped: int
+    completed: int
+    rejected: int
+    requeued: int
+    duration_s: float
+    throughput_per_s: float
+    latency_p50_ms: float
+    latency_p95_ms: float
+    latency_p99_ms: float
+    latency_max_ms: float
+
+    def summary(self) -> str:
+        return (
+            f"replayed {self.messages} messages at {self.speed} in {self.duration_s:.2f}s "
+            f"({self.throughput_per_s:.2f}/s): {self.completed} completed, "
+            f"{self.rejected} rejected, {self.requeued} requeued, "
+            f"{self.skipped} skipped without image data\n"
+            f"latency ms p50 {self.latency_p50_ms:.1f}, p95 {self.latency_p95_ms:.1f}, "
+            f"p99 {self.latency_p99_ms:.1f}, max {self.latency_max_ms:.1f}"
+        )
+
+
+class ReplayIncomingMessage:
+    """Stand-in for aio_pika.IncomingMessage, records how the message was settled"""
+
+    def __init__(self, headers: Dict[str, str]):
+        self.headers = headers
+        self.outcome: Optional[str] = None
+
+    async def ack(self):
+        self.outcome = "completed"
+
+    async def nack(self, requeue: bool = False):
+        # requeued messages are counted, not redelivered
+        self.outcome = "requeued" if requeue else "rejected"
+
+
+class ReplaySender:
+    """Stand-in for RabbitMqMessageSender, keeps what would have been published"""
+
+    def __init__(self):
+        self.sent: List[Dict[str, Any]] = []
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def send_json_message(self, queue_name: str, message: Any, **kwargs):
+        self.sent.append({"queue_name": queue_name, "message": message, **kwargs})
+
+
+class ReplayJobManagerClient:
+    """Stand-in for JobManagerClient, serves image data from the archive"""
+
+    def __init__(self, archive: TrafficArchive):
+        self.archive = archive
+        self.blobs: Dict[str, str] = {}
+
+    async def connect(self):
+        pass
+
+    async def close_grpc_socket(self):
+        pass
+
+    async def get_image_data(
+        self,
+        image_source: str,
+        corr_id: str,
+        jwe_token: str,
+        image_policy: Optional[ImagePolicy] = None,
+        on_header: Optional[Callable[[Optional[ImageHeader]], Awaitable[None]]] = None,
+    ) -> bytes:
+        image_data = self.archive.read_blob(self.blobs[corr_id])
+        # give other messages a turn, as the gRPC stream would
+        await asyncio.sleep(0)
+        head = image_data[: image_policy.sniff_bytes if image_policy else 262144]
+        if image_policy:
+            image_policy.inspect(head, final=True)
+        if on_header:
+            await on_header(read_header(head))
+        return image_data
+
+
+async def replay(
+    workflow: Workflow,
+    archive: TrafficArchive,
+    speed: Optional[float] = 1.0,
+    concurrency: int = config["rabbitmq"]["prefetchLimit"],
+) -> ReplayReport:
+    """
+    Replay an archive through a workflow's message handler with in-process broker
+    and gRPC stand-ins. speed scales the recorded gaps between messages (2 is twice
+    as fast), None sends everything at once. Up to concurrency messages are handled
+    at a time, like the prefetch limit. Latency is measured from when a message was
+    due to when it was acked or nacked, so includes time waiting for a slot. Only
+    messages recorded with their image data are replayed.
+    """
+    recorded = list(archive.messages())
+    entries = sorted(
+        (entry for entry in recorded if entry.blob is not None),
+        key=lambda entry: entry.received,
+    )
+    if not entries:
+        raise ValueError(f"no image data recorded in {archive.path}")
+
+    client = ReplayJobManagerClient(archive)
+    workflow.jobManagerClient = client
+    workflow.sender = ReplaySender()
+    workflow.recorder = None
+
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(concurrency)
+    outcomes: List[str] = []
+    latencies: List[float] = []
+    first = entries[0].received
+    started = loop.time()
+
+    async def send(index: int, entry):
+        due = started + ((entry.received - first) / speed if speed else 0)
+        await asyncio.sleep(max(due - loop.time(), 0))
+        corr_id = f"{entry.corr_id}-replay-{index}"
+        client.blobs[corr_id] = entry.blob
+        headers = {"x-correlation-id": corr_id}
+        if entry.authorized:
+            headers["authorization"] = REPLAY_TOKEN
+        message = ReplayIncomingMessage(headers)
+        async with slots:
+            data = RabbitMqMessage[Any].model_validate(entry.message)
+            await workflow.handle_incoming_message(data, message)
+        latencies.append((loop.time() - due) * 1000)
+        outcomes.append(message.outcome or "requeued")
+
+    await asyncio.gather(*(send(i, entry) for i, entry in enumerate(entries)))
+
+    duration = loop.time() - started
+    return ReplayReport(
+        speed=f"{speed}x" if speed else "max",
+        messages=len(entries),
+        skipped=len(recorded) - len(entries),
+        completed=outcomes.count("completed"),
+        rejected=outcomes.count("rejected"),
+        requeued=outcomes.count("requeued"),
+        duration_s=duration,
+        throughput_per_s=len(entries) / duration if duration else 0.0,
+        latency_p50_ms=percentile(latencies, 50),
+        latency_p95_ms=percentile(latencies, 95),
+        latency_p99_ms=percentile(latencies, 99),
+        latency_max_ms=max(latencies),
+    )
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q / 100 * len(ordered)) - 1, 0)]
+
+
+def load_extractor(path: str):
+    module_name, _, attribute = path.partition(":")
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Replay recorded traffic against a service's extract_data"
+    )
+    parser.add_argument("archive", help="directory recorded with TRAFFIC_RECORD_DIR")
+    parser.add_argument(
+        "--extract",
+        required=True,
+        help="extract function as module:function, ie. modules.detect_faces:detect_faces",
+    )
+    parser.add_argument(
+        "--speed",
+        default=["1"],
+        nargs="+",
+        help="one or more replay speeds, a multiplier or 'max' for as fast as possible",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=config["rabbitmq"]["prefetchLimit"]
+    )
+    args = parser.parse_args()
+
+    setup_logging()
+    logger = get_logger("replay")
+    extract_data = load_extractor(args.extract)
+    archive = TrafficArchive(args.archive)
+    reports: List[ReplayReport] = []
+    for speed in args.speed:
+        workflow = Workflow(
+            description=f"replay {args.extract}", extract_data=extract_data
+        )
+        report = await replay(
+            workflow,
+            archive,
+            speed=None if speed == "max" else float(speed),
+            concurrency=args.concurrency,
+        )
+        logger.info(report.summary())
+        reports.append(report)
+
+    for report in reports:
+        print(report.summary())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, Mapping, Optional
+
+from pydantic import BaseModel
+
+from service_python_shared.configs.config import TrafficSettings, config
+from service_python_shared.lib.utils import decode_header
+from service_python_shared.modules.logger import get_logger
+from service_python_shared.modules.rabbitmq import RabbitMqMessage
+
+INDEX_FILE = "messages.jsonl"
+BLOBS_DIR = "blobs"
+
+
+class RecordedMessage(BaseModel):
+    # unix time the message was received, replay keeps the gaps between messages
+    received: float
+    corr_id: Optional[str]
+    # whether the message carried a token, the token itself is never recorded
+    authorized: bool = True
+    # sha1 of the image data, stored once in blobs/ however often it is seen, None
+    # if the message was settled before all of it was streamed
+    blob: Optional[str] = None
+    # "completed", "rejected" or "requeued", None if handling it failed unexpectedly
+    outcome: Optional[str] = None
+    reason: Optional[str] = None
+    message: Dict[str, Any]
+
+
+class Recording:
+    """A message being recorded, written to the archive once it has been settled"""
+
+    def __init__(self, entry: RecordedMessage):
+        self.entry = entry
+        self.image_data: Optional[bytes] = None
+
+    def settle(self, outcome: str, reason: Optional[str] = None):
+        self.entry.outcome = outcome
+        self.entry.reason = reason
+
+
+class TrafficArchive:
+    """
+    A directory holding an index of message envelopes, one JSON object per line,
+    and the image data they streamed stored by content hash so that duplicates
+    are only kept once. Credentials are never recorded.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.index_path = self.path / INDEX_FILE
+        self.blobs_path = self.path / BLOBS_DIR
+
+    def blob_path(self, blob: str) -> Path:
+        return self.blobs_path / blob
+
+    def write(self, entry: RecordedMessage, image_data: Optional[bytes] = None):
+        self.path.mkdir(parents=True, exist_ok=True)
+        if image_data is not None:
+            entry.blob = hashlib.sha1(image_data).hexdigest()
+            self.blobs_path.mkdir(exist_ok=True)
+            blob_path = self.blob_path(entry.blob)
+            if not blob_path.exists():
+                blob_path.write_bytes(image_data)
+        with self.index_path.open("a", encoding="utf-8") as index:
+            index.write(entry.model_dump_json() + "\n")
+
+    def messages(self) -> Iterator[RecordedMessage]:
+        with self.index_path.open(encoding="utf-8") as index:
+            for line in index:
+                if line.strip():
+                    yield RecordedMessage.model_validate_json(line)
+
+    def read_blob(self, blob: str) -> bytes:
+        return self.blob_path(blob).read_bytes()
+
+
+class TrafficRecorder:
+    """
+    Samples messages as they are received. Hashing and writing are left to a
+    single writer thread, in the order messages are settled, so the event loop
+    never waits on the disk.
+    """
+
+    def __init__(self, archive: TrafficArchive, sample_rate: float, max_messages: int):
+        self.archive = archive
+        self.sample_rate = sample_rate
+        self.max_messages = max_messages
+        self.recorded = 0
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="traffic")
+
+    @classmethod
+    def from_config(
+        cls, settings: Optional[TrafficSettings] = None
+    ) -> Optional["TrafficRecorder"]:
+        settings = settings or config["traffic"]
+        if not settings["record_dir"]:
+            return None
+        get_logger("TrafficRecorder/from_config").warning(
+            f"recording messages and image data to {settings['record_dir']}"
+        )
+        return cls(
+            TrafficArchive(settings["record_dir"]),
+            settings["record_sample_rate"],
+            settings["record_max_messages"],
+        )
+
+    def start(
+        self, data: RabbitMqMessage, headers: Mapping[str, Any]
+    ) -> Optional[Recording]:
+        """Record a message as it is received, None if it isn't sampled"""
+        if self.recorded >= self.max_messages:
+            return None
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+        self.recorded += 1
+        return Recording(
+            RecordedMessage(
+                received=time.time(),
+                corr_id=decode_header(headers.get("x-correlation-id")),
+                authorized=headers.get("authorization") is not None,
+                message=json.loads(data.model_dump_json(by_alias=True)),
+            )
+        )
+
+    def finish(self, recording: Recording):
+        self.writer.submit(self._write, recording.entry, recording.image_data)
+
+    def _write(self, entry: RecordedMessage, image_data: Optional[bytes]):
+        try:
+            self.archive.write(entry, image_data)
+        except OSError as e:
+            get_logger("TrafficRecorder/write", corr_id=entry.corr_id).error(
+                f"failed to record message for {entry.message.get('filepath')}: {e}"
+            )
+
+    def close(self):
+        """Blocks until everything finished so far is written"""
+        self.writer.shutdown(wait=True)
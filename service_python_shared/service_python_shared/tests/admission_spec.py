@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+
+from service_python_shared.lib import decoding
+from service_python_shared.lib.image_header import ImageHeader
+from service_python_shared.modules.AdmissionController import (
+    MB,
+    AdmissionController,
+    PilImage,
+    apply_decoder_pixel_limits,
+)
+from service_python_shared.modules.Workflow import Workflow
+
+
+def header(width: int, height: int) -> ImageHeader:
+    return ImageHeader(format="jpeg", width=width, height=height)
+
+
+def test_estimate_from_header():
+    controller = AdmissionController(
+        budget_bytes=100 * MB, bytes_per_pixel=3, unknown_estimate_bytes=7 * MB
+    )
+    assert controller.estimate(header(1000, 1000)) == 3_000_000
+    assert controller.estimate(ImageHeader(format="heif")) == 7 * MB
+    assert controller.estimate(None) == 7 * MB
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_waits_until_memory_is_released():
+    controller = AdmissionController(budget_bytes=10, bytes_per_pixel=1)
+    order = []
+
+    async def handle(name: str, pixels: int, hold: asyncio.Event):
+        async with controller.reserve(name) as reservation:
+            await reservation.admit(header(pixels, 1))
+            order.append(name)
+            await hold.wait()
+
+    first, second = asyncio.Event(), asyncio.Event()
+    tasks = [
+        asyncio.create_task(handle("first", 8, first)),
+        asyncio.create_task(handle("second", 8, second)),
+    ]
+    await asyncio.sleep(0.01)
+    assert order == ["first"]
+    assert controller.stats().waiting == 1
+
+    first.set()
+    await asyncio.sleep(0.01)
+    assert order == ["first", "second"]
+    second.set()
+    await asyncio.gather(*tasks)
+
+    stats = controller.stats()
+    assert (stats.in_flight, stats.in_flight_bytes, stats.peak_bytes) == (0, 0, 8)
+    assert (stats.admitted, stats.delayed) == (2, 1)
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_over_budget_image_runs_alone_and_is_not_starved():
+    controller = AdmissionController(budget_bytes=10, bytes_per_pixel=1)
+    order = []
+    release = asyncio.Event()
+
+    async def handle(name: str, pixels: int):
+        async with controller.reserve(name) as reservation:
+            await reservation.admit(header(pixels, 1))
+            order.append(name)
+            if name == "small":
+                await release.wait()
+
+    tasks = [asyncio.create_task(handle("small", 4))]
+    await asyncio.sleep(0.01)
+    tasks.append(asyncio.create_task(handle("huge", 50)))
+    await asyncio.sleep(0.01)
+    # would fit next to "small", but must not overtake the waiting huge image
+    tasks.append(asyncio.create_task(handle("later", 4)))
+    await asyncio.sleep(0.01)
+    assert order == ["small"]
+
+    release.set()
+    await asyncio.gather(*tasks)
+    assert order == ["small", "huge", "later"]
+    assert controller.stats().serialised == 1
+    assert controller.stats().peak_bytes == 50
+
+
+@pytest.mark.asyncio
+async def test_reservation_not_admitted_releases_nothing():
+    controller = AdmissionController(budget_bytes=10)
+    with pytest.raises(ValueError):
+        async with controller.reserve("rejected"):
+            raise ValueError("rejected before the header was read")
+    assert controller.stats().in_flight == 0
+
+
+def test_decoder_pixel_limits_applied(monkeypatch):
+    monkeypatch.setattr(decoding, "MAX_IMAGE_PIXELS", 0)
+    if PilImage is not None:
+        monkeypatch.setattr(PilImage, "MAX_IMAGE_PIXELS", PilImage.MAX_IMAGE_PIXELS)
+    apply_decoder_pixel_limits(0)
+    assert decoding.MAX_IMAGE_PIXELS == 0
+    apply_decoder_pixel_limits(5000)
+    assert decoding.MAX_IMAGE_PIXELS == 5000
+
+
+def test_workflow_limit_overrides_the_configured_one(monkeypatch):
+    monkeypatch.setattr(decoding, "MAX_IMAGE_PIXELS", 0)
+    if PilImage is not None:
+        monkeypatch.setattr(PilImage, "MAX_IMAGE_PIXELS", PilImage.MAX_IMAGE_PIXELS)
+    workflow = Workflow(
+        description="large images", extract_data=len, max_pixels=600_000_000
+    )
+    assert workflow.image_policy.max_pixels == 600_000_000
+    assert decoding.MAX_IMAGE_PIXELS == 600_000_000
@@ -0,0 +1,241 @@
+import struct
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+import pytest
+
+from service_python_shared.lib import decoding
+from service_python_shared.lib.decoding import (
+    ORIENTATIONS,
+    apply_orientation,
+    choose_sources,
+    decode_image,
+    image_sources,
+    pixel_view,
+)
+
+# (tag, type, values), type 4 is LONG, 3 SHORT and 7 UNDEFINED bytes
+Tag = Tuple[int, int, object]
+
+
+def jpeg(width: int, height: int) -> bytes:
+    # a gradient, so every orientation decodes differently
+    x = np.linspace(0, 255, width, dtype=np.uint8)
+    y = np.linspace(0, 255, height, dtype=np.uint8)
+    image = np.dstack(
+        [
+            np.add.outer(y, x * 0),
+            np.add.outer(y * 0, x),
+            np.zeros((height, width), np.uint8),
+        ]
+    )
+    ok, encoded = cv2.imencode(".jpg", image)
+    assert ok
+    return encoded.tobytes()
+
+
+def tiff_ifd(tags: List[Tag], offset: int, next_ifd: int = 0) -> bytes:
+    """a little endian IFD to be placed at offset, its values follow it"""
+    extra = b""
+    entries = b""
+    values_offset = offset + 2 + len(tags) * 12 + 4
+    for tag, field_type, value in tags:
+        if field_type == 7:
+            raw = value
+        else:
+            raw = struct.pack(
+                "<" + ("H" if field_type == 3 else "I") * len(value), *value
+            )
+        count = len(raw) if field_type == 7 else len(value)
+        if len(raw) <= 4:
+            entries += struct.pack("<HHI", tag, field_type, count) + raw.ljust(4, b"\0")
+        else:
+            entries += struct.pack(
+                "<HHII", tag, field_type, count, values_offset + len(extra)
+            )
+            extra += raw
+    return struct.pack("<H", len(tags)) + entries + struct.pack("<I", next_ifd) + extra
+
+
+def with_exif(primary: bytes, orientation: int, thumbnail: bytes) -> bytes:
+    """the primary JPEG with an EXIF APP1 holding orientation and a thumbnail"""
+    ifd0 = tiff_ifd([(0x0112, 3, [orientation])], 8, next_ifd=26)
+    thumbnail_offset = 26 + 2 + 2 * 12 + 4
+    ifd1 = tiff_ifd(
+        [(0x0201, 4, [thumbnail_offset]), (0x0202, 4, [len(thumbnail)])], 26
+    )
+    tiff = b"II*\x00" + struct.pack("<I", 8) + ifd0 + ifd1 + thumbnail
+    app1 = b"Exif\x00\x00" + tiff
+    return (
+        primary[:2]
+        + b"\xff\xe1"
+        + struct.pack(">H", len(app1) + 2)
+        + app1
+        + primary[2:]
+    )
+
+
+def with_mpf_preview(primary: bytes, preview: bytes) -> bytes:
+    """the primary JPEG with a multi-picture format index and a preview after it"""
+
+    def app2(preview_offset: int) -> bytes:
+        entries = struct.pack("<IIIHH", 0x20030000, 0, 0, 0, 0)
+        entries += struct.pack("<IIIHH", 0x00020002, len(preview), preview_offset, 0, 0)
+        ifd = tiff_ifd(
+            [(0xB000, 7, b"0100"), (0xB001, 4, [2]), (0xB002, 7, entries)], 8
+        )
+        segment = b"MPF\x00" + b"II*\x00" + struct.pack("<I", 8) + ifd
+        return b"\xff\xe2" + struct.pack(">H", len(segment) + 2) + segment
+
+    # offsets are from the MPF TIFF header, 8 bytes into the segment
+    size = len(app2(0))
+    mpf_start = 2 + 8
+    preview_offset = len(primary) + size - mpf_start
+    return primary[:2] + app2(preview_offset) + primary[2:] + preview
+
+
+def raw_like_tiff(preview: bytes, size: int = 8, compression: int = 1) -> bytes:
+    """a TIFF with an uncompressed image and a JPEG preview in its second IFD"""
+    pixels = bytes(8 * 8 * 3)
+
+    def ifd0(pixels_offset: int, next_ifd: int) -> bytes:
+        tags = [
+            (256, 4, [size]),
+            (257, 4, [size]),
+            (258, 3, [8, 8, 8]),
+            (259, 3, [compression]),
+            (262, 3, [2]),
+            (273, 4, [pixels_offset]),
+            (277, 3, [3]),
+            (278, 4, [8]),
+            (279, 4, [len(pixels)]),
+        ]
+        return tiff_ifd(tags, 8, next_ifd)
+
+    def ifd1(offset: int, preview_offset: int) -> bytes:
+        tags = [(0x0201, 4, [preview_offset]), (0x0202, 4, [len(preview)])]
+        return tiff_ifd(tags, offset)
+
+    # sizes do not depend on the offsets, so lay out with placeholders first
+    ifd1_offset = 8 + len(ifd0(0, 0))
+    preview_offset = ifd1_offset + len(ifd1(0, 0))
+    pixels_offset = preview_offset + len(preview)
+    return (
+        b"II*\x00"
+        + struct.pack("<I", 8)
+        + ifd0(pixels_offset, ifd1_offset)
+        + ifd1(ifd1_offset, preview_offset)
+        + preview
+        + pixels
+    )
+
+
+def test_orientations_match_the_decoder():
+    primary = jpeg(64, 32)
+    for orientation in ORIENTATIONS:
+        data = with_exif(primary, orientation, jpeg(16, 8))
+        upright = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        unrotated = cv2.imdecode(
+            np.frombuffer(data, np.uint8),
+            cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION,
+        )
+        assert np.array_equal(apply_orientation(unrotated, orientation), upright), (
+            orientation
+        )
+
+
+def test_exif_thumbnail_used_when_large_enough():
+    data = with_exif(jpeg(2000, 1000), 6, jpeg(160, 80))
+    sources = image_sources(data)
+    assert sources[0].kind == "primary" and sources[0].long_edge == 2000
+    assert {(s.kind, s.long_edge) for s in sources} >= {
+        ("thumbnail", 160),
+        ("primary", 250),
+    }
+
+    # rotated as the primary image would be
+    assert decode_image(data, min_size=100).shape == (160, 80, 3)
+    # too small for the thumbnail, the primary decoded at 1/8 scale
+    assert decode_image(data, min_size=200).shape == (250, 125, 3)
+    assert decode_image(data).shape == (2000, 1000, 3)
+
+
+def test_mpf_preview_cheaper_than_huge_primary():
+    data = with_mpf_preview(jpeg(4000, 3000), jpeg(1600, 1200))
+    chosen = choose_sources(image_sources(data), min_size=384)[0]
+    assert (chosen.kind, chosen.scale) == ("preview", 4)
+    assert decode_image(data, min_size=384).shape == (300, 400, 3)
+
+
+def test_raw_preview_found_in_tiff():
+    data = raw_like_tiff(jpeg(640, 480))
+    previews = [s for s in image_sources(data) if s.kind == "preview"]
+    assert {(s.scale, s.long_edge) for s in previews} == {
+        (1, 640),
+        (2, 320),
+        (4, 160),
+        (8, 80),
+    }
+    assert decode_image(data, min_size=300).shape == (240, 320, 3)
+    # the preview is larger than the primary, as in RAW files with a thumbnail first
+    assert decode_image(data).shape == (480, 640, 3)
+
+
+def test_falls_back_when_primary_cannot_be_decoded():
+    # a compression no decoder knows, like the raw data of a camera RAW file
+    data = raw_like_tiff(jpeg(640, 480), size=4000, compression=34892)
+    assert decode_image(data, min_size=384).shape == (480, 640, 3)
+    # at full resolution a smaller preview would not match the image's coordinates
+    with pytest.raises(ValueError):
+        decode_image(data)
+
+
+def test_no_thumbnail_for_a_corrupt_primary_at_full_resolution():
+    data = with_exif(jpeg(2000, 1000), 1, jpeg(160, 80))
+    truncated = data[: len(data) // 2]
+    with pytest.raises(ValueError):
+        decode_image(truncated)
+    assert decode_image(truncated, min_size=100).shape == (80, 160, 3)
+
+
+def test_undecodable_data_raises():
+    with pytest.raises(ValueError):
+        decode_image(b"\xff\xd8\xff\xe0 not really a jpeg")
+
+
+@pytest.mark.parametrize(
+    "extension,params,gray",
+    [
+        (".bmp", [], False),
+        (".tiff", [cv2.IMWRITE_TIFF_COMPRESSION, 1], False),
+        (".tiff", [cv2.IMWRITE_TIFF_COMPRESSION, 1], True),
+    ],
+)
+def test_pixel_view_of_uncompressed_images(extension, params, gray):
+    image = cv2.imdecode(np.frombuffer(jpeg(301, 203), np.uint8), cv2.IMREAD_COLOR)
+    if gray:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    ok, encoded = cv2.imencode(extension, image, params)
+    assert ok
+    data = encoded.tobytes()
+
+    view = pixel_view(data)
+    decoded = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    assert (view.width, view.height) == (301, 203)
+    assert np.array_equal(view.region(17, 30, 250, 190), decoded[30:190, 17:250])
+
+
+def test_no_pixel_view_of_compressed_images():
+    assert pixel_view(jpeg(64, 64)) is None
+    ok, encoded = cv2.imencode(".tiff", np.zeros((8, 8, 3), np.uint8))
+    assert pixel_view(encoded.tobytes()) is None
+
+
+def test_images_over_the_pixel_limit_are_not_decoded(monkeypatch):
+    monkeypatch.setattr(decoding, "MAX_IMAGE_PIXELS", 1_000_000)
+    data = jpeg(2000, 1000)
+    with pytest.raises(ValueError, match="over the limit"):
+        decode_image(data)
+    # a reduced scale decode fits
+    assert decode_image(data, min_size=500).shape == (250, 500, 3)
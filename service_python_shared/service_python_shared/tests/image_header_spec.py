@@ -0,0 +1,99 @@
+import cv2
+import numpy as np
+import pytest
+
+from service_python_shared.lib.image_header import sniff_image_header
+from service_python_shared.modules.ImagePolicy import ImagePolicy, ImageRejectedError
+
+WIDTH = 120
+HEIGHT = 80
+
+
+def encode(extension: str, width: int = WIDTH, height: int = HEIGHT) -> bytes:
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    ok, encoded = cv2.imencode(extension, image)
+    assert ok
+    return encoded.tobytes()
+
+
+@pytest.mark.parametrize(
+    "extension,image_format",
+    [
+        (".jpg", "jpeg"),
+        (".png", "png"),
+        (".webp", "webp"),
+        (".bmp", "bmp"),
+        (".tiff", "tiff"),
+    ],
+)
+def test_sniff_reads_format_and_dimensions(extension, image_format):
+    header = sniff_image_header(encode(extension))
+    assert header.format == image_format
+    assert (header.width, header.height) == (WIDTH, HEIGHT)
+
+
+def test_sniff_waits_for_more_data():
+    data = encode(".jpg")
+    assert sniff_image_header(data[:2]) is None
+    partial = sniff_image_header(data[:4])
+    assert partial.format == "jpeg"
+    assert partial.width is None
+
+
+def test_sniff_skips_extraneous_bytes_between_jpeg_segments():
+    data = encode(".jpg")
+    # after the APP0 segment, as written by some cameras and editors
+    end = 4 + int.from_bytes(data[4:6], "big")
+    header = sniff_image_header(data[:end] + b"\x00\x00" + data[end:])
+    assert (header.width, header.height) == (WIDTH, HEIGHT)
+
+
+def test_sniff_raises_on_corrupt_header():
+    data = bytearray(encode(".png"))
+    data[12:16] = b"XXXX"
+    with pytest.raises(ValueError):
+        sniff_image_header(bytes(data))
+
+
+def test_policy_accepts_valid_image_from_first_chunk():
+    policy = ImagePolicy(allowed_formats=["jpeg"], min_width=16, min_height=16)
+    assert policy.inspect(encode(".jpg")[:1024]) is True
+
+
+def test_policy_rejects_out_of_policy_images():
+    policy = ImagePolicy(
+        allowed_formats=["jpeg", "png"], min_width=16, min_height=16, max_pixels=5000
+    )
+    with pytest.raises(ImageRejectedError, match="too small"):
+        policy.inspect(encode(".png", width=1, height=1))
+    with pytest.raises(ImageRejectedError, match="too large"):
+        policy.inspect(encode(".png"))
+    with pytest.raises(ImageRejectedError, match="unsupported"):
+        policy.inspect(encode(".bmp", width=20, height=20))
+    with pytest.raises(ImageRejectedError, match="unknown"):
+        policy.inspect(b"not an image at all")
+
+
+def test_configured_policy_accepts_any_format():
+    policy = ImagePolicy.from_config()
+    assert policy.inspect(encode(".gif")) is True
+    # PPM, TGA and the like aren't recognised but are left for the decoder
+    ok, ppm = cv2.imencode(".ppm", np.zeros((20, 20, 3), dtype=np.uint8))
+    assert ok
+    assert policy.inspect(ppm.tobytes()) is True
+
+
+def test_configured_policy_rejects_formats_that_never_decode():
+    policy = ImagePolicy.from_config()
+    with pytest.raises(ImageRejectedError, match="heif"):
+        policy.inspect(b"\x00\x00\x00\x18ftypheic" + bytes(16))
+    with pytest.raises(ImageRejectedError, match="avif"):
+        policy.inspect(b"\x00\x00\x00\x18ftypavif" + bytes(16))
+
+
+def test_policy_decides_when_stream_ends():
+    policy = ImagePolicy(allowed_formats=["jpeg"])
+    assert policy.inspect(b"\xff\xd8\xff") is False
+    assert policy.inspect(b"\xff\xd8\xff", final=True) is True
+    with pytest.raises(ImageRejectedError):
+        policy.inspect(b"", final=True)
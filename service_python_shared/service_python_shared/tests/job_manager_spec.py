@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+
+from service_python_shared.modules.ImagePolicy import ImagePolicy, ImageRejectedError
+from service_python_shared.modules.JobManagerClient import JobManagerClient
+
+
+class FakeCall:
+    """Streams the given chunks the way a gRPC response stream does"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.read = 0
+        self.cancelled = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.cancelled or self.read == len(self.chunks):
+            raise StopAsyncIteration
+        self.read += 1
+        return SimpleNamespace(data=self.chunks[self.read - 1])
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def stream(monkeypatch, data: bytes, chunk_size: int) -> FakeCall:
+    call = FakeCall([data[i : i + chunk_size] for i in range(0, len(data), chunk_size)])
+    client = SimpleNamespace(getData=lambda request, metadata: call)
+    monkeypatch.setattr(JobManagerClient, "_client", client)
+    return call
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_rejected_image_cancels_the_stream(monkeypatch):
+    ok, image = cv2.imencode(".png", np.zeros((100, 100, 3), dtype=np.uint8))
+    assert ok
+    call = stream(monkeypatch, image.tobytes(), chunk_size=64)
+    policy = ImagePolicy(allowed_formats=[], max_pixels=5000)
+
+    with pytest.raises(ImageRejectedError, match="too large"):
+        await JobManagerClient.get_image_data(
+            "big.png", "corr", "token", image_policy=policy
+        )
+
+    assert call.cancelled
+    # the header is in the first chunk so nothing more was read
+    assert call.read == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_accepted_image_is_read_whole(monkeypatch):
+    ok, image = cv2.imencode(".png", np.zeros((50, 50, 3), dtype=np.uint8))
+    assert ok
+    call = stream(monkeypatch, image.tobytes(), chunk_size=64)
+    policy = ImagePolicy(allowed_formats=[], max_pixels=5000)
+
+    data = await JobManagerClient.get_image_data(
+        "small.png", "corr", "token", image_policy=policy
+    )
+
+    assert data == image.tobytes()
+    assert not call.cancelled
@@ -0,0 +1,105 @@
+import cProfile
+import pstats
+import threading
+import time
+
+from service_python_shared.modules.profiler import Profiler
+
+CORR_ID = "test/corr-id"
+
+
+def make_profiler(tmp_path, **overrides) -> Profiler:
+    settings = {
+        "output_dir": str(tmp_path),
+        "mode": "cprofile",
+        "sample_rate": 0.0,
+        "sample_interval_ms": 1,
+        "allow_header": True,
+        "signal_count": 2,
+    }
+    settings.update(overrides)
+    return Profiler(settings)
+
+
+def busy_work():
+    deadline = time.perf_counter() + 0.05
+    while time.perf_counter() < deadline:
+        sum(range(1000))
+
+
+def test_should_profile_only_when_asked(tmp_path):
+    profiler = make_profiler(tmp_path)
+    assert profiler.should_profile({}) is False
+    assert profiler.should_profile({"x-profile": b"true"}) is True
+    assert profiler.should_profile({"x-profile": "0"}) is False
+
+    profiler.arm()
+    assert [profiler.should_profile({}) for _ in range(3)] == [True, True, False]
+
+    assert make_profiler(tmp_path, sample_rate=1.0).should_profile({}) is True
+    no_header = make_profiler(tmp_path, allow_header=False)
+    assert no_header.should_profile({"x-profile": "true"}) is False
+
+
+def test_disabled_stage_writes_nothing(tmp_path):
+    profiler = make_profiler(tmp_path)
+    with profiler.stage(CORR_ID, "extract_data", False):
+        busy_work()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_cprofile_stage_writes_pstats(tmp_path):
+    profiler = make_profiler(tmp_path)
+    with profiler.stage(CORR_ID, "extract_data", True):
+        busy_work()
+    path = tmp_path / "test_corr-id" / "extract_data.pstats"
+    stats = pstats.Stats(str(path))
+    assert any(func[2] == "busy_work" for func in stats.stats)
+
+
+def test_sampling_stage_writes_collapsed_stacks(tmp_path):
+    profiler = make_profiler(tmp_path, mode="sampling")
+    with profiler.stage(CORR_ID, "extract_data", True):
+        busy_work()
+    lines = (tmp_path / "test_corr-id" / "extract_data.collapsed").read_text()
+    assert "busy_work" in lines
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines.splitlines())
+
+
+def test_concurrent_cprofile_stages_profile_only_one(tmp_path):
+    profiler = make_profiler(tmp_path)
+    errors = []
+    started = threading.Barrier(4)
+
+    def stage(name: str):
+        try:
+            started.wait()
+            with profiler.stage(CORR_ID, name, True):
+                busy_work()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=stage, args=(f"t{i}",)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(list((tmp_path / "test_corr-id").iterdir())) >= 1
+    # released after each stage
+    with profiler.stage(CORR_ID, "after", True):
+        busy_work()
+    assert (tmp_path / "test_corr-id" / "after.pstats").exists()
+
+
+def test_stage_runs_unprofiled_when_cprofile_is_taken(tmp_path, monkeypatch):
+    def enable(self):
+        raise ValueError("Another profiling tool is already active")
+
+    monkeypatch.setattr(cProfile.Profile, "enable", enable)
+    profiler = make_profiler(tmp_path)
+    with profiler.stage(CORR_ID, "extract_data", True):
+        busy_work()
+    assert not (tmp_path / "test_corr-id" / "extract_data.pstats").exists()
+    assert not profiler._cprofile_lock.locked()
@@ -1,6 +1,10 @@
 import asyncio
+import socket
+import uuid
 from aio_pika import IncomingMessage
+from aio_pika.exceptions import ChannelClosed
 from datetime import datetime, timezone
+import aio_pika
 import pytest
 
 from service_python_shared.modules.rabbitmq import (
@@ -8,6 +12,7 @@ from service_python_shared.modules.rabbitmq import (
     RabbitMqMessageSender,
     RabbitMqMessageReceiver,
     RabbitMqMessage,
+    shard_key,
 )
 from service_python_shared.configs.config import config
 
@@ -21,6 +26,20 @@ SENDER_ID = config["rabbitmq"]["service_queue_name"]
 TEST_MESSAGE = "this is a test message"
 
 
+def broker_available() -> bool:
+    settings = config["rabbitmq"]["connection_settings"]
+    try:
+        with socket.create_connection((settings["host"], settings["port"]), 0.5):
+            return True
+    except OSError:
+        return False
+
+
+needs_broker = pytest.mark.skipif(
+    not broker_available(), reason="RabbitMQ is not running"
+)
+
+
 @pytest.mark.asyncio
 @pytest.mark.timeout(5)
 async def test_connect_and_disconnect():
@@ -115,3 +134,71 @@ async def test_send_message_from_a_to_b_and_check_headers():
 
     assert sender.is_connected() is False
     assert receiver.is_connected() is False
+
+
+def test_shard_key_is_md5_of_message():
+    assert shard_key(b'{"md5": "abc123", "filepath": "a.jpg"}') == "abc123"
+    assert shard_key(b'{"filepath": "a.jpg"}') == ""
+    assert shard_key(b"not json") == ""
+    assert shard_key(b'["md5"]') == ""
+
+
+def test_receiver_shard_names_include_replica(monkeypatch):
+    monkeypatch.setitem(config["rabbitmq"], "replica_id", "replica-1")
+    receiver = RabbitMqMessageReceiver(QUEUE_1, sharded=True)
+    assert receiver.shard_exchange_name == f"{QUEUE_1}.shards"
+    assert receiver.shard_queue_name == f"{QUEUE_1}.shard.replica-1"
+    assert receiver.is_connected() is False
+
+
+def test_sharding_needs_a_replica_id(monkeypatch):
+    monkeypatch.setitem(config["rabbitmq"], "replica_id", "")
+    with pytest.raises(ValueError):
+        RabbitMqMessageReceiver(QUEUE_1, sharded=True)
+    assert RabbitMqMessageReceiver(QUEUE_1, sharded=False)
+
+
+@needs_broker
+@pytest.mark.asyncio
+@pytest.mark.timeout(20)
+async def test_shard_of_crashed_replica_is_reaped(monkeypatch):
+    queue_name = f"tester-shards-{uuid.uuid4().hex[:8]}"
+    receivers = {}
+    for replica_id in ("crashed", "survivor"):
+        monkeypatch.setitem(config["rabbitmq"], "replica_id", replica_id)
+        receiver = RabbitMqMessageReceiver(queue_name, sharded=True)
+        await receiver.connect()
+        try:
+            await receiver._join_shard_ring()
+        except ChannelClosed:
+            pytest.skip("rabbitmq_consistent_hash_exchange plugin not enabled")
+        receivers[replica_id] = receiver
+    crashed, survivor = receivers["crashed"], receivers["survivor"]
+    channel = survivor.connection.channel
+
+    try:
+        for i in range(50):
+            await survivor.shard_exchange.publish(
+                aio_pika.Message(body=b"{}"), routing_key=f"md5-{i}"
+            )
+        stranded = await channel.declare_queue(crashed.shard_queue_name, passive=True)
+        assert stranded.declaration_result.message_count > 0
+
+        # gone without leaving the ring
+        await crashed.connection.close()
+        assert await survivor.reap_shard_ring() == []
+        assert await survivor.reap_shard_ring() == [crashed.shard_queue_name]
+
+        service_queue = await channel.declare_queue(queue_name, passive=True)
+        assert (
+            service_queue.declaration_result.message_count
+            == stranded.declaration_result.message_count
+        )
+        # only live shard queues stay in the ring
+        assert await survivor.reap_shard_ring() == []
+    finally:
+        await survivor.leave_shard_ring()
+        for name in (queue_name, f"{queue_name}.dead", survivor.shard_members_name):
+            await channel.queue_delete(name)
+        await channel.exchange_delete(survivor.shard_exchange_name)
+        await survivor.close()
@@ -0,0 +1,207 @@
+import asyncio
+import os
+import signal
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from loguru import logger
+
+from service_python_shared.configs.config import config
+from service_python_shared.modules import logger as logger_module
+from service_python_shared.modules.logger import (
+    get_logger,
+    setup_logging,
+    setup_worker_logging,
+)
+from service_python_shared.modules.Supervisor import (
+    Supervisor,
+    read_memory,
+    run_worker,
+)
+from service_python_shared.modules.Workflow import Workflow, WorkflowStats
+
+
+class FakeReceiver:
+    def is_connected(self) -> bool:
+        return True
+
+
+class FakeWorkflow:
+    """Logs its lifecycle to a file, the first one started crashes"""
+
+    def __init__(self, log: Path):
+        self.log = log
+        self.stats = WorkflowStats()
+        self.receiver = FakeReceiver()
+
+    def write(self, event: str):
+        with self.log.open("a") as log:
+            log.write(f"{event} {os.getpid()}\n")
+
+    async def start_receiving_messages(self):
+        crash = not self.log.exists()
+        self.write("started")
+        if crash:
+            await asyncio.sleep(0.1)
+            raise RuntimeError("connection lost")
+        await asyncio.Event().wait()
+
+    async def drain(self, timeout: float):
+        self.write("drained")
+
+
+def events(log: Path, name: str):
+    if not log.exists():
+        return []
+    return [line for line in log.read_text().splitlines() if line.startswith(name)]
+
+
+def wait_for(condition, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def test_workers_log_to_files_of_their_own(tmp_path, monkeypatch):
+    monkeypatch.setitem(config["logger"], "combined_log", str(tmp_path / "service.log"))
+    monkeypatch.setitem(config["logger"], "error_log", str(tmp_path / "errors.log"))
+    monkeypatch.setattr(logger_module, "_logging_to_files", False)
+    try:
+        setup_logging()
+        get_logger("test").info("from the supervisor")
+        setup_worker_logging(2)
+        get_logger("test").info("from a worker")
+    finally:
+        logger.remove()
+        logger.add(sys.stderr)
+
+    assert "from the supervisor" in (tmp_path / "service.log").read_text()
+    worker_log = (tmp_path / "service.worker-2.log").read_text()
+    assert "from a worker" in worker_log
+    assert "from the supervisor" not in worker_log
+    assert (tmp_path / "errors.worker-2.log").exists()
+
+
+class Closable:
+    def __init__(self, closed: list, name: str):
+        self.closed = closed
+        self.name = name
+
+    async def stop_consuming(self):
+        pass
+
+    async def close(self):
+        self.closed.append(self.name)
+
+    async def close_grpc_socket(self):
+        self.closed.append(self.name)
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_drain_closes_the_service_before_its_connections():
+    closed = []
+
+    async def on_close():
+        closed.append("service")
+
+    workflow = Workflow(description="drain test", extract_data=len, on_close=on_close)
+    workflow.receiver = Closable(closed, "receiver")
+    workflow.sender = Closable(closed, "sender")
+    workflow.jobManagerClient = Closable(closed, "grpc")
+    await workflow.drain(timeout=1)
+    assert closed == ["receiver", "service", "sender", "grpc"]
+
+
+def test_read_memory_of_this_process():
+    rss, pss, private = read_memory(os.getpid())
+    if rss == 0:
+        pytest.skip("/proc/<pid>/smaps_rollup not available")
+    assert rss >= private > 0
+    assert read_memory(0) == (0.0, 0.0, 0.0)
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_run_worker_drains_on_sigterm(tmp_path):
+    log = tmp_path / "log"
+    log.write_text("")
+
+    async def stop_soon():
+        await asyncio.sleep(0.1)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    stopper = asyncio.create_task(stop_soon())
+    code = await run_worker(lambda: FakeWorkflow(log), drain_timeout=1)
+    await stopper
+    assert code == 0
+    assert len(events(log, "drained")) == 1
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_running_loop().remove_signal_handler(sig)
+
+
+def start_supervisor(log: Path) -> int:
+    settings = {
+        "workers": 2,
+        "drain_timeout_s": 2,
+        "stats_interval_s": 60,
+        "restart_backoff_max_s": 1,
+    }
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            code = Supervisor(lambda: FakeWorkflow(log), settings).run()
+        finally:
+            os._exit(code)
+    return pid
+
+
+def stop_supervisor(pid: int) -> int:
+    try:
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+        return os.waitstatus_to_exitcode(status)
+    finally:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+@pytest.mark.timeout(20)
+def test_supervisor_restarts_crashed_worker_and_drains_all(tmp_path):
+    log = tmp_path / "log"
+    pid = start_supervisor(log)
+    try:
+        # the crashed worker is replaced after a second
+        wait_for(lambda: len(events(log, "started")) == 3)
+    finally:
+        code = stop_supervisor(pid)
+
+    assert code == 0
+    assert len(events(log, "drained")) == 2
+
+
+@pytest.mark.timeout(20)
+def test_supervisor_rolling_restart(tmp_path):
+    log = tmp_path / "log"
+    log.write_text("")
+    pid = start_supervisor(log)
+    try:
+        wait_for(lambda: len(events(log, "started")) == 2)
+        os.kill(pid, signal.SIGHUP)
+        wait_for(lambda: len(events(log, "started")) == 4)
+        first_drained = events(log, "drained")
+    finally:
+        code = stop_supervisor(pid)
+
+    assert code == 0
+    assert len(first_drained) == 2
+    # every worker was replaced, none of the originals are drained twice
+    started = {line.split()[1] for line in events(log, "started")}
+    drained = [line.split()[1] for line in events(log, "drained")]
+    assert len(started) == 4 and sorted(drained) == sorted(started)
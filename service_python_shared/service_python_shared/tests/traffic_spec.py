@@ -0,0 +1,125 @@
+from datetime import datetime, timezone
+from typing import Any
+
+import cv2
+import numpy as np
+import pytest
+
+from service_python_shared.modules.rabbitmq import RabbitMqMessage
+from service_python_shared.modules.replay import (
+    ReplayIncomingMessage,
+    ReplayJobManagerClient,
+    ReplaySender,
+    replay,
+)
+from service_python_shared.modules.traffic import TrafficArchive, TrafficRecorder
+from service_python_shared.modules.Workflow import Workflow
+
+HEIF_HEADER = b"\x00\x00\x00\x18ftypheic" + bytes(16)
+
+
+def make_message(filepath: str) -> RabbitMqMessage:
+    return RabbitMqMessage[dict](
+        from_="JobManager",
+        to="tester",
+        time=datetime.now(timezone.utc).isoformat(),
+        jobId="test-job-id",
+        errors=[],
+        filepath=filepath,
+        md5=f"md5-{filepath}",
+        message={},
+    )
+
+
+def record(
+    recorder: TrafficRecorder, filepath: str, corr_id: str, image_data: bytes
+) -> bool:
+    recording = recorder.start(
+        make_message(filepath),
+        {"x-correlation-id": corr_id, "authorization": "token"},
+    )
+    if recording is None:
+        return False
+    recording.image_data = image_data
+    recording.settle("completed")
+    recorder.finish(recording)
+    return True
+
+
+def record_archive(tmp_path) -> TrafficArchive:
+    archive = TrafficArchive(tmp_path / "archive")
+    recorder = TrafficRecorder(archive, sample_rate=1.0, max_messages=4)
+    ok, image = cv2.imencode(".png", np.zeros((32, 48, 3), dtype=np.uint8))
+    assert ok
+    record(recorder, "a.png", "corr-a", image.tobytes())
+    record(recorder, "b.png", "corr-b", image.tobytes())
+    # HEIF is known not to decode so is rejected
+    record(recorder, "photo.heic", "corr-c", HEIF_HEADER)
+    # settled before its image data was streamed, not replayed
+    recording = recorder.start(make_message("gone.png"), {"x-correlation-id": "corr-d"})
+    recording.settle("rejected", "bad request, no credentials provided")
+    recorder.finish(recording)
+    # over the limit, not recorded
+    assert not record(recorder, "e.png", "corr-e", image.tobytes())
+    recorder.close()
+    return archive
+
+
+def test_recorder_stores_duplicate_image_data_once(tmp_path):
+    archive = record_archive(tmp_path)
+    entries = list(archive.messages())
+    assert [e.message["filepath"] for e in entries] == [
+        "a.png",
+        "b.png",
+        "photo.heic",
+        "gone.png",
+    ]
+    assert entries[0].blob == entries[1].blob
+    assert len(list(archive.blobs_path.iterdir())) == 2
+    assert entries[3].blob is None
+    assert not entries[3].authorized
+    assert entries[3].outcome == "rejected"
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_workflow_records_messages_with_their_outcome(tmp_path):
+    source = record_archive(tmp_path)
+    workflow = Workflow(description="record test", extract_data=len)
+    workflow.jobManagerClient = ReplayJobManagerClient(source)
+    workflow.sender = ReplaySender()
+    archive = TrafficArchive(tmp_path / "recorded")
+    workflow.recorder = TrafficRecorder(archive, sample_rate=1.0, max_messages=10)
+
+    for entry in list(source.messages())[:3]:
+        workflow.jobManagerClient.blobs[entry.corr_id] = entry.blob
+        message = ReplayIncomingMessage(
+            {"x-correlation-id": entry.corr_id, "authorization": "token"}
+        )
+        data = RabbitMqMessage[Any].model_validate(entry.message)
+        await workflow.handle_incoming_message(data, message)
+    await workflow._close_recorder()
+
+    entries = list(archive.messages())
+    assert [e.outcome for e in entries] == ["completed", "completed", "rejected"]
+    assert "heif" in entries[2].reason
+    # rejected from its header, before any image data was kept
+    assert entries[0].blob is not None and entries[2].blob is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.timeout(5)
+async def test_replay_reports_outcomes(tmp_path):
+    archive = record_archive(tmp_path)
+    sizes = []
+    workflow = Workflow(
+        description="replay test", extract_data=lambda data: sizes.append(len(data))
+    )
+
+    report = await replay(workflow, archive, speed=None)
+
+    assert (report.messages, report.completed, report.rejected) == (3, 2, 1)
+    assert report.skipped == 1
+    assert len(sizes) == 2
+    assert len(workflow.sender.sent) == 3
+    assert report.latency_max_ms >= report.latency_p50_ms